@@ -0,0 +1,104 @@
+"""Compare the memory used by the full and compact TVDB records.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_records [--series N] [--episodes M]
+"""
+
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+from scotchbutter.util import tvdb
+
+
+class StubApi():
+    """Serves synthetic series and episode payloads without any network."""
+
+    def __init__(self, episodes: int):
+        self.episodes = episodes
+
+    def get_series_data(self, series_id: int):
+        return synthetic_series(series_id)
+
+    def get_episodes(self, series_id: int):
+        return [synthetic_episode(series_id, number) for number in range(self.episodes)]
+
+
+def synthetic_series(series_id: int) -> dict:
+    """Build a payload shaped like /series/{id}."""
+    return {
+        'id': series_id, 'seriesId': series_id, 'seriesName': f'Series {series_id}',
+        'firstAired': '2004-9-22', 'airsDayOfWeek': 'Wednesday', 'airsTime': '9:00 PM',
+        'banner': f'graphical/{series_id}-g.jpg', 'imdbId': f'tt{series_id:07d}',
+        'overview': 'A long running drama about people on an island. ' * 6,
+        'network': 'ABC', 'runtime': '45', 'genre': ['Drama'], 'status': 'Ended',
+        'rating': 'TV-14', 'siteRating': 8.4, 'siteRatingCount': 1200, 'slug': f'series-{series_id}',
+        'aliases': [], 'added': '', 'addedBy': None, 'lastUpdated': 1500000000,
+        'networkId': '', 'zap2itId': '',
+    }
+
+
+def synthetic_episode(series_id: int, number: int) -> dict:
+    """Build a payload shaped like an entry of /series/{id}/episodes."""
+    return {
+        'id': series_id * 100000 + number, 'airedSeason': number // 24 + 1,
+        'airedSeasonID': series_id * 100 + number // 24,
+        'airedEpisodeNumber': number % 24 + 1, 'episodeName': f'Episode {number}',
+        'firstAired': f'20{number % 20:02d}-{number % 12 + 1}-{number % 28 + 1}',
+        'absoluteNumber': number + 1, 'dvdSeason': number // 24 + 1,
+        'dvdEpisodeNumber': number % 24 + 1, 'dvdChapter': None, 'dvdDiscid': '',
+        'imdbId': '', 'seriesId': series_id, 'filename': f'episodes/{series_id}/{number}.jpg',
+        'overview': f'Something surprising happens in episode {number}. ' * 5,
+        'language': {'episodeName': 'en', 'overview': 'en'}, 'lastUpdated': 1500000000 + number,
+        'directors': ['Someone'], 'writers': ['Someone Else'], 'guestStars': [],
+        'productionCode': '', 'showUrl': '', 'siteRating': 7.9, 'siteRatingCount': 20,
+        'thumbAdded': '', 'thumbAuthor': 1, 'thumbHeight': '225', 'thumbWidth': '400',
+        'airsAfterSeason': None, 'airsBeforeEpisode': None, 'airsBeforeSeason': None,
+        'lastUpdatedBy': 1,
+    }
+
+
+def measure(series_type, series_count: int, episodes: int) -> dict:
+    """Build series_count series with all their episodes and measure the memory held."""
+    api = StubApi(episodes)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    library = []
+    for series_id in range(1, series_count + 1):
+        series = series_type(api.get_series_data(series_id), api)
+        series.episodes
+        library.append(series)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'records': series_type.__name__,
+        'series': series_count,
+        'episodes': series_count * episodes,
+        'retained_bytes': current,
+        'peak_bytes': peak,
+        'bytes_per_episode': round(current / (series_count * episodes), 1),
+        'build_seconds': round(elapsed, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--series', type=int, default=50)
+    parser.add_argument('--episodes', type=int, default=2000)
+    args = parser.parse_args()
+    results = [measure(series_type, args.series, args.episodes)
+               for series_type in (tvdb.TvdbSeries, tvdb.CompactSeries)]
+    for result in results:
+        print(json.dumps(result))
+    ratio = results[0]['retained_bytes'] / results[1]['retained_bytes']
+    print(f'Compact records retain {ratio:.1f}x less memory')
+
+
+if __name__ == '__main__':
+    main()
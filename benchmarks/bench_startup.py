@@ -0,0 +1,91 @@
+"""Measure the startup time of the show_runner CLI.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup [--runs N] [--top N]
+
+Prints the `python -X importtime` breakdown of importing
+scotchbutter.show_runner, then the median wall time of CLI invocations
+that only touch the local database, run against a throwaway library.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# CLI invocations timed against the throwaway library.
+COMMANDS = (
+    ('--help',),
+    ('search', 'Series 1'),
+)
+
+
+def import_times(env: dict) -> list:
+    """Return the (cumulative_us, self_us, module) of importing show_runner."""
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             'import scotchbutter.show_runner'],
+                            env=env, capture_output=True, text=True, check=True)
+    rows = []
+    for line in output.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        rows.append((int(cumulative_us), int(self_us), module.rstrip()))
+    return rows
+
+
+def build_library(home: str, series: int = 20, episodes: int = 100):
+    """Fill the library in the settings folder under home."""
+    script = ('from benchmarks.bench_records import StubApi\n'
+              'from scotchbutter.util import database, tvdb\n'
+              f'api = StubApi({episodes})\n'
+              'with database.DBInterface() as db:\n'
+              f'    for series_id in range(1, {series + 1}):\n'
+              '        db.add_series(tvdb.TvdbSeries(api.get_series_data(series_id), api))\n')
+    subprocess.run([sys.executable, '-c', script], env=dict(os.environ, HOME=home, APPDATA=home),
+                   check=True)
+
+
+def time_command(arguments: list, env: dict, runs: int) -> float:
+    """Return the median wall time, in ms, of running python with arguments."""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, *arguments], env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+    return round(statistics.median(timings) * 1000, 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory(prefix='scotchbutter-startup-') as home:
+        env = dict(os.environ, HOME=home, APPDATA=home)
+        build_library(home)
+        rows = import_times(env)
+        total = next(row for row in rows if row[2].strip() == 'scotchbutter.show_runner')[0]
+        print(f'import scotchbutter.show_runner: {total / 1000:.1f} ms cumulative')
+        print(f"{'cumulative ms':>14}{'self ms':>10}  module")
+        for cumulative_us, self_us, module in sorted(rows, reverse=True)[:args.top]:
+            print(f'{cumulative_us / 1000:>14.1f}{self_us / 1000:>10.1f}  {module}')
+        results = {
+            'import_ms': round(total / 1000, 1),
+            'interpreter_ms': time_command(['-c', 'pass'], env, args.runs),
+            'commands_ms': {},
+        }
+        for command in COMMANDS:
+            results['commands_ms'][' '.join(command)] = time_command(
+                ['-m', 'scotchbutter.show_runner', *command], env, args.runs)
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
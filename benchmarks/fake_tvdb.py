@@ -0,0 +1,213 @@
+"""A local stand-in for the TVDB API, serving synthetic data for benchmarks.
+
+Run it on its own to point a client at it by hand:
+
+    python -m benchmarks.fake_tvdb [--port 8080] [--series N] [--episodes M] [--latency S]
+
+TvdbApi reaches it through transport.KeepAliveTransport(hosts=FakeTvdb.hosts).
+GET /_stats returns the request and byte counters without counting itself.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib import parse
+
+from benchmarks.bench_records import synthetic_episode, synthetic_series
+
+# TVDB serves episodes 100 per page.
+PAGE_SIZE = 100
+# Series returned by a search.
+SEARCH_RESULTS = 10
+
+
+class FakeTvdb():
+    """Serves a synthetic library of series episodes series with episodes each.
+
+    latency seconds are slept before every response.  requests and
+    bytes_sent count what the server handled, reset() zeroes them.
+    """
+
+    def __init__(self, series: int = 100, episodes: int = 250, latency: float = 0.0,
+                 banner_size: int = 32 * 1024, host: str = '127.0.0.1', port: int = 0):
+        """Create the server, it starts serving on start()."""
+        self.series = series
+        self.episodes = episodes
+        self.latency = latency
+        self.banner_size = banner_size
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.bytes_sent = 0
+        self._server = ThreadingHTTPServer((host, port), _handler_for(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Origin the server listens on."""
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def hosts(self) -> dict:
+        """Host mapping for transport.KeepAliveTransport routing TVDB here."""
+        return {'api.thetvdb.com': self.url, 'thetvdb.com': self.url}
+
+    @property
+    def stats(self) -> dict:
+        """Return the request and byte counters."""
+        with self._lock:
+            return {'requests': self.requests, 'bytes_sent': self.bytes_sent}
+
+    def reset(self):
+        """Zero the counters."""
+        with self._lock:
+            self.requests = 0
+            self.bytes_sent = 0
+
+    def count(self, size: int):
+        """Record a response of size body bytes."""
+        with self._lock:
+            self.requests += 1
+            self.bytes_sent += size
+
+    def start(self):
+        """Serve requests on a background thread."""
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and release the port."""
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop the server."""
+        self.stop()
+
+    def banner(self, path: str) -> bytes:
+        """Return the synthetic image stored at path, distinct per path."""
+        seed = hashlib.sha256(path.encode('utf-8')).digest()
+        return (seed * (self.banner_size // len(seed) + 1))[:self.banner_size]
+
+
+def _handler_for(fake: FakeTvdb):
+    """Build the request handler class bound to fake."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # Headers and body go out in separate writes, without this
+            # Nagle's algorithm adds ~40ms to every response.
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, status: int, payload=None, body: bytes = None,
+                  content_type: str = 'application/json', counted: bool = True):
+            if body is None:
+                body = json.dumps(payload).encode('utf-8')
+            headers = {'Content-Type': content_type}
+            if (content_type == 'application/json'
+                    and 'gzip' in (self.headers.get('Accept-Encoding') or '')):
+                body = gzip.compress(body, compresslevel=5)
+                headers['Content-Encoding'] = 'gzip'
+            if fake.latency:
+                time.sleep(fake.latency)
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            if counted:
+                fake.count(len(body))
+
+        def not_found(self):
+            self.reply(404, {'Error': 'Resource not found'})
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            if self.path == '/login':
+                return self.reply(200, {'token': 'benchmark-token'})
+            return self.not_found()
+
+        def do_GET(self):
+            url = parse.urlsplit(self.path)
+            query = parse.parse_qs(url.query)
+            parts = url.path.strip('/').split('/')
+            if parts[0] == '_stats':
+                return self.reply(200, fake.stats, counted=False)
+            if parts[0] == 'refresh_token':
+                return self.reply(200, {'token': 'benchmark-token'})
+            if parts[0] == 'banners':
+                return self.reply(200, body=fake.banner(url.path), content_type='image/jpeg')
+            if parts[:2] == ['search', 'series']:
+                name = query.get('name', [''])[0]
+                results = [dict(synthetic_series(series_id),
+                                seriesName=f'{name} {series_id}')
+                           for series_id in range(1, min(fake.series, SEARCH_RESULTS) + 1)]
+                return self.reply(200, {'data': results})
+            if parts[:2] == ['updated', 'query']:
+                results = [{'id': series_id, 'lastUpdated': int(time.time())}
+                           for series_id in range(1, fake.series + 1)]
+                return self.reply(200, {'data': results})
+            if parts[0] == 'episodes' and len(parts) == 2:
+                episode_id = int(parts[1])
+                series_id, number = divmod(episode_id, 100000)
+                return self.reply(200, {'data': synthetic_episode(series_id, number)})
+            if parts[0] != 'series' or len(parts) < 2 or not parts[1].isdigit():
+                return self.not_found()
+            series_id = int(parts[1])
+            if not 1 <= series_id <= fake.series:
+                return self.not_found()
+            if len(parts) == 2:
+                return self.reply(200, {'data': synthetic_series(series_id)})
+            if parts[2] != 'episodes':
+                return self.not_found()
+            page = int(query.get('page', ['1'])[0])
+            last_page = max(1, -(-fake.episodes // PAGE_SIZE))
+            if page > last_page:
+                return self.not_found()
+            numbers = range((page - 1) * PAGE_SIZE, min(page * PAGE_SIZE, fake.episodes))
+            links = {'first': 1, 'last': last_page,
+                     'next': page + 1 if page < last_page else None,
+                     'prev': page - 1 if page > 1 else None}
+            return self.reply(200, {'data': [synthetic_episode(series_id, number)
+                                             for number in numbers],
+                                    'links': links})
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--series', type=int, default=100)
+    parser.add_argument('--episodes', type=int, default=250)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    fake = FakeTvdb(args.series, args.episodes, args.latency, port=args.port)
+    print(f'Serving {args.series} series on {fake.url}')
+    fake.start()
+    try:
+        fake._thread.join()
+    except KeyboardInterrupt:
+        fake.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,268 @@
+"""Run the TvdbApi/DBInterface benchmark scenarios against a local fake TVDB.
+
+Run from the repository root:
+
+    python -m benchmarks.run [--series N] [--episodes M] [--latency S] [--rate R]
+                             [--scenario NAME ...] [--output FILE] [--compare FILE]
+
+Each scenario runs in its own process, so peak RSS is per scenario, with
+a fresh settings folder.  The results are printed as JSON tagged with the
+git commit, save them with --output and pass them to --compare on a later
+commit to see the change.
+"""
+
+import argparse
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib import request
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, peak RSS is then not reported.
+    resource = None
+
+SCENARIOS = ('search', 'single_add', 'bulk_add', 'library_read', 'artwork')
+# Metrics shown by --compare, lower is better for all of them.
+COMPARED_METRICS = ('wall_seconds', 'requests', 'bytes_sent', 'peak_rss_kib', 'sqlite_seconds')
+SEARCH_QUERIES = 50
+
+
+class SqliteTimer():
+    """Accumulates the time spent inside sqlite calls."""
+
+    seconds = 0.0
+    calls = 0
+
+    @classmethod
+    def timed(cls, func, *args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            cls.seconds += time.perf_counter() - start
+            cls.calls += 1
+
+
+class TimedCursor(sqlite3.Cursor):
+    """Cursor recording the time spent executing and fetching."""
+
+    def execute(self, *args):
+        return SqliteTimer.timed(super().execute, *args)
+
+    def executemany(self, *args):
+        return SqliteTimer.timed(super().executemany, *args)
+
+    def fetchone(self):
+        return SqliteTimer.timed(super().fetchone)
+
+    def fetchmany(self, *args):
+        return SqliteTimer.timed(super().fetchmany, *args)
+
+    def fetchall(self):
+        return SqliteTimer.timed(super().fetchall)
+
+    def __next__(self):
+        return SqliteTimer.timed(super().__next__)
+
+
+class TimedConnection(sqlite3.Connection):
+    """Connection handing out TimedCursors and timing its own statements."""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        return SqliteTimer.timed(super().commit)
+
+
+def timed_profile():
+    """Return a database.ConnectionProfile whose connections are timed."""
+    from scotchbutter.util import database
+
+    class TimedProfile(database.ConnectionProfile):
+        def connect(self, db_file, **kwargs):
+            return super().connect(db_file, factory=TimedConnection, **kwargs)
+
+    return TimedProfile()
+
+
+def peak_rss_kib():
+    """Return the peak resident set size of this process in KiB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def git_commit():
+    """Return the current commit, marked -dirty with uncommitted changes."""
+    root = Path(__file__).resolve().parent.parent
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=root, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=root, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return f'{commit}-dirty' if status.strip() else commit
+
+
+class Scenario():
+    """Runs one scenario in the current process against the fake server at url."""
+
+    def __init__(self, url: str, series: int, schema: str = None, rate: float = None):
+        from scotchbutter.util import database, ratelimit, transport, tvdb
+
+        self.url = url
+        self.series = series
+        hosts = {'api.thetvdb.com': url, 'thetvdb.com': url}
+        rate_limiter = None
+        if rate:
+            rate_limiter = ratelimit.RateLimiter(rate, burst=max(10, int(rate)), max_rate=rate)
+        self.api = tvdb.TvdbApi(use_cache=False,
+                                http_transport=transport.KeepAliveTransport(hosts=hosts),
+                                rate_limiter=rate_limiter)
+        self.db = database.DBInterface(profile=timed_profile(), schema=schema)
+
+    def server_stats(self) -> dict:
+        with request.urlopen(f'{self.url}/_stats') as response:
+            return json.loads(response.read())
+
+    def fill_library(self):
+        from scotchbutter.util import refresh
+        refresh.refresh_library(self.db, self.api, list(range(1, self.series + 1)))
+
+    def search(self):
+        for number in range(SEARCH_QUERIES):
+            self.api.search_series(f'Series {number}')
+
+    def single_add(self):
+        self.db.add_series(self.api.get_series(1))
+
+    def bulk_add(self):
+        self.fill_library()
+
+    def library_read(self):
+        from scotchbutter.util import database
+        for row in self.db.iter_library(row_type=database.ROW_TUPLE):
+            list(self.db.iter_episodes(row[0], row_type=database.ROW_TUPLE))
+
+    def artwork(self):
+        from scotchbutter.util import artwork
+        artwork.ArtworkDownloader(self.api).download_library(self.db)
+
+    def run(self, name: str) -> dict:
+        """Run the setup for name, then measure name itself."""
+        if name in ('library_read', 'artwork'):
+            self.fill_library()
+        before = self.server_stats()
+        SqliteTimer.seconds = 0.0
+        SqliteTimer.calls = 0
+        start = time.perf_counter()
+        getattr(self, name)()
+        wall = time.perf_counter() - start
+        after = self.server_stats()
+        self.db.close()
+        return {
+            'wall_seconds': round(wall, 4),
+            'requests': after['requests'] - before['requests'],
+            'bytes_sent': after['bytes_sent'] - before['bytes_sent'],
+            'peak_rss_kib': peak_rss_kib(),
+            'sqlite_seconds': round(SqliteTimer.seconds, 4),
+            'sqlite_calls': SqliteTimer.calls,
+        }
+
+
+def run_scenario(name: str, url: str, args) -> dict:
+    """Run a scenario in a child process with its own settings folder."""
+    with tempfile.TemporaryDirectory(prefix='scotchbutter-bench-') as home:
+        env = dict(os.environ, HOME=home, APPDATA=home)
+        command = [sys.executable, '-m', 'benchmarks.run', '--worker', name, '--url', url,
+                   '--series', str(args.series)]
+        if args.schema:
+            command += ['--schema', args.schema]
+        if args.rate:
+            command += ['--rate', str(args.rate)]
+        output = subprocess.run(command, env=env, capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError(f'Scenario {name} failed:\n{output.stderr}')
+        return json.loads(output.stdout.splitlines()[-1])
+
+
+def compare(old: dict, new: dict):
+    """Print the change of every metric between two result documents."""
+    print(f"{'scenario':<14}{'metric':<16}{'old':>14}{'new':>14}{'change':>10}")
+    for name, metrics in new['scenarios'].items():
+        old_metrics = old.get('scenarios', {}).get(name)
+        if old_metrics is None:
+            continue
+        for metric in COMPARED_METRICS:
+            before, after = old_metrics.get(metric), metrics.get(metric)
+            if before is None or after is None:
+                continue
+            change = f'{(after - before) / before:+.1%}' if before else ''
+            print(f'{name:<14}{metric:<16}{before:>14}{after:>14}{change:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--series', type=int, default=100)
+    parser.add_argument('--episodes', type=int, default=250)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='Seconds the fake server waits before each response.')
+    parser.add_argument('--schema', choices=('per_series', 'normalized'))
+    parser.add_argument('--rate', type=float,
+                        help='Fixed requests/s for the client, instead of the adaptive '
+                             'default, e.g. 10000 to take request pacing out of the numbers.')
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS)
+    parser.add_argument('--output', type=Path)
+    parser.add_argument('--compare', type=Path)
+    parser.add_argument('--worker', choices=SCENARIOS, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        scenario = Scenario(args.url, args.series, args.schema, args.rate)
+        print(json.dumps(scenario.run(args.worker)))
+        return
+
+    from benchmarks.fake_tvdb import FakeTvdb
+
+    results = {
+        'commit': git_commit(),
+        'timestamp': int(time.time()),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'parameters': {'series': args.series, 'episodes': args.episodes,
+                       'latency': args.latency, 'schema': args.schema, 'rate': args.rate},
+        'scenarios': {},
+    }
+    with FakeTvdb(args.series, args.episodes, args.latency) as fake:
+        for name in args.scenario or SCENARIOS:
+            results['scenarios'][name] = run_scenario(name, fake.url, args)
+            print(f'{name}: {json.dumps(results["scenarios"][name])}', file=sys.stderr)
+    document = json.dumps(results, indent=2)
+    if args.output:
+        args.output.write_text(document + '\n', encoding='utf-8')
+    print(document)
+    if args.compare:
+        compare(json.loads(args.compare.read_text(encoding='utf-8')), results)
+
+
+if __name__ == '__main__':
+    main()
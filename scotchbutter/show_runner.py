@@ -1,14 +1,14 @@
 #!/usr/bin/env python
-"""Provide a debugging front end for maintaining the database."""
+"""Provide a debugging front end for maintaining the database.
+
+The CLI is run often from scripts, so each action imports only the modules
+it needs and the TVDB client is only built by actions that go online.
+"""
 
 import argparse
 import logging
 import sys
 
-from scotchbutter.util import tvdb
-
-# from scotchbutter.util import database
-
 logger = logging.getLogger(__name__)
 
 
@@ -16,9 +16,21 @@ class FatalError(Exception):
     """Manually raised excpetions that should end the script."""
 
 
+def positive_int(value: str) -> int:
+    """Parse a count argument, which must be at least 1."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f'{value} is not a positive integer')
+    return number
+
+
 def parse_args() -> argparse.Namespace:
     """Parse initialization arguments."""
     parser = argparse.ArgumentParser()
+    parser.add_argument('--profile', action='store_true',
+                        help='Print timings of the network and database calls when done')
+    parser.add_argument('--profile-format', choices=('text', 'json', 'prometheus'),
+                        default='text', help='Format of the --profile output')
     subparsers = parser.add_subparsers(dest='action')
     subparsers.required = True
     # Arguments for adding a series to the database.
@@ -30,10 +42,45 @@ def parse_args() -> argparse.Namespace:
     # Arguments for searching TVDB for a series.
     search_parser = subparsers.add_parser('search', help='Search TVDB for a TV series')
     search_parser.add_argument('search_text', nargs='+', type=str, help='Text to search on TVDB.')
+    search_parser.add_argument('--remote', action='store_true',
+                               help='Skip the local library and search TVDB directly')
+    # Arguments for resolving a batch of raw titles to SeriesIds.
+    resolve_parser = subparsers.add_parser('resolve',
+                                           help='Match raw titles to TVDB series as JSON lines')
+    resolve_parser.add_argument('file', nargs='?', type=str,
+                                help='File with one title per line, stdin when missing or -')
+    resolve_parser.add_argument('--workers', type=positive_int,
+                                help='Number of searches run at once')
+    resolve_parser.add_argument('--threshold', type=float,
+                                help='Lowest match score reported as a match')
     # Arguments for updating the series information in the database.
     update_parser = subparsers.add_parser('update',
                                           help='Update series/episode information in the library')
-    update_parser.add_argument('series_id', type=int, help='The TVDB SeriesId')
+    update_parser.add_argument('series_id', nargs='*', type=int, help='The TVDB SeriesIds')
+    update_parser.add_argument('--all', action='store_true',
+                               help='Update every series in the library')
+    update_parser.add_argument('--workers', type=positive_int,
+                               help='Number of series fetched at once')
+    # Arguments for syncing the library with the changes on TVDB.
+    sync_parser = subparsers.add_parser(
+        'sync', help='Update library series that changed since the last sync')
+    sync_parser.add_argument('--workers', type=positive_int,
+                             help='Number of series fetched at once')
+    # Arguments for migrating the database to the single episodes table.
+    subparsers.add_parser('migrate', help='Move all episodes into a single normalized table')
+    # Arguments for listing the episodes airing soon.
+    upcoming_parser = subparsers.add_parser('upcoming',
+                                            help='List library episodes airing soon')
+    upcoming_parser.add_argument('--days', type=int,
+                                 help='Number of days to look ahead')
+    upcoming_parser.add_argument('--next', action='store_true',
+                                 help='Show the next episode of every series instead')
+    # Arguments for exporting/importing a library snapshot.
+    snapshot_parser = subparsers.add_parser('snapshot',
+                                            help='Export or import the library as a snapshot file')
+    snapshot_parser.add_argument('direction', choices=('export', 'import'),
+                                 help='Write the library to file or load file into it')
+    snapshot_parser.add_argument('file', type=str, help='Path of the snapshot file')
     # Arguments for displaying information about a show.
     info_parser = subparsers.add_parser('info', help='Display information about a series')
     info_parser.add_argument('series_id', type=int, help='The TVDB SeriesId')
@@ -42,13 +89,21 @@ def parse_args() -> argparse.Namespace:
     group.add_argument('--episode', type=int, help='Show episode overview')
     # Arguments for downloading artwork for a show.
     artwork_parser = subparsers.add_parser('artwork', help='Download artwork for a series')
-    artwork_parser.add_argument('series_id', type=int, help='The TVDB SeriesId')
+    artwork_parser.add_argument('series_id', nargs='?', type=int, help='The TVDB SeriesId')
+    artwork_parser.add_argument('--all', action='store_true',
+                                help='Download artwork for every series in the library')
     artwork_parser.add_argument('--banner', action='store_true', help='Download the series banner')
     artwork_parser.add_argument('--thumbs', action='store_true',
                                 help='Download the episode thumbs')
+    artwork_parser.add_argument('--workers', type=positive_int,
+                                help='Number of files downloaded at once')
     args = parser.parse_args()
     if args.action == 'search':
         args.search_text = ' '.join(args.search_text)
+    if args.action == 'update' and bool(args.series_id) == args.all:
+        parser.error('update requires either series_id(s) or --all')
+    if args.action == 'artwork' and (args.series_id is None) != args.all:
+        parser.error('artwork requires either a series_id or --all')
     return args
 
 
@@ -61,35 +116,193 @@ def check_implemented_actions(args: argparse.Namespace) -> None:
         'add': set(),
         'remove': set(),
         'search': set(),
+        'resolve': set(),
+        'update': set(),
+        'sync': set(),
+        'migrate': set(),
+        'upcoming': set(),
+        'snapshot': set(),
         'info': {'series_id', 'overview', 'episode'},
-        'artwork': {'series_id', 'banner', 'thumbs'},
+        'artwork': set(),
     }
     args_dict = vars(args)
     for action in notimplemented_actions[args_dict['action']]:
         if args_dict[action]:
             raise NotImplementedError(f'{args.action} {action} is not implemented')
 
-def search_series(tvdb_api: tvdb.TvdbApi, search_text: str) -> dict:
-    """Search TVDB for shows."""
+
+def get_tvdb_api():
+    """Build the TVDB client, only actions that go online call this."""
+    from scotchbutter.util import tvdb
+    return tvdb.TvdbApi()
+
+
+def search_library(search_text: str) -> bool:
+    """Search the local library for shows, returns False when nothing matched."""
+    from scotchbutter.util import database
+    with database.DBInterface() as db:
+        results = db.search(search_text)
+    found_series = {}
+    for result in results:
+        found_series.setdefault(result['seriesId'], result['seriesName'])
+    for series_id, series_name in found_series.items():
+        print(f'{series_name} -- SeriesId: {series_id} (library)')
+    return bool(found_series)
+
+
+def search_series(search_text: str, remote: bool = False) -> dict:
+    """Search the library, or TVDB when the library has no match, for shows."""
+    if remote is False and search_library(search_text):
+        return
     try:
-        results = tvdb_api.search_series(search_text)
+        results = get_tvdb_api().search_series(search_text)
     except LookupError:
         results = {}
     if not results:
         raise FatalError(f'TVDB returned no results for search string: "{search_text}"')
     for series_ident, series in sorted(results.items()):
-        print(f'{series} -- SeriesId: {series.id}')
+        print(f'{series} -- SeriesId: {series.series_id}')
+
+
+def resolve_titles(file_path: str = None, workers: int = None,
+                   threshold: float = None) -> None:
+    """Print a JSON line with the best matching series of every title read."""
+    from scotchbutter.util import resolver
+    if file_path in (None, '-'):
+        titles = sys.stdin
+    else:
+        try:
+            titles = open(file_path, encoding='utf-8')
+        except OSError as error:
+            raise FatalError(f'Unable to read titles: {error}')
+    if workers is None:
+        workers = resolver.RESOLVE_WORKERS
+    if threshold is None:
+        threshold = resolver.MATCH_THRESHOLD
+    with titles, resolver.Resolver(get_tvdb_api(), workers, threshold=threshold) as batch:
+        for line in batch.resolve_lines(titles):
+            print(line, flush=True)
+
+
+def update_series(series_ids: list, workers: int = None) -> None:
+    """Refresh series in the library, or the whole library if series_ids is empty."""
+    from scotchbutter.util import database, refresh
+    with database.DBInterface() as db:
+        stats = refresh.refresh_library(db, get_tvdb_api(), series_ids or None,
+                                        workers=workers or refresh.REFRESH_WORKERS)
+    print(stats)
+    if stats.failed:
+        raise FatalError(f'Failed to update SeriesIds: {sorted(stats.failed)}')
+
+
+def sync_library(workers: int = None) -> None:
+    """Update the library series that changed on TVDB since the last sync."""
+    from scotchbutter.util import database, refresh
+    with database.DBInterface() as db:
+        stats = refresh.sync_library(db, get_tvdb_api(),
+                                     workers=workers or refresh.REFRESH_WORKERS)
+    print(stats)
+    if stats.failed:
+        raise FatalError(f'Failed to sync SeriesIds: {sorted(stats.failed)}')
+
+
+def migrate_database() -> None:
+    """Move the per-series episode tables into the normalized episodes table."""
+    from scotchbutter.util import database
+    with database.DBInterface() as db:
+        migrated = db.migrate_to_normalized()
+    print(f'Migrated {migrated} series to the normalized episodes table')
+
+
+def list_upcoming(days: int = None, next_only: bool = False) -> None:
+    """Print the library episodes airing in the next days, or each series' next episode."""
+    from scotchbutter.util import database
+    if days is None:
+        days = database.UPCOMING_DAYS
+    with database.DBInterface() as db:
+        episodes = db.next_episodes() if next_only else db.upcoming(days)
+    if not episodes:
+        raise FatalError('No upcoming episodes in the library')
+    for episode in episodes:
+        airs_time = f" {episode['airsTime']}" if episode['airsTime'] else ''
+        print(f"{episode['airDate']}{airs_time} -- {episode['seriesName']} "
+              f"S{episode['airedSeason']:02d}E{episode['airedEpisodeNumber']:02d} "
+              f"{episode['episodeName']}")
+
+
+def snapshot_library(direction: str, file_path: str) -> None:
+    """Export the library to a snapshot file, or import one into the library."""
+    from scotchbutter.util import database, snapshot
+    with database.DBInterface() as db:
+        try:
+            if direction == 'export':
+                counts = db.export_snapshot(file_path)
+            else:
+                counts = db.import_snapshot(file_path)
+        except (OSError, snapshot.SnapshotError) as error:
+            raise FatalError(f'Snapshot {direction} failed: {error}')
+    print(f"{direction.capitalize()}ed {counts['series']} series and "
+          f"{counts['episodes']} episodes")
+
+
+def download_artwork(args: argparse.Namespace) -> None:
+    """Download the banner and/or episode thumbs of a series or the whole library."""
+    from scotchbutter.util import artwork, database
+    banner, thumbs = args.banner, args.thumbs
+    if not (banner or thumbs):
+        banner = thumbs = True
+    tvdb_api = get_tvdb_api()
+    downloader = artwork.ArtworkDownloader(tvdb_api, args.workers or artwork.ARTWORK_WORKERS)
+    if args.all:
+        with database.DBInterface() as db:
+            stats = downloader.download_library(db, banner, thumbs)
+    else:
+        try:
+            series = tvdb_api.get_series(args.series_id)
+        except LookupError:
+            raise FatalError(f'TVDB has no series with SeriesId {args.series_id}')
+        stats = downloader.download_series(series, banner, thumbs)
+    print(stats)
+    if stats.failed:
+        raise FatalError(f'Failed to download {len(stats.failed)} files')
+
 
+def print_profile(profile_format: str) -> None:
+    """Print the collected metrics to stderr."""
+    from scotchbutter.util import metrics
+    if profile_format == 'json':
+        output = metrics.REGISTRY.to_json(indent=2)
+    elif profile_format == 'prometheus':
+        output = metrics.REGISTRY.to_prometheus()
+    else:
+        output = metrics.REGISTRY.summary()
+    print(output, file=sys.stderr)
 
 
 def main():
     """Run the showrunner script."""
     args = parse_args()
     check_implemented_actions(args)
-    tvdb_api = tvdb.TvdbApi()
+    if args.profile:
+        import atexit
+        atexit.register(print_profile, args.profile_format)
     try:
         if args.action == 'search':
-            search_series(tvdb_api, args.search_text)
+            search_series(args.search_text, args.remote)
+        elif args.action == 'resolve':
+            resolve_titles(args.file, args.workers, args.threshold)
+        elif args.action == 'update':
+            update_series(args.series_id, args.workers)
+        elif args.action == 'sync':
+            sync_library(args.workers)
+        elif args.action == 'migrate':
+            migrate_database()
+        elif args.action == 'upcoming':
+            list_upcoming(args.days, args.next)
+        elif args.action == 'snapshot':
+            snapshot_library(args.direction, args.file)
+        elif args.action == 'artwork':
+            download_artwork(args)
     except FatalError as error:
         print(error)
         sys.exit(2)
@@ -1,13 +1,175 @@
+"""Contains the base classes for sources and the engine that crawls them.
 
-"""Contains the base classes for sources."""
+A SiteSource describes how to crawl one video site: the pages to start
+from and parsing hooks that turn each fetched Page into more Requests to
+follow and the EpisodeLinks found on it.  crawl() runs any number of
+sources through a shared FetchScheduler, which limits the requests in
+flight per host, spaces them out politely and caches the responses, and
+matches every link against an EpisodeIndex of the library.
+"""
 
+import logging
+import time
 from abc import ABCMeta
 from abc import abstractmethod
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib import parse
+
+from scotchbutter.util import database, http_cache, ratelimit, transport
+from scotchbutter.util.titles import normalize_title
+
+# Pages fetched and parsed at once across all hosts.
+CRAWL_WORKERS = 16
+CACHE_FILENAME = 'source_cache.sqlite'
+USER_AGENT = 'scotchbutter'
+# Times a throttled request is sent before it is given up on.
+MAX_ATTEMPTS = 3
+
+logger = logging.getLogger(__name__)
+
+
+class Request():
+    """A page to fetch and the hook that parses it."""
+
+    __slots__ = ('url', 'callback', 'context', 'attempt')
+
+    def __init__(self, url: str, callback=None, context: dict = None):
+        """Create a request, callback defaults to the source's parse method."""
+        self.url = url
+        self.callback = callback
+        self.context = context or {}
+        self.attempt = 0
+
+    def __repr__(self):
+        return f'<Request {self.url}>'
+
+
+class Page():
+    """Container for a fetched page."""
+
+    __slots__ = ('url', 'body', 'context', 'from_cache')
+
+    def __init__(self, url: str, body: bytes, context: dict, from_cache: bool = False):
+        """Create a page container."""
+        self.url = url
+        self.body = body
+        self.context = context
+        self.from_cache = from_cache
+
+    @property
+    def text(self) -> str:
+        """The body decoded as text."""
+        return self.body.decode('utf-8', errors='replace')
+
+    def urljoin(self, link: str) -> str:
+        """Resolve a link found on the page."""
+        return parse.urljoin(self.url, link)
+
+
+class EpisodeLink():
+    """An episode a source page says is available.
+
+    series is a seriesId, or a title when the site doesn't know TVDB ids.
+    """
+
+    __slots__ = ('series', 'season', 'episode', 'url')
+
+    def __init__(self, series, season: int, episode: int, url: str):
+        """Create a link container."""
+        self.series = series
+        self.season = season
+        self.episode = episode
+        self.url = url
+
+    def __repr__(self):
+        return f'<EpisodeLink {self.series} S{self.season:02d}E{self.episode:02d} {self.url}>'
+
+
+class EpisodeIndex():
+    """Library episodes keyed by (seriesId, season, episode) for constant time matching."""
+
+    # Episode columns kept as the record of each key.
+    RECORD_COLUMNS = ('id', 'episodeName')
+
+    def __init__(self):
+        """Create an empty index."""
+        self.series_names = {}
+        self._series_ids = {}
+        self._episodes = {}
+
+    def __len__(self):
+        return len(self._episodes)
+
+    def __contains__(self, key):
+        return key in self._episodes
+
+    def add_series(self, series_id: int, *titles):
+        """Add a series, every title is matched to it after normalize_title."""
+        self.series_names.setdefault(series_id, titles[0] if titles else str(series_id))
+        for title in titles:
+            self._series_ids[normalize_title(title)] = series_id
+
+    def add_episode(self, series_id: int, season: int, episode: int, record):
+        """Add an episode of a series already in the index."""
+        self._episodes[(series_id, season, episode)] = record
+
+    def series_id(self, series):
+        """Return the seriesId of a seriesId or title, None if it isn't in the index."""
+        if isinstance(series, int):
+            return series if series in self.series_names else None
+        return self._series_ids.get(normalize_title(series))
+
+    def key(self, series, season, episode):
+        """Return the (seriesId, season, episode) key, None if the series is unknown."""
+        series_id = self.series_id(series)
+        if series_id is None:
+            return None
+        return series_id, int(season), int(episode)
+
+    def get(self, series, season, episode):
+        """Return the record of an episode, None if it isn't in the library."""
+        return self._episodes.get(self.key(series, season, episode))
+
+    @classmethod
+    def from_database(cls, db: database.DBInterface):
+        """Build the index of every episode in the library."""
+        # Deferred so the index can be built without loading the TVDB client.
+        from scotchbutter.util.tvdb import make_series_ident
+
+        index = cls()
+        for series_id, series_name, first_aired in db.iter_library(
+                ('seriesId', 'seriesName', 'firstAired'), database.ROW_TUPLE):
+            index.add_series(series_id, series_name, make_series_ident(series_name, first_aired))
+        columns = ('airedSeason', 'airedEpisodeNumber') + cls.RECORD_COLUMNS
+        if db.schema == database.SCHEMA_NORMALIZED:
+            if db.episodes_name in db.existing_tables:
+                rows = db.iter_rows(db.episodes_name, ('seriesId',) + columns,
+                                    row_type=database.ROW_TUPLE)
+                for series_id, season, episode, *record in rows:
+                    index.add_episode(series_id, season, episode, tuple(record))
+        else:
+            existing_tables = set(db.existing_tables)
+            for series_id in list(index.series_names):
+                # A series added without episodes has no table yet.
+                if not db.episode_table_exists(series_id, existing_tables):
+                    continue
+                for season, episode, *record in db.iter_episodes(series_id, columns,
+                                                                 database.ROW_TUPLE):
+                    index.add_episode(series_id, season, episode, tuple(record))
+        logger.info('Indexed %s episodes of %s series', len(index), len(index.series_names))
+        return index
 
 
 class SiteSource(metaclass=ABCMeta):
     """Base class for the site parser for video sources."""
 
+    # Requests in flight to the site, and seconds between starting them.
+    max_concurrent = 2
+    delay = 1.0
+    # Seconds a cached page is used before it is fetched again.
+    cache_ttl = 6 * 60 * 60
+
     @property
     @abstractmethod
     def base_url(self):
@@ -18,3 +180,243 @@ class SiteSource(metaclass=ABCMeta):
     def language(self):
         pass
 
+    @property
+    def name(self):
+        """Name the source is reported under."""
+        return type(self).__name__
+
+    @property
+    def host(self):
+        """Host the politeness limits apply to."""
+        return parse.urlsplit(self.base_url).hostname
+
+    @abstractmethod
+    def start_requests(self, index: EpisodeIndex):
+        """Yield the Requests a crawl starts from.
+
+        index lets a source only visit the series that are in the library.
+        """
+
+    @abstractmethod
+    def parse(self, page: Page):
+        """Yield the Requests to follow and the EpisodeLinks found on page.
+
+        Requests may name another method of the source as their callback,
+        so each kind of page gets its own hook.
+        """
+
+
+class Throttled(Exception):
+    """Raised when a site asked us to slow down."""
+
+    def __init__(self, retry_after: float = None):
+        super().__init__(f'Throttled, retry after {retry_after}s')
+        self.retry_after = retry_after
+
+
+class _HostState():
+    """Queue and limits of the requests for one host."""
+
+    def __init__(self, max_concurrent: int, delay: float):
+        self.max_concurrent = max(1, max_concurrent)
+        self.delay = delay
+        self.queue = deque()
+        self.in_flight = 0
+        self.next_start = 0.0
+
+
+class FetchScheduler():
+    """Fetches and parses pages for any number of sources with a shared pool.
+
+    Each host has its own queue.  A request is only handed to a worker
+    while its host has fewer than max_concurrent requests in flight, and
+    requests to a host start at least delay seconds apart, so a slow or
+    strict site never ties up the workers other sites could use.  Fresh
+    cached pages skip both limits.
+    """
+
+    def __init__(self, workers: int = CRAWL_WORKERS, use_cache: bool = True,
+                 http_transport: transport.Transport = None):
+        """Create a scheduler, use_cache keeps pages in a persistent ResponseCache."""
+        self.workers = max(1, workers)
+        self.cache = http_cache.ResponseCache(CACHE_FILENAME) if use_cache else None
+        self.transport = http_transport or transport.KeepAliveTransport()
+        self._hosts = {}
+        self._ready = deque()
+        self.fetched = 0
+        self.cached = 0
+
+    def set_host_limits(self, host: str, max_concurrent: int, delay: float):
+        """Set the politeness limits of a host."""
+        state = self._hosts.get(host)
+        if state is None:
+            self._hosts[host] = _HostState(max_concurrent, delay)
+        else:
+            state.max_concurrent = max(1, max_concurrent)
+            state.delay = delay
+
+    def add(self, source: SiteSource, request: Request):
+        """Queue a request of source."""
+        if self.cache is not None:
+            cached, fresh = self.cache.lookup(request.url, source.cache_ttl)
+            if fresh:
+                self._ready.append((source, request, cached.body))
+                return
+        host = parse.urlsplit(request.url).hostname
+        if host not in self._hosts:
+            self.set_host_limits(host, source.max_concurrent, source.delay)
+        self._hosts[host].queue.append((source, request))
+
+    def _fetch(self, url: str, start_at: float) -> bytes:
+        """Fetch url once its politeness delay has passed."""
+        wait_time = start_at - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+        headers = {'User-Agent': USER_AGENT}
+        cached = None
+        if self.cache is not None:
+            cached, _ = self.cache.lookup(url, 0)
+            if cached is not None:
+                headers.update(cached.validators)
+        response = self.transport.request('GET', url, headers)
+        if response.status == 304 and cached is not None:
+            self.cache.revalidate(url)
+            return cached.body
+        if response.status in ratelimit.THROTTLE_STATUSES:
+            raise Throttled(ratelimit.parse_retry_after(response.headers.get('Retry-After')))
+        if response.status == 404:
+            raise LookupError(f'{url} was not found')
+        if response.status != 200:
+            raise ConnectionError(f'Unexpected Response: {response.status}.')
+        if self.cache is not None:
+            self.cache.store(url, response.body, response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'))
+        return response.body
+
+    @staticmethod
+    def _parse(source: SiteSource, request: Request, body: bytes, from_cache: bool) -> list:
+        """Run the parsing hook of a request over its page."""
+        callback = request.callback or source.parse
+        return list(callback(Page(request.url, body, request.context, from_cache)))
+
+    def _work(self, source: SiteSource, request: Request, start_at: float) -> list:
+        """Fetch and parse a page on a worker thread."""
+        body = self._fetch(request.url, start_at)
+        return self._parse(source, request, body, False)
+
+    def _dispatch(self, executor, futures: dict):
+        """Hand every request the host limits allow to the workers."""
+        while self._ready:
+            source, request, body = self._ready.popleft()
+            self.cached += 1
+            future = executor.submit(self._parse, source, request, body, True)
+            futures[future] = (source, request, None)
+        now = time.monotonic()
+        for host, state in self._hosts.items():
+            while state.queue and state.in_flight < state.max_concurrent:
+                source, request = state.queue.popleft()
+                start_at = max(now, state.next_start)
+                state.next_start = start_at + state.delay
+                state.in_flight += 1
+                future = executor.submit(self._work, source, request, start_at)
+                futures[future] = (source, request, host)
+
+    def run(self):
+        """Process the queued requests, yields (source, request, items, error).
+
+        items is the list the parsing hook produced, error the exception
+        raised while fetching or parsing, which fails only that page.
+        Requests added while iterating are processed before run() finishes.
+        """
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            self._dispatch(executor, futures)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    source, request, host = futures.pop(future)
+                    if host is not None:
+                        self._hosts[host].in_flight -= 1
+                        self.fetched += 1
+                    try:
+                        items = future.result()
+                    except Throttled as error:
+                        request.attempt += 1
+                        if host is not None and request.attempt < MAX_ATTEMPTS:
+                            state = self._hosts[host]
+                            # Back off the whole host, not just this request.
+                            state.delay = max(state.delay * 2, 1.0)
+                            state.next_start = time.monotonic() + (error.retry_after or state.delay)
+                            state.queue.appendleft((source, request))
+                            logger.debug('%s throttled, delay raised to %.1fs', host, state.delay)
+                            continue
+                        yield source, request, None, error
+                    except Exception as error:
+                        # A parse hook failing on a page must not end the crawl of every source.
+                        yield source, request, None, error
+                    else:
+                        yield source, request, items, None
+                self._dispatch(executor, futures)
+
+
+class CrawlResult():
+    """Episodes found available by a crawl."""
+
+    def __init__(self):
+        """Create an empty result, failed holds the (source, url) of failed pages and links."""
+        self.found = {}
+        self.unmatched = []
+        self.failed = []
+        self.pages = 0
+        self.elapsed = 0.0
+
+    def add(self, key, source_name: str, url: str):
+        """Record that source_name has the episode key at url."""
+        self.found.setdefault(key, []).append((source_name, url))
+
+    def __str__(self):
+        return (f'Crawled {self.pages} pages in {self.elapsed:.2f}s -- '
+                f'{len(self.found)} library episodes available, '
+                f'{len(self.unmatched)} links not in the library, '
+                f'{len(self.failed)} pages or links failed')
+
+
+def crawl(sources, index: EpisodeIndex, scheduler: FetchScheduler = None) -> CrawlResult:
+    """Crawl every source and match the links found against index."""
+    scheduler = scheduler or FetchScheduler()
+    result = CrawlResult()
+    start = time.perf_counter()
+    seen = set()
+    for source in sources:
+        scheduler.set_host_limits(source.host, source.max_concurrent, source.delay)
+        for request in source.start_requests(index):
+            if request.url not in seen:
+                seen.add(request.url)
+                scheduler.add(source, request)
+    for source, request, items, error in scheduler.run():
+        if error is not None:
+            logger.warning('%s failed to crawl %s: %s', source.name, request.url, error)
+            result.failed.append((source.name, request.url))
+            continue
+        result.pages += 1
+        for item in items:
+            if isinstance(item, Request):
+                if item.url not in seen:
+                    seen.add(item.url)
+                    scheduler.add(source, item)
+            elif isinstance(item, EpisodeLink):
+                try:
+                    key = index.key(item.series, item.season, item.episode)
+                except Exception as error:
+                    # A malformed link only fails itself, not the page or the crawl.
+                    logger.warning('%s found a malformed link on %s: %s', source.name,
+                                   request.url, error)
+                    result.failed.append((source.name, item.url))
+                    continue
+                if key is not None and key in index:
+                    result.add(key, source.name, item.url)
+                else:
+                    result.unmatched.append((source.name, item))
+    result.elapsed = time.perf_counter() - start
+    logger.info('%s', result)
+    return result
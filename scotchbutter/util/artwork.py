@@ -0,0 +1,213 @@
+"""Contains a concurrent downloader for series banners and episode thumbnails.
+
+Downloads are stored content-addressed under OBJECTS_DIR by their sha256 and
+hard linked to their TVDB path, so identical images are stored only once.
+A manifest of sizes and hashes lets later runs skip files already on disk.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib import parse
+
+from scotchbutter.util import database, environment, tvdb
+
+# Files downloaded at once.
+ARTWORK_WORKERS = 8
+MANIFEST_FILENAME = 'artwork_manifest.json'
+OBJECTS_DIR = 'objects'
+
+logger = logging.getLogger(__name__)
+
+
+def hash_file(file_path: Path, chunk_size: int = 64 * 1024):
+    """Return the (size, sha256 hexdigest) of a file on disk."""
+    digest = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return size, digest.hexdigest()
+
+
+class ArtworkManifest():
+    """Records the size and sha256 of every downloaded file, keyed by TVDB path."""
+
+    def __init__(self, manifest_file: Path):
+        """Load the manifest, or start an empty one."""
+        self._manifest_file = manifest_file
+        self._lock = threading.Lock()
+        self.entries = {}
+        if manifest_file.is_file():
+            with open(manifest_file, encoding='utf-8') as f:
+                self.entries = json.load(f)
+
+    def get(self, path: str):
+        """Return the {'size', 'sha256'} entry for path, or None."""
+        with self._lock:
+            return self.entries.get(path)
+
+    def record(self, path: str, size: int, sha256: str):
+        """Add or replace the entry for path."""
+        with self._lock:
+            self.entries[path] = {'size': size, 'sha256': sha256}
+
+    def save(self):
+        """Write the manifest to disk atomically."""
+        temp_file = self._manifest_file.with_name(f'{self._manifest_file.name}.tmp')
+        with self._lock:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+        os.replace(temp_file, self._manifest_file)
+
+
+class ArtworkStats():
+    """Counters describing an artwork download run."""
+
+    def __init__(self):
+        """Create an empty set of counters."""
+        self.downloaded = 0
+        self.skipped = 0
+        self.empty = 0
+        self.failed = []
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def __str__(self):
+        return (f'Downloaded {self.downloaded} files ({self.bytes} bytes) in '
+                f'{self.elapsed:.2f}s -- {self.skipped} already present, '
+                f'{self.empty} empty, {len(self.failed)} failed')
+
+
+class ArtworkDownloader():
+    """Downloads artwork from TVDB with a pool of workers."""
+
+    def __init__(self, tvdb_api, workers: int = ARTWORK_WORKERS, root: Path = None):
+        """Create a downloader storing files under root (the settings folder)."""
+        self._tvdb_api = tvdb_api
+        self.workers = max(1, workers)
+        self.root = root or environment.get_settings_path()
+        self.manifest = ArtworkManifest(self.root.joinpath(MANIFEST_FILENAME))
+
+    def output_file(self, path: str) -> Path:
+        """Return where the TVDB path is stored locally."""
+        return self.root.joinpath(path)
+
+    def object_file(self, sha256: str) -> Path:
+        """Return the content-addressed location of a file."""
+        return self.root.joinpath(OBJECTS_DIR, sha256[:2], sha256)
+
+    def is_current(self, path: str) -> bool:
+        """Check whether path is already downloaded."""
+        output_file = self.output_file(path)
+        if not output_file.is_file():
+            return False
+        entry = self.manifest.get(path)
+        if entry is None:
+            # Downloaded before the manifest existed, hashing beats a re-download.
+            self.manifest.record(path, *hash_file(output_file))
+            return True
+        return output_file.stat().st_size == entry['size']
+
+    def _link(self, object_file: Path, output_file: Path):
+        """Point output_file at the stored object, replacing any old file."""
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+        temp_file = output_file.with_name(f'.link-{uuid.uuid4().hex}')
+        try:
+            os.link(object_file, temp_file)
+        except OSError:
+            # Hard links are not available on every file system.
+            shutil.copyfile(object_file, temp_file)
+        os.replace(temp_file, output_file)
+
+    def fetch(self, path: str):
+        """Download a single TVDB path, returns the number of bytes fetched.
+
+        Returns None if the file was already present and 0 if TVDB sent an
+        empty file.
+        """
+        if self.is_current(path):
+            return None
+        url = parse.urljoin(tvdb.URLS['banners'], path)
+        incoming_file = self.root.joinpath(OBJECTS_DIR, 'incoming', uuid.uuid4().hex)
+        result = self._tvdb_api.stream_to_file(url, incoming_file)
+        if result is None:
+            logger.info('File %s was found, but contained no data.  Skipping download.', url)
+            return 0
+        size, sha256 = result
+        object_file = self.object_file(sha256)
+        if object_file.is_file():
+            os.remove(incoming_file)
+        else:
+            object_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(incoming_file, object_file)
+        self._link(object_file, self.output_file(path))
+        self.manifest.record(path, size, sha256)
+        logger.debug('Downloaded %s to %s', url, self.output_file(path))
+        return size
+
+    def download_paths(self, paths) -> ArtworkStats:
+        """Download every TVDB path concurrently."""
+        stats = ArtworkStats()
+        start = time.perf_counter()
+        paths = list(dict.fromkeys(path for path in paths if path))
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(self.fetch, path): path for path in paths}
+                for future in as_completed(futures):
+                    try:
+                        size = future.result()
+                    except (LookupError, ConnectionError, OSError) as error:
+                        logger.warning('Failed to download %s: %s', futures[future], error)
+                        stats.failed.append(futures[future])
+                        continue
+                    if size is None:
+                        stats.skipped += 1
+                    elif size == 0:
+                        stats.empty += 1
+                    else:
+                        stats.downloaded += 1
+                        stats.bytes += size
+        finally:
+            self.manifest.save()
+        stats.elapsed = time.perf_counter() - start
+        logger.info('%s', stats)
+        return stats
+
+    @staticmethod
+    def series_paths(series, banner: bool = True, thumbs: bool = True) -> list:
+        """List the artwork paths of a tvdb.TvdbSeries."""
+        paths = []
+        if banner:
+            paths.append(series['banner'])
+        if thumbs:
+            paths.extend(episode['filename'] for episode in series.episodes)
+        return [path for path in paths if path]
+
+    @staticmethod
+    def library_paths(db, banner: bool = True, thumbs: bool = True):
+        """Yield the artwork paths of every series in the library database."""
+        rows = list(db.iter_library(('seriesId', 'banner'), database.ROW_TUPLE))
+        for series_id, series_banner in rows:
+            if banner and series_banner:
+                yield series_banner
+            if thumbs:
+                for filename, in db.iter_episodes(series_id, ('filename',), database.ROW_TUPLE):
+                    if filename:
+                        yield filename
+
+    def download_series(self, series, banner: bool = True, thumbs: bool = True) -> ArtworkStats:
+        """Download the banner and/or episode thumbnails of a series."""
+        return self.download_paths(self.series_paths(series, banner, thumbs))
+
+    def download_library(self, db, banner: bool = True, thumbs: bool = True) -> ArtworkStats:
+        """Download the artwork of every series in the library database."""
+        return self.download_paths(self.library_paths(db, banner, thumbs))
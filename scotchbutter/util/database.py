@@ -3,16 +3,138 @@
 NOTE: Currently only supporting sqlite databases
 """
 
+import datetime
 import logging
+import re
 import sqlite3
 import time
+from contextlib import contextmanager
 
-from scotchbutter.util import environment, tables
+from scotchbutter.util import environment, metrics, snapshot, tables
 
 DB_FILENAME = 'tvshows.sqlite'
+# Each series gets its own episode table named after the seriesId.
+SCHEMA_PER_SERIES = 'per_series'
+# Every episode lives in a single table keyed by the episode id.
+SCHEMA_NORMALIZED = 'normalized'
+# sync_state key recording which schema the database uses.
+SCHEMA_KEY = 'schema'
+# Row types returned by DBInterface.iter_rows.
+ROW_DICT = 'dict'
+ROW_SQLITE = 'row'
+ROW_TUPLE = 'tuple'
+# Rows pulled from sqlite per fetchmany call.
+FETCH_BATCH_SIZE = 500
+# Results returned by DBInterface.search by default.
+SEARCH_LIMIT = 20
+# bm25 weights of the search_index columns: seriesName, episodeName, overview.
+SEARCH_WEIGHTS = (10.0, 4.0, 1.0)
+# Days DBInterface.upcoming looks ahead by default.
+UPCOMING_DAYS = 7
+# TVDB dates are not zero padded, e.g. '1990-9-2'.
+TVDB_DATE_REGEX = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+# Rows per snapshot record when exporting and per executemany when importing.
+SNAPSHOT_BATCH_SIZE = 5000
 
 logger = logging.getLogger(__name__)
 
+
+class ConnectionProfile():
+    """Settings applied to every new sqlite connection.
+
+    The defaults enable WAL so readers are not blocked while a refresh
+    writes.  Setting a pragma to None leaves the sqlite default in place.
+    """
+
+    def __init__(self, journal_mode: str = 'WAL', synchronous: str = 'NORMAL',
+                 cache_size: int = -16000, mmap_size: int = 256 * 1024 * 1024,
+                 temp_store: str = 'MEMORY', cached_statements: int = 256,
+                 busy_timeout: float = 5.0):
+        """Create a connection profile.
+
+        A negative cache_size is in KiB, a positive one in pages.
+        """
+        self.journal_mode = journal_mode
+        self.synchronous = synchronous
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.cached_statements = cached_statements
+        self.busy_timeout = busy_timeout
+
+    @property
+    def pragmas(self):
+        """List the (name, value) pragmas to run on a new connection."""
+        pragmas = [
+            ('journal_mode', self.journal_mode),
+            ('synchronous', self.synchronous),
+            ('cache_size', self.cache_size),
+            ('mmap_size', self.mmap_size),
+            ('temp_store', self.temp_store),
+        ]
+        return [(name, value) for name, value in pragmas if value is not None]
+
+    def connect(self, db_file, **kwargs):
+        """Open an sqlite connection using this profile."""
+        conn = sqlite3.connect(db_file, timeout=self.busy_timeout,
+                               cached_statements=self.cached_statements, **kwargs)
+        for name, value in self.pragmas:
+            conn.execute(f'PRAGMA {name} = {value}')
+        return conn
+
+
+DEFAULT_PROFILE = ConnectionProfile()
+
+
+def iso_date(value):
+    """Normalize a TVDB date to ISO 8601, None when it isn't a valid date."""
+    match = TVDB_DATE_REGEX.match(value or '')
+    if match is None:
+        return None
+    try:
+        return datetime.date(*map(int, match.groups())).isoformat()
+    except ValueError:
+        return None
+
+
+class SeriesChanges():
+    """Summary of the rows DBInterface.add_series wrote for a series."""
+
+    INSERTED = 'inserted'
+    UPDATED = 'updated'
+    UNCHANGED = 'unchanged'
+
+    def __init__(self, series_id: int):
+        """Create an empty summary."""
+        self.series_id = series_id
+        self.series = self.UNCHANGED
+        self.inserted = 0
+        self.updated = 0
+        self.deleted = 0
+        self.unchanged = 0
+
+    @property
+    def changed(self):
+        """Check if anything was written."""
+        return (self.series != self.UNCHANGED
+                or bool(self.inserted or self.updated or self.deleted))
+
+    def as_dict(self):
+        """Return the summary as plain data."""
+        return {
+            'seriesId': self.series_id,
+            'series': self.series,
+            'inserted': self.inserted,
+            'updated': self.updated,
+            'deleted': self.deleted,
+            'unchanged': self.unchanged,
+        }
+
+    def __str__(self):
+        return (f'seriesId {self.series_id} {self.series}: {self.inserted} episodes inserted, '
+                f'{self.updated} updated, {self.deleted} deleted, {self.unchanged} unchanged')
+
+
 class DBInterface():
     """Provides a contraced API to query the DataBase.
 
@@ -21,16 +143,57 @@ class DBInterface():
     """
 
     library_name = 'library'
+    state_name = 'sync_state'
+    episodes_name = 'episodes'
+    search_name = 'search_index'
+    schedule_name = 'schedule'
 
-    def __init__(self, db_file: str = DB_FILENAME):
-        """Create an interface to query the DataBase."""
+    def __init__(self, db_file: str = DB_FILENAME, schema: str = None,
+                 profile: ConnectionProfile = DEFAULT_PROFILE):
+        """Create an interface to query the DataBase.
+
+        schema is SCHEMA_PER_SERIES or SCHEMA_NORMALIZED, when None the
+        schema recorded in the database is used.  profile holds the
+        pragmas applied to the connection.
+        """
         self._settings_path = environment.get_settings_path()
         self._db_file = self._settings_path.joinpath(db_file)
         logger.info('Using database located at %s', self._db_file)
         self._conn = None
         self._cursor = None
+        self._requested_schema = schema
+        self._schema = schema
+        self._schema_checked = False
+        self._known_tables = set()
+        self.profile = profile
         self.close()
 
+    @property
+    def schema(self):
+        """The episode storage layout used by the database.
+
+        Raises ValueError when the normalized schema is requested for a
+        database still holding per-series tables, or when its episodes
+        table is not keyed by the episode id, see migrate_to_normalized.
+        """
+        if self._schema is None:
+            self._schema = self.get_state(SCHEMA_KEY, SCHEMA_PER_SERIES)
+        if self._schema == SCHEMA_NORMALIZED and not self._schema_checked:
+            if self.get_state(SCHEMA_KEY) != SCHEMA_NORMALIZED and self._series_tables():
+                raise ValueError(f'{self._db_file} stores episodes in per-series tables, '
+                                 'run migrate_to_normalized first')
+            if self._table_exists(self.episodes_name) and not self._episodes_keyed_by_id():
+                raise ValueError(f'{self._db_file} keys its episodes by their numbering, '
+                                 'run migrate_to_normalized first')
+            self._schema_checked = True
+        return self._schema
+
+    def _series_tables(self, existing_tables=None):
+        """List the per-series episode tables, which are named after their seriesId."""
+        if existing_tables is None:
+            existing_tables = self.existing_tables
+        return [name for name in existing_tables if name.isdigit()]
+
     @property
     def conn(self):
         """Create a DB connection if it doesn't already exist."""
@@ -45,6 +208,11 @@ class DBInterface():
             self.connect()
         return self._cursor
 
+    def _table_exists(self, name) -> bool:
+        """Check if a single table exists, cheaper than listing existing_tables."""
+        query = "SELECT 1 FROM sqlite_master WHERE type='table' AND name = ?"
+        return self.cursor.execute(query, (str(name),)).fetchone() is not None
+
     @property
     def existing_tables(self):
         """List tables currently in the database."""
@@ -56,9 +224,32 @@ class DBInterface():
     def connect(self):
         """Create a new connection to DB."""
         # If the database file doesn't exist, this will create it.
-        self._conn = sqlite3.connect(self._db_file)
+        self._conn = self.profile.connect(self._db_file)
         self._cursor = self.conn.cursor()
 
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed statements in a single transaction.
+
+        The transaction is committed on success and rolled back on error.
+        Nested calls join the transaction that is already open.
+        """
+        if self.conn.in_transaction:
+            yield self
+            return
+        self.conn.execute('BEGIN')
+        try:
+            yield self
+        except BaseException:
+            self.conn.rollback()
+            # Tables created or dropped, and schema changes, were rolled back too.
+            self._known_tables = set()
+            self._schema = self._requested_schema
+            self._schema_checked = False
+            raise
+        with metrics.timer('db.commit'):
+            self.conn.commit()
+
     def close(self, commit: bool = True):
         """Close the DB connections."""
         if self._conn is not None:
@@ -77,52 +268,648 @@ class DBInterface():
         """Closes any existing DB connection."""
         self.close()
 
-    def create_table(self, name, columns):
+    def create_table(self, name, columns, primary_key=None, indexes=()):
         """Create a table in the database."""
-        table = tables.Table(name)
+        table = tables.Table(name, primary_key)
         for column in columns:
             table.add_column(column)
-        if name not in self.existing_tables:
-            self.cursor.execute(table.create_table_string)
-            logger.info('Created table %s', name)
+        for index in indexes:
+            table.add_index(index)
+        name = str(name)
+        if name not in self._known_tables:
+            if not self._table_exists(name):
+                self.cursor.execute(table.create_table_string)
+                for index_string in table.create_index_strings:
+                    self.cursor.execute(index_string)
+                logger.info('Created table %s', name)
+            self._known_tables.add(name)
         return table
 
-    def add_series(self, series):
-        """Add a series to the database."""
-        table = self.create_table(self.library_name, tables.LIBRARY_COLUMNS)
-        values = [series[column.name] for column in table.columns]
-        self.cursor.execute(table.insert_string, values)
-        logger.info('Added seriesId %s to %s', series.series_id, self.library_name)
-        show_table = self.create_table(series.series_id, tables.SHOW_COLUMNS)
-        episodes = []
-        for episode in series.episodes:
-            values = [episode[column.name] for column in show_table.columns]
-            episodes.append(values)
-        logger.info('Added %s episodes to table %s', len(series.episodes), series.series_id)
-        self.cursor.executemany(show_table.insert_string, episodes)
+    def _create_episodes_table(self, series_id):
+        """Create the table holding the episodes of series_id."""
+        if self.schema == SCHEMA_NORMALIZED:
+            first_use = self.episodes_name not in self._known_tables
+            if first_use and self.get_state(SCHEMA_KEY) != SCHEMA_NORMALIZED:
+                self.set_state(SCHEMA_KEY, SCHEMA_NORMALIZED)
+            return self.create_table(self.episodes_name, tables.EPISODES_COLUMNS,
+                                     indexes=tables.EPISODES_INDEXES)
+        return self.create_table(series_id, tables.SHOW_COLUMNS)
+
+    def add_series(self, series, episodes=None):
+        """Add a series to the database, writing only the rows that changed.
+
+        New values are compared with the stored rows and only inserted or
+        modified rows are written, so refreshing an unchanged series does
+        almost no writes.  episodes limits the episodes written to a
+        subset of series.episodes.  Stored episodes missing from
+        series.episodes are deleted, but only when episodes is None.
+        Returns a SeriesChanges summary.
+        """
+        prune = episodes is None
+        if episodes is None:
+            episodes = series.episodes
+        changes = SeriesChanges(series.series_id)
+        with metrics.timer('db.add_series'), self.transaction():
+            table = self.create_table(self.library_name, tables.LIBRARY_COLUMNS)
+            values = tuple(column.coerce(series[column.name]) for column in table.columns)
+            stored = list(self.iter_rows(self.library_name, where='seriesId = ?',
+                                         params=(series.series_id,), row_type=ROW_TUPLE))
+            if not stored:
+                changes.series = SeriesChanges.INSERTED
+            elif stored[0] != values:
+                changes.series = SeriesChanges.UPDATED
+            if changes.series != SeriesChanges.UNCHANGED:
+                self.cursor.execute(table.insert_string, values)
+                logger.info('Added seriesId %s to %s', series.series_id, self.library_name)
+            show_table = self._create_episodes_table(series.series_id)
+            stored = {row[0]: row for row in self.iter_episodes(
+                series.series_id, [column.name for column in show_table.columns], ROW_TUPLE)}
+            rows = []
+            changed_episodes = []
+            seen = set()
+            for episode in episodes:
+                values = tuple(column.coerce(episode[column.name])
+                               for column in show_table.columns)
+                seen.add(values[0])
+                stored_values = stored.get(values[0])
+                if stored_values == values:
+                    changes.unchanged += 1
+                    continue
+                if stored_values is None:
+                    changes.inserted += 1
+                else:
+                    changes.updated += 1
+                rows.append(values)
+                changed_episodes.append(episode)
+            deleted = []
+            if prune:
+                deleted = [(episode_id,) for episode_id in stored if episode_id not in seen]
+            if deleted:
+                delete_string = f"DELETE FROM '{show_table.table_name}' WHERE id = ?"
+                self.cursor.executemany(delete_string, deleted)
+                changes.deleted = len(deleted)
+            if rows:
+                self.cursor.executemany(show_table.insert_string, rows)
+            logger.info('%s', changes)
+            if changes.series == SeriesChanges.UPDATED:
+                # The series name is stored with every episode entry of the search index.
+                changed_episodes = episodes
+            removed = [episode_id for episode_id, in deleted]
+            self._index_series(series, changed_episodes,
+                               index_series=changes.series != SeriesChanges.UNCHANGED,
+                               removed=removed)
+            self._schedule_series(series.series_id, changed_episodes, removed)
+        return changes
 
     def remove_series(self, series_id):
         """Remove a series from the database."""
-        drop_string = f"DROP TABLE IF EXISTS '{series_id}'"
-        delete_string = f"DELETE FROM '{self.library_name}' WHERE seriesId = {series_id}"
-        self.cursor.execute(delete_string)
-        logger.info('Removed %s from table %s', series_id, self.library_name)
-        self.cursor.execute(drop_string)
-        logger.info('Removed table %s', series_id)
-
-    def _select_from_table(self, table_name: str):
-        """Select all entries from a table."""
-        # TODO: expand this to accept where statements
-        results = self.cursor.execute(f'SELECT * from {table_name}')
-        column_names = [x[0] for x in results.description]
-        rows_values = [dict(zip(column_names, row)) for row in results]
+        with self.transaction():
+            self._unindex_series(series_id)
+            if self._table_exists(self.schedule_name):
+                self.cursor.execute(f"DELETE FROM '{self.schedule_name}' WHERE seriesId = ?",
+                                    (series_id,))
+            delete_string = f"DELETE FROM '{self.library_name}' WHERE seriesId = {series_id}"
+            self.cursor.execute(delete_string)
+            logger.info('Removed %s from table %s', series_id, self.library_name)
+            if self.schema == SCHEMA_NORMALIZED:
+                delete_string = f"DELETE FROM '{self.episodes_name}' WHERE seriesId = ?"
+                self.cursor.execute(delete_string, (series_id,))
+                logger.info('Removed %s from table %s', series_id, self.episodes_name)
+            else:
+                drop_string = f"DROP TABLE IF EXISTS '{series_id}'"
+                self.cursor.execute(drop_string)
+                self._known_tables.discard(str(series_id))
+                logger.info('Removed table %s', series_id)
+
+    @property
+    def _search_uses_fts(self):
+        """Check if the search index is an FTS5 table rather than the plain fallback."""
+        query = "SELECT sql FROM sqlite_master WHERE name = ?"
+        row = self.cursor.execute(query, (self.search_name,)).fetchone()
+        return row is not None and 'fts5' in row[0].lower()
+
+    def _create_search_index(self):
+        """Create the full-text index over series and episode names and overviews.
+
+        Series rows use -seriesId as their rowid and episode rows their
+        episode id, so single entries can be replaced by rowid.  When sqlite
+        is built without FTS5 a plain table searched with LIKE is used.
+        """
+        if self.search_name in self._known_tables:
+            return False
+        created = not self._table_exists(self.search_name)
+        if created:
+            columns = 'seriesName, episodeName, overview, seriesId UNINDEXED'
+            try:
+                self.cursor.execute(f"CREATE VIRTUAL TABLE '{self.search_name}' USING fts5("
+                                    f"{columns}, tokenize='unicode61 remove_diacritics 2')")
+            except sqlite3.OperationalError:
+                logger.warning('sqlite has no FTS5 support, falling back to LIKE searches')
+                self.cursor.execute(f"CREATE TABLE '{self.search_name}' (rowid INTEGER PRIMARY "
+                                    'KEY, seriesName TEXT, episodeName TEXT, overview TEXT, '
+                                    'seriesId INTEGER)')
+            logger.info('Created table %s', self.search_name)
+        self._known_tables.add(self.search_name)
+        return created
+
+    def _index_series(self, series, episodes, index_series: bool = True, removed=()):
+        """Add or replace the search entries of a series and some of its episodes.
+
+        index_series=False leaves the series entry alone, removed lists
+        episode ids whose entries are deleted.
+        """
+        if self._create_search_index():
+            # A new index also has to cover the series added before it existed.
+            self._fill_search_index()
+            return
+        insert_string = (f"INSERT INTO '{self.search_name}' "
+                         '(rowid, seriesName, episodeName, overview, seriesId) VALUES(?,?,?,?,?)')
+        delete_string = f"DELETE FROM '{self.search_name}' WHERE rowid = ?"
+        if removed:
+            self.cursor.executemany(delete_string, [(episode_id,) for episode_id in removed])
+        rows = []
+        if index_series:
+            rows.append((-series.series_id, series['seriesName'], None, series['overview'],
+                         series.series_id))
+        for episode in episodes:
+            rows.append((episode['id'], series['seriesName'], episode['episodeName'],
+                         episode['overview'], series.series_id))
+        self.cursor.executemany(delete_string, [(row[0],) for row in rows])
+        self.cursor.executemany(insert_string, rows)
+
+    def _unindex_series(self, series_id):
+        """Remove the search entries of a series."""
+        if not self._table_exists(self.search_name):
+            return
+        rowids = [(-series_id,)]
+        if self.episode_table_exists(series_id):
+            rowids.extend(self.iter_episodes(series_id, ('id',), ROW_TUPLE))
+        delete_string = f"DELETE FROM '{self.search_name}' WHERE rowid = ?"
+        self.cursor.executemany(delete_string, rowids)
+
+    def episode_table_exists(self, series_id, existing_tables: set = None):
+        """Check if the table holding the episodes of series_id exists.
+
+        Loops over the library pass existing_tables, read once, instead of
+        querying sqlite_master for every series.
+        """
+        table_name = self.episodes_name if self.schema == SCHEMA_NORMALIZED else str(series_id)
+        if table_name in self._known_tables:
+            return True
+        if existing_tables is not None:
+            return table_name in existing_tables
+        return self._table_exists(table_name)
+
+    def _fill_search_index(self):
+        """Index every series and episode already stored in the library."""
+        if not self._table_exists(self.library_name):
+            return
+        insert_string = (f"INSERT OR REPLACE INTO '{self.search_name}' "
+                         '(rowid, seriesName, episodeName, overview, seriesId) VALUES(?,?,?,?,?)')
+        library = list(self.iter_library(('seriesId', 'seriesName', 'overview'), ROW_TUPLE))
+        existing_tables = set(self.existing_tables)
+        for series_id, series_name, overview in library:
+            rows = [(-series_id, series_name, None, overview, series_id)]
+            if self.episode_table_exists(series_id, existing_tables):
+                columns = ('id', 'episodeName', 'overview')
+                for episode_id, name, episode_overview in self.iter_episodes(series_id, columns,
+                                                                             ROW_TUPLE):
+                    rows.append((episode_id, series_name, name, episode_overview, series_id))
+            self.cursor.executemany(insert_string, rows)
+        logger.info('Indexed %s series in %s', len(library), self.search_name)
+
+    def rebuild_search_index(self):
+        """Drop and rebuild the search index from the library."""
+        with self.transaction():
+            self.cursor.execute(f"DROP TABLE IF EXISTS '{self.search_name}'")
+            self._known_tables.discard(self.search_name)
+            self._create_search_index()
+            self._fill_search_index()
+
+    def _create_schedule(self):
+        """Create the schedule table, returns True if it didn't exist yet."""
+        if self.schedule_name in self._known_tables:
+            return False
+        created = not self._table_exists(self.schedule_name)
+        self.create_table(self.schedule_name, tables.SCHEDULE_COLUMNS,
+                          indexes=tables.SCHEDULE_INDEXES)
+        return created
+
+    @staticmethod
+    def _schedule_row(series_id, episode_id, season, number, name, first_aired):
+        """Return the schedule row of an episode, None if it has no valid air date."""
+        air_date = iso_date(first_aired)
+        if air_date is None:
+            return None
+        return (episode_id, series_id, air_date, season, number, name)
+
+    def _schedule_series(self, series_id, episodes, removed=()):
+        """Add or replace the schedule entries of some episodes of a series."""
+        if self._create_schedule():
+            # A new schedule also has to cover the series added before it existed.
+            self._fill_schedule()
+            return
+        table = self.create_table(self.schedule_name, tables.SCHEDULE_COLUMNS)
+        delete_string = f"DELETE FROM '{self.schedule_name}' WHERE episodeId = ?"
+        removed = list(removed)
+        rows = []
+        for episode in episodes:
+            row = self._schedule_row(series_id, episode['id'], episode['airedSeason'],
+                                     episode['airedEpisodeNumber'], episode['episodeName'],
+                                     episode['firstAired'])
+            if row is None:
+                # The date may have been removed upstream.
+                removed.append(episode['id'])
+            else:
+                rows.append(row)
+        if removed:
+            self.cursor.executemany(delete_string, [(episode_id,) for episode_id in removed])
+        if rows:
+            self.cursor.executemany(table.insert_string, rows)
+
+    def _fill_schedule(self):
+        """Schedule every episode already stored in the library."""
+        if not self._table_exists(self.library_name):
+            return
+        table = self.create_table(self.schedule_name, tables.SCHEDULE_COLUMNS)
+        columns = ('id', 'airedSeason', 'airedEpisodeNumber', 'episodeName', 'firstAired')
+        series_ids = [series_id for series_id, in self.iter_library(('seriesId',), ROW_TUPLE)]
+        existing_tables = set(self.existing_tables)
+        for series_id in series_ids:
+            if not self.episode_table_exists(series_id, existing_tables):
+                continue
+            rows = [self._schedule_row(series_id, *episode)
+                    for episode in self.iter_episodes(series_id, columns, ROW_TUPLE)]
+            self.cursor.executemany(table.insert_string, [row for row in rows if row])
+        logger.info('Scheduled %s series in %s', len(series_ids), self.schedule_name)
+
+    def rebuild_schedule(self):
+        """Drop and rebuild the schedule from the library."""
+        with self.transaction():
+            self.cursor.execute(f"DROP TABLE IF EXISTS '{self.schedule_name}'")
+            self._known_tables.discard(self.schedule_name)
+            self._create_schedule()
+            self._fill_schedule()
+
+    def _query_schedule(self, where: str, params: tuple, group_by: str = None,
+                        limit: int = None):
+        """Return schedule entries joined with their series, ordered by air date."""
+        if not self._table_exists(self.schedule_name):
+            if not self._table_exists(self.library_name):
+                return []
+            # Libraries from before the schedule existed get it on first use.
+            with self.transaction():
+                self._create_schedule()
+                self._fill_schedule()
+        query = ('SELECT s.seriesId, l.seriesName, l.airsTime, s.episodeId, s.airedSeason, '
+                 's.airedEpisodeNumber, s.episodeName, MIN(s.airDate) AS airDate '
+                 if group_by else
+                 'SELECT s.seriesId, l.seriesName, l.airsTime, s.episodeId, s.airedSeason, '
+                 's.airedEpisodeNumber, s.episodeName, s.airDate ')
+        query += (f"FROM '{self.schedule_name}' AS s "
+                  f"JOIN '{self.library_name}' AS l ON l.seriesId = s.seriesId WHERE {where}")
+        if group_by:
+            query += f' GROUP BY {group_by}'
+        query += ' ORDER BY airDate, l.seriesName, s.airedSeason, s.airedEpisodeNumber'
+        if limit is not None:
+            query += f' LIMIT {int(limit)}'
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(query, params)
+            column_names = [x[0] for x in cursor.description]
+            return [dict(zip(column_names, row)) for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+
+    def upcoming(self, days: int = UPCOMING_DAYS, start: datetime.date = None):
+        """Return the library episodes airing in the days from start (today) on."""
+        start = start or datetime.date.today()
+        end = start + datetime.timedelta(days=days)
+        with metrics.timer('db.upcoming'):
+            return self._query_schedule('s.airDate >= ? AND s.airDate < ?',
+                                        (start.isoformat(), end.isoformat()))
+
+    def next_episode(self, series_id, start: datetime.date = None):
+        """Return the next episode of a series airing on or after start (today), or None."""
+        start = start or datetime.date.today()
+        rows = self._query_schedule('s.seriesId = ? AND s.airDate >= ?',
+                                    (series_id, start.isoformat()), limit=1)
+        return rows[0] if rows else None
+
+    def next_episodes(self, start: datetime.date = None):
+        """Return the next episode of every series with one airing on or after start."""
+        start = start or datetime.date.today()
+        return self._query_schedule('s.airDate >= ?', (start.isoformat(),),
+                                    group_by='s.seriesId')
+
+    def search(self, text: str, limit: int = SEARCH_LIMIT):
+        """Search the local library for series and episodes matching text.
+
+        Returns a list of dicts with seriesId, episodeId (None for a series
+        match), seriesName, episodeName and rank, best matches first.
+        """
+        words = [word.replace('"', '""') for word in text.split()]
+        if not words:
+            return []
+        if self.search_name not in self._known_tables:
+            with self.transaction():
+                if self._create_search_index():
+                    self._fill_search_index()
+        columns = 'seriesId, rowid, seriesName, episodeName'
+        if self._search_uses_fts:
+            # Every word has to match, the last one may be partially typed.
+            match = ' '.join(f'"{word}"' for word in words) + '*'
+            weights = ', '.join(str(weight) for weight in SEARCH_WEIGHTS)
+            query = (f'SELECT {columns}, bm25("{self.search_name}", {weights}) AS rank '
+                     f'FROM "{self.search_name}" WHERE "{self.search_name}" MATCH ? '
+                     'ORDER BY rank LIMIT ?')
+            params = (match, limit)
+        else:
+            matches = ' AND '.join(['(seriesName LIKE ? OR episodeName LIKE ? OR overview LIKE ?)']
+                                   * len(words))
+            query = (f"SELECT {columns}, episodeName IS NOT NULL AS rank "
+                     f"FROM '{self.search_name}' WHERE {matches} ORDER BY rank LIMIT ?")
+            params = tuple(f'%{word}%' for word in words for _ in range(3)) + (limit,)
+        results = []
+        for series_id, rowid, series_name, episode_name, rank in self.cursor.execute(query,
+                                                                                      params):
+            results.append({
+                'seriesId': series_id,
+                'episodeId': rowid if rowid > 0 else None,
+                'seriesName': series_name,
+                'episodeName': episode_name,
+                'rank': rank,
+            })
+        logger.debug('Found %s local results for "%s"', len(results), text)
+        return results
+
+    def iter_rows(self, table_name: str, columns: tuple = None, where: str = None,
+                  params: tuple = (), order_by: str = None, limit: int = None,
+                  row_type: str = ROW_DICT, batch_size: int = FETCH_BATCH_SIZE):
+        """Lazily yield the rows of a table.
+
+        columns limits the selected columns, where is an SQL expression using
+        '?' placeholders bound from params.  Rows are fetched batch_size at a
+        time and yielded as dicts, sqlite3.Row objects or plain tuples
+        depending on row_type.
+        """
+        if row_type not in (ROW_DICT, ROW_SQLITE, ROW_TUPLE):
+            raise ValueError(f'Unknown row_type: {row_type}')
+        selected = ', '.join(columns) if columns else '*'
+        query = f"SELECT {selected} FROM '{table_name}'"
+        params = tuple(params)
+        if where:
+            query += f' WHERE {where}'
+        if order_by:
+            query += f' ORDER BY {order_by}'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params += (limit,)
+        # Use a dedicated cursor so other queries can run while this one is consumed.
+        cursor = self.conn.cursor()
+        if row_type == ROW_SQLITE:
+            cursor.row_factory = sqlite3.Row
+        # Only the time spent in sqlite is measured, not the consumer's.
+        elapsed = 0.0
+        row_count = 0
+        try:
+            start = time.perf_counter()
+            cursor.execute(query, params)
+            column_names = [x[0] for x in cursor.description]
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                elapsed += time.perf_counter() - start
+                if not rows:
+                    break
+                row_count += len(rows)
+                if row_type == ROW_DICT:
+                    rows = [dict(zip(column_names, row)) for row in rows]
+                yield from rows
+                start = time.perf_counter()
+        finally:
+            cursor.close()
+            metrics.observe('db.iter_rows', elapsed)
+            metrics.count('db.rows_read', row_count)
+
+    def _select_from_table(self, table_name: str, where: str = None, params: tuple = (),
+                           order_by: str = None):
+        """Select all entries from a table, its time is recorded under db.iter_rows."""
+        rows_values = list(self.iter_rows(table_name, where=where, params=params,
+                                          order_by=order_by))
         logger.debug('Selected %s rows from table %s', len(rows_values), table_name)
         return rows_values
 
-    def get_library(self):
+    def iter_library(self, columns: tuple = None, row_type: str = ROW_DICT):
+        """Lazily yield the series in the library."""
+        return self.iter_rows(self.library_name, columns, row_type=row_type)
+
+    def get_library(self, columns: tuple = None, row_type: str = ROW_DICT):
         """return a list of series dicts for shows in the library."""
-        return self._select_from_table(self.library_name)
+        return list(self.iter_library(columns, row_type))
+
+    def iter_episodes(self, series_id, columns: tuple = None, row_type: str = ROW_DICT):
+        """Lazily yield the episodes of the requested series."""
+        if self.schema == SCHEMA_NORMALIZED:
+            # Match the per-series tables, which are ordered by their id key.
+            return self.iter_rows(self.episodes_name, columns, 'seriesId = ?', (series_id,),
+                                  order_by='id', row_type=row_type)
+        return self.iter_rows(series_id, columns, row_type=row_type)
 
-    def get_episodes(self, series_id):
+    def get_episodes(self, series_id, columns: tuple = None, row_type: str = ROW_DICT):
         """Return a list of episode dicts for the requested series."""
-        return self._select_from_table(series_id)
+        return list(self.iter_episodes(series_id, columns, row_type))
+
+    def migrate_to_normalized(self):
+        """Move every per-series episode table into the single episodes table.
+
+        Tables left behind by an earlier switch to the normalized schema are
+        migrated as well, and an episodes table keyed by season and episode
+        numbers is rebuilt keyed by the episode id.  Returns the number of
+        series tables that were migrated.
+        """
+        series_tables = self._series_tables()
+        rekey = self._table_exists(self.episodes_name) and not self._episodes_keyed_by_id()
+        if (not series_tables and not rekey
+                and self.get_state(SCHEMA_KEY) == SCHEMA_NORMALIZED):
+            return 0
+        migrated = 0
+        with self.transaction():
+            self._schema = SCHEMA_NORMALIZED
+            self._schema_checked = True
+            if rekey:
+                self._rekey_episodes_table()
+            episodes_table = self._create_episodes_table(None)
+            columns = ', '.join(column.name for column in episodes_table.columns)
+            for series_id in series_tables:
+                self.cursor.execute(f"INSERT OR REPLACE INTO '{self.episodes_name}' ({columns}) "
+                                    f"SELECT {columns} FROM '{series_id}'")
+                self.cursor.execute(f"DROP TABLE '{series_id}'")
+                self._known_tables.discard(str(series_id))
+                migrated += 1
+        logger.info('Migrated %s series tables into table %s', migrated, self.episodes_name)
+        return migrated
+
+    def _episodes_keyed_by_id(self) -> bool:
+        """Check if the episodes table uses the episode id as its primary key."""
+        columns = self.cursor.execute(f"PRAGMA table_info('{self.episodes_name}')").fetchall()
+        # table_info rows are (cid, name, type, notnull, default, pk).
+        return [column[1] for column in columns if column[5]] == ['id']
+
+    def _rekey_episodes_table(self):
+        """Rebuild an episodes table keyed by its numbering into one keyed by id."""
+        old_name = f'{self.episodes_name}_old'
+        self.cursor.execute(f"ALTER TABLE '{self.episodes_name}' RENAME TO '{old_name}'")
+        for index in ('episodes_id', 'episodes_firstAired'):
+            self.cursor.execute(f"DROP INDEX IF EXISTS '{index}'")
+        self._known_tables.discard(self.episodes_name)
+        episodes_table = self._create_episodes_table(None)
+        columns = ', '.join(column.name for column in episodes_table.columns)
+        self.cursor.execute(f"INSERT OR REPLACE INTO '{self.episodes_name}' ({columns}) "
+                            f"SELECT {columns} FROM '{old_name}'")
+        self.cursor.execute(f"DROP TABLE '{old_name}'")
+        logger.info('Rebuilt table %s keyed by the episode id', self.episodes_name)
+
+    def export_snapshot(self, file_path, batch_size: int = SNAPSHOT_BATCH_SIZE):
+        """Write the library, its episodes and the sync state to a snapshot file.
+
+        Rows are streamed from sqlite into the file, see util.snapshot for
+        the format.  The file only replaces file_path once it is complete.
+        Returns the number of series and episodes written.
+        """
+        library_columns = [column.name for column in tables.LIBRARY_COLUMNS]
+        episode_columns = [column.name for column in tables.SHOW_COLUMNS]
+        counts = {'series': 0, 'episodes': 0}
+        # The read transaction keeps the snapshot consistent while other connections write.
+        with metrics.timer('db.export_snapshot'), self.transaction(), \
+                snapshot.SnapshotWriter(file_path) as writer:
+            writer.write(snapshot.HEADER, {
+                'version': snapshot.FORMAT_VERSION,
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'schema': self.schema,
+                'library_columns': library_columns,
+                'episode_columns': episode_columns,
+            })
+            existing_tables = set(self.existing_tables)
+            if self.library_name in existing_tables:
+                for row in self.iter_library(library_columns, ROW_TUPLE):
+                    writer.write(snapshot.SERIES, row)
+                    counts['series'] += 1
+                    if not self.episode_table_exists(row[0], existing_tables):
+                        continue
+                    rows = []
+                    for episode in self.iter_episodes(row[0], episode_columns, ROW_TUPLE):
+                        rows.append(episode)
+                        if len(rows) >= batch_size:
+                            writer.write(snapshot.EPISODES, (row[0], rows))
+                            counts['episodes'] += len(rows)
+                            rows = []
+                    if rows:
+                        writer.write(snapshot.EPISODES, (row[0], rows))
+                        counts['episodes'] += len(rows)
+            if self.state_name in existing_tables:
+                for key, value in self.iter_rows(self.state_name, row_type=ROW_TUPLE):
+                    # The importing database keeps its own schema.
+                    if key != SCHEMA_KEY:
+                        writer.write(snapshot.STATE, (key, value))
+            writer.write(snapshot.END, counts)
+        logger.info('Exported %s series and %s episodes to %s', counts['series'],
+                    counts['episodes'], file_path)
+        return counts
+
+    def import_snapshot(self, file_path, batch_size: int = SNAPSHOT_BATCH_SIZE):
+        """Bulk load a snapshot written by export_snapshot into the database.
+
+        Everything is loaded in one transaction with batched executemany
+        calls, series already in the library are replaced, then the search
+        index and schedule are rebuilt.  A truncated or corrupt file raises
+        snapshot.SnapshotError and leaves the database untouched.  Returns
+        the number of series and episodes loaded.
+        """
+        with metrics.timer('db.import_snapshot'), snapshot.SnapshotReader(file_path) as reader, \
+                self.transaction():
+            records = iter(reader)
+            kind, header = next(records)
+            try:
+                if kind != snapshot.HEADER:
+                    raise snapshot.SnapshotError(f'{file_path} does not start with a header')
+                counts = self._load_snapshot(header, records, batch_size)
+            except snapshot.SnapshotError:
+                raise
+            except (KeyError, IndexError, TypeError, ValueError, sqlite3.IntegrityError,
+                    sqlite3.InterfaceError) as error:
+                raise snapshot.SnapshotError(f'{file_path} has a malformed record: '
+                                             f'{error!r}') from error
+            self.rebuild_search_index()
+            self.rebuild_schedule()
+        logger.info('Imported %s series and %s episodes from %s', counts['series'],
+                    counts['episodes'], file_path)
+        return counts
+
+    def _load_snapshot(self, header: dict, records, batch_size: int):
+        """Write the records following a snapshot header, see import_snapshot."""
+        counts = {'series': 0, 'episodes': 0}
+        pending = {}
+        pending_rows = 0
+
+        def flush():
+            for insert_string, rows in pending.values():
+                self.cursor.executemany(insert_string, rows)
+            pending.clear()
+
+        library_table = self.create_table(self.library_name, tables.LIBRARY_COLUMNS)
+        library_row = _column_mapper(header['library_columns'], tables.LIBRARY_COLUMNS)
+        episode_row = _column_mapper(header['episode_columns'], tables.SHOW_COLUMNS)
+        existing = {series_id for series_id, in self.iter_library(('seriesId',), ROW_TUPLE)}
+        totals = None
+        for kind, payload in records:
+            if kind == snapshot.SERIES:
+                row = library_row(payload)
+                if row[0] in existing:
+                    flush()
+                    pending_rows = 0
+                    self.remove_series(row[0])
+                pending.setdefault(self.library_name, (library_table.insert_string, []))
+                pending[self.library_name][1].append(row)
+                counts['series'] += 1
+                pending_rows += 1
+            elif kind == snapshot.EPISODES:
+                series_id, rows = payload
+                table = self._create_episodes_table(series_id)
+                pending.setdefault(table.table_name, (table.insert_string, []))
+                pending[table.table_name][1].extend(episode_row(row) for row in rows)
+                counts['episodes'] += len(rows)
+                pending_rows += len(rows)
+            elif kind == snapshot.STATE:
+                self.set_state(*payload)
+            elif kind == snapshot.END:
+                totals = payload
+            if pending_rows >= batch_size:
+                flush()
+                pending_rows = 0
+        flush()
+        if totals != counts:
+            raise snapshot.SnapshotError(f'The snapshot holds {counts}, expected {totals}')
+        return counts
+
+    def get_state(self, key: str, default=None):
+        """Return a value saved with set_state."""
+        if not self._table_exists(self.state_name):
+            return default
+        query = f"SELECT value FROM '{self.state_name}' WHERE key = ?"
+        row = self.cursor.execute(query, (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key: str, value):
+        """Save a value, like the time of the last sync, in the database."""
+        table = self.create_table(self.state_name, tables.STATE_COLUMNS)
+        self.cursor.execute(table.insert_string, (key, value))
+
+
+def _column_mapper(snapshot_columns, columns):
+    """Return a function ordering snapshot rows like columns, missing values become None."""
+    names = [column.name for column in columns]
+    if list(snapshot_columns) == names:
+        return tuple
+    positions = {name: position for position, name in enumerate(snapshot_columns)}
+    indexes = [positions.get(name) for name in names]
+    return lambda row: tuple(None if index is None else row[index] for index in indexes)
@@ -0,0 +1,201 @@
+"""Contains a persistent on-disk cache for HTTP responses.
+
+Responses are stored in an sqlite file in the settings folder, keyed by URL.
+"""
+
+import logging
+import threading
+import time
+
+from scotchbutter.util import database, environment
+
+CACHE_FILENAME = 'http_cache.sqlite'
+# Responses older than this are revalidated before being used.
+DEFAULT_TTL = 24 * 60 * 60
+# Least recently used responses are evicted once the cache grows past this.
+MAX_CACHE_BYTES = 128 * 1024 * 1024
+# Seconds between writes of the last access time of a response, which only
+# needs to be rough for the LRU eviction.
+ACCESS_UPDATE_INTERVAL = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse():
+    """Container for a response stored in the cache."""
+
+    def __init__(self, url, body, etag, last_modified, stored_at):
+        """Create a cached response container."""
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.stored_at = stored_at
+
+    @property
+    def age(self):
+        """Seconds since the response was fetched or last revalidated."""
+        return time.time() - self.stored_at
+
+    @property
+    def validators(self):
+        """Headers used to revalidate the response with the server."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache():
+    """Stores HTTP response bodies on disk with TTL and LRU eviction."""
+
+    table_name = 'responses'
+
+    def __init__(self, cache_file: str = CACHE_FILENAME, default_ttl: int = DEFAULT_TTL,
+                 max_bytes: int = MAX_CACHE_BYTES,
+                 profile: database.ConnectionProfile = database.DEFAULT_PROFILE):
+        """Open (or create) the response cache.
+
+        profile holds the pragmas of the connection, by default the WAL
+        profile of the library database so lookups don't wait on fsyncs.
+        """
+        self._settings_path = environment.get_settings_path()
+        self._cache_file = self._settings_path.joinpath(cache_file)
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evicted = 0
+        self._lock = threading.Lock()
+        # The connection is shared between threads, access is serialized by _lock.
+        self._conn = profile.connect(str(self._cache_file), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute(
+            f"CREATE TABLE IF NOT EXISTS '{self.table_name}' ("
+            'url TEXT PRIMARY KEY, body BLOB NOT NULL, etag TEXT, last_modified TEXT, '
+            'stored_at REAL NOT NULL, last_access REAL NOT NULL, size INTEGER NOT NULL)')
+        self._conn.execute(
+            f"CREATE INDEX IF NOT EXISTS '{self.table_name}_last_access' "
+            f"ON '{self.table_name}' (last_access)")
+        query = f"SELECT COALESCE(SUM(size), 0) FROM '{self.table_name}'"
+        self._total_bytes = self._conn.execute(query).fetchone()[0]
+        logger.info('Using HTTP cache located at %s', self._cache_file)
+
+    def lookup(self, url: str, ttl: int = None):
+        """Find a cached response for url.
+
+        Returns a tuple of (response, fresh).  A stale response is still
+        returned so its validators can be used for a conditional request.
+        The access time is only written once it is ACCESS_UPDATE_INTERVAL old.
+        """
+        ttl = self.default_ttl if ttl is None else ttl
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body, etag, last_modified, stored_at, last_access "
+                f"FROM '{self.table_name}' WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None, False
+            if now - row[-1] >= ACCESS_UPDATE_INTERVAL:
+                self._conn.execute(
+                    f"UPDATE '{self.table_name}' SET last_access = ? WHERE url = ?", (now, url))
+        response = CachedResponse(url, *row[:-1])
+        fresh = response.age < ttl
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return response, fresh
+
+    def store(self, url: str, body: bytes, etag: str = None, last_modified: str = None):
+        """Add or replace the cached response for url."""
+        now = time.time()
+        size = len(body)
+        with self._lock:
+            row = self._conn.execute(f"SELECT size FROM '{self.table_name}' WHERE url = ?",
+                                     (url,)).fetchone()
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO '{self.table_name}' "
+                '(url, body, etag, last_modified, stored_at, last_access, size) '
+                'VALUES(?,?,?,?,?,?,?)', (url, body, etag, last_modified, now, now, size))
+            self._total_bytes += size - (row[0] if row else 0)
+            self._evict()
+
+    def revalidate(self, url: str):
+        """Mark a stale response as fresh after the server confirmed it is unchanged."""
+        with self._lock:
+            self._conn.execute(f"UPDATE '{self.table_name}' SET stored_at = ? WHERE url = ?",
+                               (time.time(), url))
+            self.revalidated += 1
+
+    @staticmethod
+    def _nested(url: str):
+        """Return the WHERE clause and parameters matching url and the URLs nested under it."""
+        return 'url = ? OR substr(url, 1, ?) IN (?, ?)', (url, len(url) + 1, f'{url}/', f'{url}?')
+
+    def invalidate(self, url: str):
+        """Remove the cached response for url and any URL nested under it."""
+        where, params = self._nested(url)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT url, size FROM '{self.table_name}' WHERE {where}", params).fetchall()
+            for cached_url, size in rows:
+                self._conn.execute(f"DELETE FROM '{self.table_name}' WHERE url = ?",
+                                   (cached_url,))
+                self._total_bytes -= size
+
+    def expire(self, url: str):
+        """Mark the responses of url and the URLs nested under it as stale.
+
+        Unlike invalidate the responses are kept, so their validators still
+        turn the next request into a conditional one.
+        """
+        where, params = self._nested(url)
+        with self._lock:
+            self._conn.execute(f"UPDATE '{self.table_name}' SET stored_at = 0 WHERE {where}",
+                               params)
+
+    def _evict(self):
+        """Remove least recently used responses until the cache fits max_bytes."""
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                f"SELECT url, size FROM '{self.table_name}' ORDER BY last_access LIMIT 32"
+            ).fetchall()
+            if not rows:
+                self._total_bytes = 0
+                break
+            for url, size in rows:
+                self._conn.execute(f"DELETE FROM '{self.table_name}' WHERE url = ?", (url,))
+                self._total_bytes -= size
+                self.evicted += 1
+                if self._total_bytes <= self.max_bytes:
+                    break
+            logger.debug('Evicted responses from the HTTP cache, %s bytes remain',
+                         self._total_bytes)
+
+    def clear(self):
+        """Remove every cached response."""
+        with self._lock:
+            self._conn.execute(f"DELETE FROM '{self.table_name}'")
+            self._total_bytes = 0
+
+    @property
+    def stats(self):
+        """Return the cache counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidated': self.revalidated,
+            'evicted': self.evicted,
+            'bytes': self._total_bytes,
+        }
+
+    def close(self):
+        """Close the cache database."""
+        with self._lock:
+            self._conn.close()
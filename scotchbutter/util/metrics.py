@@ -0,0 +1,191 @@
+"""Contains counters and timing histograms for the network and database hot paths.
+
+Instrumented code records into the module level REGISTRY:
+
+    with metrics.timer('tvdb.get'):
+        ...
+    metrics.count('tvdb.cache_hits')
+
+The registry can be exported as JSON, as Prometheus text or printed as a
+summary table, see show_runner --profile.
+"""
+
+import bisect
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds, in seconds, of the timer histogram buckets.
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                1.0, 2.5, 5.0, 10.0, 30.0)
+PROMETHEUS_PREFIX = 'scotchbutter_'
+
+
+class Histogram():
+    """Distribution of observed values over fixed buckets."""
+
+    def __init__(self, buckets: tuple = TIME_BUCKETS, unit: str = 'seconds'):
+        """Create an empty histogram, values above the last bucket go to +Inf."""
+        self.buckets = tuple(buckets)
+        self.unit = unit
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value: float):
+        """Record a value."""
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    @property
+    def mean(self):
+        """Mean of the observed values."""
+        return self.total / self.count if self.count else 0.0
+
+    def quantile(self, q: float):
+        """Estimate a quantile from the buckets, interpolating inside the bucket."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[index - 1] if index else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / bucket_count
+                return min(max(estimate, self.min), self.max)
+            seen += bucket_count
+        return self.max
+
+    def as_dict(self):
+        """Return the histogram as plain data."""
+        return {
+            'unit': self.unit,
+            'count': self.count,
+            'sum': self.total,
+            'min': self.min,
+            'max': self.max,
+            'mean': self.mean,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'],
+                                self.bucket_counts)),
+        }
+
+
+class MetricsRegistry():
+    """Thread safe collection of named counters and histograms."""
+
+    def __init__(self):
+        """Create an empty registry."""
+        self._lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def count(self, name: str, value: int = 1):
+        """Add value to the counter name."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name: str, value: float, unit: str = 'seconds'):
+        """Record value in the histogram name."""
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(unit=unit)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name: str):
+        """Time the enclosed block into the histogram name, errors included."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        """Drop every counter and histogram."""
+        with self._lock:
+            self.counters = {}
+            self.histograms = {}
+
+    def snapshot(self):
+        """Return all metrics as plain data."""
+        with self._lock:
+            return {
+                'counters': dict(sorted(self.counters.items())),
+                'histograms': {name: histogram.as_dict()
+                               for name, histogram in sorted(self.histograms.items())},
+            }
+
+    def to_json(self, **kwargs) -> str:
+        """Export the metrics as a JSON document."""
+        return json.dumps(self.snapshot(), **kwargs)
+
+    def to_prometheus(self, prefix: str = PROMETHEUS_PREFIX) -> str:
+        """Export the metrics in the Prometheus text exposition format."""
+        lines = []
+        snapshot = self.snapshot()
+        for name, value in snapshot['counters'].items():
+            metric = f'{prefix}{_metric_name(name)}_total'
+            lines.append(f'# TYPE {metric} counter')
+            lines.append(f'{metric} {value}')
+        for name, histogram in snapshot['histograms'].items():
+            metric = f'{prefix}{_metric_name(name)}'
+            if histogram['unit']:
+                metric += f"_{histogram['unit']}"
+            lines.append(f'# TYPE {metric} histogram')
+            cumulative = 0
+            for bound, bucket_count in histogram['buckets'].items():
+                cumulative += bucket_count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {cumulative}')
+            lines.append(f"{metric}_sum {histogram['sum']}")
+            lines.append(f"{metric}_count {histogram['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> str:
+        """Format the metrics as a table for people."""
+        snapshot = self.snapshot()
+        lines = [f"{'timer':<24}{'count':>8}{'total s':>10}{'mean ms':>10}"
+                 f"{'p50 ms':>10}{'p95 ms':>10}{'max ms':>10}"]
+        for name, histogram in snapshot['histograms'].items():
+            lines.append(f"{name:<24}{histogram['count']:>8}{histogram['sum']:>10.3f}"
+                         f"{histogram['mean'] * 1000:>10.2f}{histogram['p50'] * 1000:>10.2f}"
+                         f"{histogram['p95'] * 1000:>10.2f}{histogram['max'] * 1000:>10.2f}")
+        if snapshot['counters']:
+            lines.append('')
+            lines.append(f"{'counter':<24}{'value':>8}")
+            for name, value in snapshot['counters'].items():
+                lines.append(f'{name:<24}{value:>8}')
+        return '\n'.join(lines)
+
+
+def _metric_name(name: str) -> str:
+    """Turn a dotted metric name into a valid Prometheus name."""
+    return ''.join(char if char.isalnum() else '_' for char in name)
+
+
+# The registry used by the instrumented modules.
+REGISTRY = MetricsRegistry()
+
+
+def count(name: str, value: int = 1):
+    """Add value to a counter of the default registry."""
+    REGISTRY.count(name, value)
+
+
+def observe(name: str, value: float, unit: str = 'seconds'):
+    """Record a value in a histogram of the default registry."""
+    REGISTRY.observe(name, value, unit)
+
+
+def timer(name: str):
+    """Time a block into a histogram of the default registry."""
+    return REGISTRY.timer(name)
@@ -0,0 +1,174 @@
+"""Contains the request pacing and retry policies used for TVDB calls."""
+
+import email.utils
+import logging
+import random
+import threading
+import time
+
+# Requests per second the limiter starts with, and the range it adapts in.
+DEFAULT_RATE = 20.0
+MIN_RATE = 0.5
+MAX_RATE = 50.0
+# Statuses that mean "slow down" as opposed to a plain server error.
+THROTTLE_STATUSES = frozenset((429, 503))
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+
+logger = logging.getLogger(__name__)
+
+
+def parse_retry_after(value: str):
+    """Convert a Retry-After header (seconds or an HTTP date) into seconds."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class RateLimiter():
+    """Token bucket shared by every request, adapting its rate to the server.
+
+    Each successful response raises the rate by increase requests/s up to
+    max_rate, and each throttled response multiplies it by decrease down to
+    min_rate.  The rate therefore settles just under the server's limit.
+    A Retry-After from the server pauses the bucket for that long.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, burst: int = 10,
+                 min_rate: float = MIN_RATE, max_rate: float = MAX_RATE,
+                 increase: float = 0.1, decrease: float = 0.5):
+        """Create a full bucket."""
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.waited_seconds = 0.0
+
+    def reserve(self) -> float:
+        """Claim a slot for a request, returns the seconds to wait before sending it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Claim a token now, a negative balance is paid back by waiting.
+            self._tokens -= 1
+            wait = max(self._paused_until - now, -self._tokens / self.rate, 0.0)
+            self.requests += 1
+            self.waited_seconds += wait
+        return wait
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until a request may be sent."""
+        import asyncio  # Deferred, asyncio is slow to import and only async callers need it.
+        wait = self.reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def on_success(self):
+        """Grow the rate after a request went through."""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after: float = None):
+        """Back off after the server asked us to slow down."""
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.throttled += 1
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        logger.debug('Throttled by the server, rate lowered to %.2f requests/s', self.rate)
+
+    @property
+    def metrics(self):
+        """Return the limiter counters."""
+        with self._lock:
+            return {
+                'rate': round(self.rate, 3),
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'waited_seconds': round(self.waited_seconds, 3),
+            }
+
+
+class RetryPolicy():
+    """Decides whether and when a failed request is retried.
+
+    Each request is retried up to max_retries times with exponential
+    backoff and jitter, capped at max_backoff, unless the server sent a
+    Retry-After.  budget caps the retries across all requests (None for no
+    cap), so a failing server can't stall a whole run.
+    """
+
+    def __init__(self, max_retries: int = 5, backoff: float = 0.5, max_backoff: float = 60.0,
+                 budget: int = None):
+        """Create a retry policy."""
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget
+        self._lock = threading.Lock()
+        self.retries = 0
+        self.backoff_seconds = 0.0
+
+    def allow(self, attempt: int) -> bool:
+        """Check if another retry is allowed after attempt failures, and claim it."""
+        with self._lock:
+            if attempt >= self.max_retries:
+                return False
+            if self.budget is not None and self.retries >= self.budget:
+                logger.warning('Retry budget of %s exhausted', self.budget)
+                return False
+            self.retries += 1
+            return True
+
+    def delay(self, attempt: int, retry_after: float = None) -> float:
+        """Return how long to wait before retry number attempt + 1."""
+        if retry_after is not None:
+            return min(retry_after, self.max_backoff)
+        delay = self.backoff * (2 ** attempt)
+        return min(self.max_backoff, delay * random.uniform(0.5, 1.0))
+
+    def _next_delay(self, attempt: int, retry_after: float = None) -> float:
+        """Return and record the delay before the next retry."""
+        delay = self.delay(attempt, retry_after)
+        with self._lock:
+            self.backoff_seconds += delay
+        return delay
+
+    def wait(self, attempt: int, retry_after: float = None):
+        """Sleep before the next retry."""
+        time.sleep(self._next_delay(attempt, retry_after))
+
+    async def wait_async(self, attempt: int, retry_after: float = None):
+        """Wait before the next retry without blocking the event loop."""
+        import asyncio  # See RateLimiter.acquire_async.
+        await asyncio.sleep(self._next_delay(attempt, retry_after))
+
+    @property
+    def metrics(self):
+        """Return the retry counters."""
+        with self._lock:
+            return {
+                'retries': self.retries,
+                'backoff_seconds': round(self.backoff_seconds, 3),
+            }
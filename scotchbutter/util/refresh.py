@@ -0,0 +1,235 @@
+"""Contains functions to refresh library series from TVDB in bulk."""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from scotchbutter.util import database
+
+# Series fetched from TVDB at once.  Each one may also fetch its episode
+# pages concurrently, see tvdb.PAGE_WORKERS.
+REFRESH_WORKERS = 8
+# Series fetched but not yet handed to a batch, per worker.  Caps memory use
+# to a few series no matter how large the library is.
+PENDING_PER_WORKER = 2
+# Series written per database transaction.
+BATCH_SIZE = 25
+# sync_state key holding the epoch time of the last successful sync.
+LAST_SYNC_KEY = 'last_sync'
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshStats():
+    """Counters describing a library refresh."""
+
+    def __init__(self):
+        """Create an empty set of counters."""
+        self.series = 0
+        self.episodes = 0
+        self.failed = []
+        self.elapsed = 0.0
+
+    @property
+    def series_per_second(self):
+        """Series refreshed per second."""
+        return self.series / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def episodes_per_second(self):
+        """Episodes refreshed per second."""
+        return self.episodes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        return (f'Refreshed {self.series} series ({self.episodes} episodes) '
+                f'in {self.elapsed:.2f}s -- {self.series_per_second:.2f} series/s, '
+                f'{self.episodes_per_second:.2f} episodes/s, {len(self.failed)} failed')
+
+
+def fetch_series(tvdb_api, series_id: int):
+    """Fetch a series and all of its episodes from TVDB.
+
+    Cached responses of the series are revalidated, so a refresh never
+    writes data older than the request.
+    """
+    tvdb_api.expire_series(series_id)
+    series = tvdb_api.get_series(series_id)
+    # Touch the episodes so they are downloaded in the worker thread.
+    series.episodes
+    return series
+
+
+def expire_series(tvdb_api, series_ids):
+    """Make the next queries of every series revalidate their cached responses."""
+    for series_id in series_ids:
+        tvdb_api.expire_series(series_id)
+
+
+def library_series_ids(db) -> list:
+    """Return the seriesId of every series in the library."""
+    if db.library_name not in db.existing_tables:
+        return []
+    rows = db.iter_library(columns=('seriesId',), row_type=database.ROW_TUPLE)
+    return [series_id for series_id, in rows]
+
+
+def changed_episodes(series, since: int) -> list:
+    """Return the episodes of series updated on TVDB at or after since."""
+    episodes = []
+    for episode in series.episodes:
+        try:
+            last_updated = episode['lastUpdated']
+        except KeyError:
+            last_updated = None
+        if last_updated is None or last_updated >= since:
+            episodes.append(episode)
+    return episodes
+
+
+def write_batch(db, batch: list, stats: RefreshStats = None):
+    """Write a batch of (series, episodes) pairs in one transaction and empty it.
+
+    When the transaction fails each series is retried in its own, so one
+    bad series doesn't lose the rest of the batch.  Written and failed
+    series are counted in stats.
+    """
+    if not batch:
+        return
+    stats = RefreshStats() if stats is None else stats
+    try:
+        with db.transaction():
+            for series, episodes in batch:
+                db.add_series(series, episodes)
+    except Exception as error:
+        if len(batch) == 1:
+            logger.warning('Failed to write seriesId %s: %s', batch[0][0].series_id, error)
+            stats.failed.append(batch[0][0].series_id)
+        else:
+            logger.warning('Failed to write %s series, writing them one by one: %s',
+                           len(batch), error)
+            for item in batch:
+                write_batch(db, [item], stats)
+    else:
+        stats.series += len(batch)
+        stats.episodes += sum(len(series.episodes if episodes is None else episodes)
+                              for series, episodes in batch)
+    batch.clear()
+
+
+def refresh_library(db, tvdb_api, series_ids: list = None, workers: int = REFRESH_WORKERS,
+                    batch_size: int = BATCH_SIZE, since: int = None) -> RefreshStats:
+    """Refresh series in the library from TVDB.
+
+    Series are fetched by a pool of workers while all writes happen on the
+    calling thread's connection, batch_size series per transaction.  When
+    series_ids is None the whole library is refreshed.  When since is set
+    only episodes updated on TVDB since that epoch time are written.
+    Only workers * PENDING_PER_WORKER series are fetched ahead of the
+    writes, so memory use does not grow with the library.
+    """
+    if series_ids is None:
+        series_ids = library_series_ids(db)
+    workers = max(1, workers)
+    max_pending = workers * PENDING_PER_WORKER
+    stats = RefreshStats()
+    start = time.perf_counter()
+    batch = []
+    remaining = iter(series_ids)
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            for series_id in remaining:
+                futures[executor.submit(fetch_series, tvdb_api, series_id)] = series_id
+                if len(futures) >= max_pending:
+                    break
+            if not futures:
+                break
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                series_id = futures.pop(future)
+                try:
+                    series = future.result()
+                    # None writes every episode and prunes those TVDB no longer lists.
+                    episodes = None if since is None else changed_episodes(series, since)
+                except Exception as error:
+                    logger.warning('Failed to refresh seriesId %s: %s', series_id, error)
+                    stats.failed.append(series_id)
+                    continue
+                batch.append((series, episodes))
+                if len(batch) >= batch_size:
+                    write_batch(db, batch, stats)
+    write_batch(db, batch, stats)
+    stats.elapsed = time.perf_counter() - start
+    logger.info('%s', stats)
+    return stats
+
+
+def sync_library(db, tvdb_api, workers: int = REFRESH_WORKERS,
+                 batch_size: int = BATCH_SIZE) -> RefreshStats:
+    """Refresh only the library series that changed on TVDB since the last sync.
+
+    The first sync of a library refreshes every series.
+    """
+    sync_time = int(time.time())
+    last_sync = db.get_state(LAST_SYNC_KEY)
+    if last_sync is None:
+        logger.info('No previous sync found, refreshing the whole library')
+        stats = refresh_library(db, tvdb_api, workers=workers, batch_size=batch_size)
+    else:
+        last_sync = int(last_sync)
+        library_ids = set(library_series_ids(db))
+        updated = tvdb_api.get_updated(last_sync, sync_time)
+        changed = sorted(library_ids.intersection(updated))
+        logger.info('%s of %s library series changed since %s', len(changed),
+                    len(library_ids), last_sync)
+        stats = refresh_library(db, tvdb_api, changed, workers=workers,
+                                batch_size=batch_size, since=last_sync)
+    if not stats.failed:
+        # Failed series are picked up again by the next sync.
+        with db.transaction():
+            db.set_state(LAST_SYNC_KEY, sync_time)
+    return stats
+
+
+async def refresh_library_async(db, tvdb_api, series_ids: list = None,
+                                workers: int = REFRESH_WORKERS, batch_size: int = BATCH_SIZE,
+                                since: int = None) -> RefreshStats:
+    """Refresh series in the library with a tvdb_async.AsyncTvdbApi.
+
+    Like refresh_library only workers * PENDING_PER_WORKER series are
+    fetched ahead of the writes.  The database work runs on a single
+    writer thread, so the event loop keeps fetching while a batch is
+    written, see refresh_library for series_ids, batch_size and since.
+    """
+    import asyncio  # Deferred, asyncio is slow to import and only async callers need it.
+    loop = asyncio.get_running_loop()
+    stats = RefreshStats()
+    start = time.perf_counter()
+    batch = []
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        def run(func, *args):
+            return loop.run_in_executor(writer, func, *args)
+
+        # sqlite connections stay on the thread that opened them, so the
+        # connection is reopened on the writer thread for the refresh.
+        db.close()
+        try:
+            if series_ids is None:
+                series_ids = await run(library_series_ids, db)
+            await run(expire_series, tvdb_api, series_ids)
+            async for series_id, series in tvdb_api.get_many_series(
+                    series_ids, max_pending=max(1, workers) * PENDING_PER_WORKER):
+                if isinstance(series, Exception):
+                    logger.warning('Failed to refresh seriesId %s: %s', series_id, series)
+                    stats.failed.append(series_id)
+                    continue
+                episodes = None if since is None else changed_episodes(series, since)
+                batch.append((series, episodes))
+                if len(batch) >= batch_size:
+                    await run(write_batch, db, batch, stats)
+            await run(write_batch, db, batch, stats)
+        finally:
+            await run(db.close)
+    stats.elapsed = time.perf_counter() - start
+    logger.info('%s', stats)
+    return stats
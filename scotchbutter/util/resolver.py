@@ -0,0 +1,251 @@
+"""Contains the batch resolver that turns raw series titles into TVDB SeriesIds.
+
+Titles are normalized and deduplicated, so each distinct title is searched
+once, the searches run on a pool of workers and their results are kept in
+a persistent QueryCache.  Every title is then matched to the candidate with
+the most similar name, with a bonus when the year agrees:
+
+    resolver = Resolver()
+    for resolution in resolver.resolve(['The Office (2005)', 'the.office.us']):
+        print(resolution.as_dict())
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from difflib import SequenceMatcher
+
+from scotchbutter.util import database, environment, metrics
+from scotchbutter.util.titles import normalize_title
+
+QUERY_CACHE_FILENAME = 'resolver_cache.sqlite'
+# Cached search results older than this are searched again.
+QUERY_CACHE_TTL = 7 * 24 * 60 * 60
+RESOLVE_WORKERS = 8
+# Lowest score a candidate needs to be reported as the match.
+MATCH_THRESHOLD = 0.6
+# Added to, or taken from, the name similarity when both years are known.
+YEAR_BONUS = 0.15
+YEAR_PENALTY = 0.1
+# A trailing year, like 'Show (2005)', 'Show [2005]' or 'Show.2005'.
+TITLE_YEAR_REGEX = re.compile(r'[\s._-]*[(\[]?((?:19|20)\d{2})[)\]]?\s*$')
+# Separators of release style names, like 'The.Office.US'.
+RELEASE_SEPARATORS = re.compile(r'[._]+')
+# Fields of a search result kept in the cache.
+CANDIDATE_FIELDS = ('id', 'seriesName', 'aliases', 'firstAired', 'network', 'status')
+
+logger = logging.getLogger(__name__)
+
+
+def parse_title(title: str):
+    """Split a raw title into its normalized name and year, the year may be None."""
+    title = title.strip()
+    year = None
+    match = TITLE_YEAR_REGEX.search(title)
+    # A title that is only a year, like '1883', is a name.
+    if match and match.start() > 0:
+        year = int(match.group(1))
+        title = title[:match.start()]
+    return normalize_title(RELEASE_SEPARATORS.sub(' ', title)), year
+
+
+def candidate_year(candidate: dict):
+    """Return the year a search result first aired, None when unknown."""
+    match = database.TVDB_DATE_REGEX.match(candidate.get('firstAired') or '')
+    return int(match.group(1)) if match else None
+
+
+def score_candidate(name: str, year: int, candidate: dict) -> float:
+    """Score how well a search result matches a normalized name and year."""
+    score = 0.0
+    for candidate_name in [candidate['seriesName']] + list(candidate.get('aliases') or ()):
+        candidate_name, _ = parse_title(candidate_name)
+        score = max(score, SequenceMatcher(None, name, candidate_name).ratio())
+    aired = candidate_year(candidate)
+    if year is not None and aired is not None:
+        score += YEAR_BONUS if aired == year else -YEAR_PENALTY
+    return score
+
+
+class QueryCache():
+    """Stores search results on disk, keyed by the normalized query."""
+
+    table_name = 'queries'
+
+    def __init__(self, cache_file: str = QUERY_CACHE_FILENAME, ttl: int = QUERY_CACHE_TTL):
+        """Open (or create) the query cache."""
+        self._cache_file = environment.get_settings_path().joinpath(cache_file)
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # The connection is shared between threads, access is serialized by _lock.
+        self._conn = sqlite3.connect(str(self._cache_file), check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS '{self.table_name}' ("
+                           'query TEXT PRIMARY KEY, results TEXT NOT NULL, '
+                           'stored_at REAL NOT NULL)')
+        logger.info('Using query cache located at %s', self._cache_file)
+
+    def get(self, query: str):
+        """Return the cached results of query, None if missing or expired."""
+        with self._lock:
+            row = self._conn.execute(f"SELECT results, stored_at FROM '{self.table_name}' "
+                                     'WHERE query = ?', (query,)).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return json.loads(row[0])
+
+    def put(self, query: str, results: list):
+        """Store the results of query."""
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO '{self.table_name}' "
+                               '(query, results, stored_at) VALUES (?, ?, ?)',
+                               (query, json.dumps(results), time.time()))
+
+    def close(self):
+        """Close the cache file."""
+        with self._lock:
+            self._conn.close()
+
+
+class Resolution():
+    """The match found for a raw title."""
+
+    def __init__(self, title: str, query: str, year: int):
+        """Create an unmatched resolution."""
+        self.title = title
+        self.query = query
+        self.year = year
+        self.series_id = None
+        self.series_name = None
+        self.first_aired = None
+        self.score = 0.0
+        self.candidates = 0
+        self.error = None
+
+    @property
+    def matched(self):
+        """Check if the title was resolved to a series."""
+        return self.series_id is not None
+
+    def as_dict(self):
+        """Return the resolution as plain data, see Resolver.resolve_lines."""
+        result = {
+            'title': self.title,
+            'query': self.query,
+            'year': self.year,
+            'seriesId': self.series_id,
+            'seriesName': self.series_name,
+            'firstAired': self.first_aired,
+            'score': round(self.score, 3),
+            'candidates': self.candidates,
+        }
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+
+class Resolver():
+    """Resolves batches of raw titles to TVDB series."""
+
+    def __init__(self, tvdb_api=None, workers: int = RESOLVE_WORKERS, cache: QueryCache = None,
+                 threshold: float = MATCH_THRESHOLD):
+        """Create a resolver.
+
+        tvdb_api defaults to a new tvdb.TvdbApi and cache to a QueryCache in
+        the settings folder.  Candidates scoring below threshold are not
+        reported as matches.
+        """
+        if tvdb_api is None:
+            from scotchbutter.util import tvdb
+            tvdb_api = tvdb.TvdbApi()
+        self.tvdb_api = tvdb_api
+        self.workers = workers
+        self.cache = QueryCache() if cache is None else cache
+        self.threshold = threshold
+
+    def search(self, query: str) -> list:
+        """Return the candidates TVDB finds for query, from the cache when possible."""
+        candidates = self.cache.get(query)
+        if candidates is not None:
+            metrics.count('resolver.cache_hits')
+            return candidates
+        with metrics.timer('resolver.search'):
+            try:
+                results = self.tvdb_api.search_series_data(query)
+            except LookupError:
+                # TVDB answers searches without results with a 404.
+                results = []
+        candidates = [{field: series.get(field) for field in CANDIDATE_FIELDS}
+                      for series in results]
+        self.cache.put(query, candidates)
+        return candidates
+
+    def best_match(self, resolution: Resolution, candidates: list) -> Resolution:
+        """Fill resolution with the best scoring candidate, if it passes the threshold."""
+        resolution.candidates = len(candidates)
+        best = None
+        for candidate in candidates:
+            score = score_candidate(resolution.query, resolution.year, candidate)
+            if score > resolution.score:
+                resolution.score = score
+                best = candidate
+        if best is not None and resolution.score >= self.threshold:
+            resolution.series_id = best['id']
+            resolution.series_name = best['seriesName']
+            resolution.first_aired = best['firstAired']
+        return resolution
+
+    def resolve(self, titles):
+        """Lazily yield a Resolution for every title, in the order searches finish.
+
+        Titles that normalize to the same query share a single search.
+        Failed searches yield resolutions with error set.
+        """
+        queries = {}
+        for title in titles:
+            title = title.strip()
+            if not title:
+                continue
+            query, year = parse_title(title)
+            queries.setdefault(query, []).append(Resolution(title, query, year))
+        logger.info('Resolving %s titles with %s distinct queries',
+                    sum(len(resolutions) for resolutions in queries.values()), len(queries))
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            futures = {executor.submit(self.search, query): query
+                       for query in queries if query}
+            for resolution in queries.get('', ()):
+                resolution.error = 'Title has no searchable text'
+                yield resolution
+            for future in as_completed(futures):
+                query = futures[future]
+                try:
+                    candidates = future.result()
+                except (ConnectionError, ValueError) as error:
+                    logger.warning('Failed to search for "%s": %s', query, error)
+                    for resolution in queries[query]:
+                        resolution.error = str(error)
+                        yield resolution
+                    continue
+                for resolution in queries[query]:
+                    yield self.best_match(resolution, candidates)
+
+    def resolve_lines(self, titles):
+        """Lazily yield a JSON line for every title, see Resolution.as_dict."""
+        for resolution in self.resolve(titles):
+            yield json.dumps(resolution.as_dict())
+
+    def close(self):
+        """Close the query cache."""
+        self.cache.close()
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the query cache."""
+        self.close()
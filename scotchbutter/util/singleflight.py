@@ -0,0 +1,54 @@
+"""Contains a helper to coalesce concurrent calls for the same resource."""
+
+import threading
+
+
+class _Call():
+    """The in-flight state of a single call."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight():
+    """Runs at most one call per key at a time, sharing its outcome.
+
+    Threads asking for a key that is already being fetched wait for that
+    call to finish and get its result (or exception) instead of starting
+    their own.  Nothing is kept once the call completes.
+    """
+
+    def __init__(self):
+        """Create an empty set of in-flight calls."""
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func, *args, **kwargs):
+        """Call func(*args, **kwargs), unless a call for key is already running."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+            else:
+                self.shared += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
@@ -0,0 +1,122 @@
+"""Contains the reader and writer of the library snapshot format.
+
+A snapshot is a gzip stream starting with MAGIC and FORMAT_VERSION,
+followed by length-prefixed records: one kind byte, a big-endian uint32
+payload length and a compact JSON payload.  Records are written and read
+one at a time, so neither direction holds the whole library in memory.
+See DBInterface.export_snapshot and DBInterface.import_snapshot.
+"""
+
+import gzip
+import json
+import os
+import struct
+from pathlib import Path
+
+MAGIC = b'SBSNAP'
+FORMAT_VERSION = 1
+RECORD_HEADER = struct.Struct('>cI')
+# Record kinds.
+HEADER = b'H'     # {'version', 'created', 'library_columns', 'episode_columns'}
+SERIES = b'S'     # A library row.
+EPISODES = b'E'   # [seriesId, [episode row, ...]]
+STATE = b'T'      # [key, value] of a sync_state entry.
+END = b'Z'        # {'series', 'episodes'} counts, marks a complete snapshot.
+
+
+class SnapshotError(ValueError):
+    """Raised for files that are not complete snapshots."""
+
+
+class SnapshotWriter():
+    """Writes snapshot records to a file, which only appears once closed."""
+
+    def __init__(self, file_path: Path, compresslevel: int = 6):
+        """Start a snapshot at file_path."""
+        self.file_path = Path(file_path)
+        self._temp_path = self.file_path.with_name(f'.{self.file_path.name}.tmp')
+        self._file = gzip.open(self._temp_path, 'wb', compresslevel=compresslevel)
+        self._file.write(MAGIC + bytes([FORMAT_VERSION]))
+
+    def write(self, kind: bytes, payload):
+        """Append a record."""
+        data = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+        self._file.write(RECORD_HEADER.pack(kind, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        """Finish the file and move it into place."""
+        self._file.close()
+        os.replace(self._temp_path, self.file_path)
+
+    def abort(self):
+        """Throw the partial file away."""
+        self._file.close()
+        os.remove(self._temp_path)
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Keep the file on success, remove it on error."""
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class SnapshotReader():
+    """Iterates over the (kind, payload) records of a snapshot."""
+
+    def __init__(self, file_path: Path):
+        """Open a snapshot and check its format."""
+        self.file_path = Path(file_path)
+        self._file = gzip.open(self.file_path, 'rb')
+        try:
+            prefix = self._file.read(len(MAGIC) + 1)
+        except (OSError, EOFError) as error:
+            self._file.close()
+            raise SnapshotError(f'{file_path} is not a snapshot: {error}') from error
+        if prefix[:len(MAGIC)] != MAGIC:
+            self._file.close()
+            raise SnapshotError(f'{file_path} is not a snapshot')
+        if prefix[len(MAGIC):] != bytes([FORMAT_VERSION]):
+            self._file.close()
+            raise SnapshotError(f'{file_path} uses an unsupported snapshot version')
+
+    def __iter__(self):
+        """Yield the records, raises SnapshotError if the file ends early."""
+        try:
+            while True:
+                header = self._file.read(RECORD_HEADER.size)
+                if not header:
+                    raise SnapshotError(f'{self.file_path} is truncated, it has no end record')
+                if len(header) < RECORD_HEADER.size:
+                    raise SnapshotError(f'{self.file_path} is truncated')
+                kind, size = RECORD_HEADER.unpack(header)
+                data = self._file.read(size)
+                if len(data) < size:
+                    raise SnapshotError(f'{self.file_path} is truncated')
+                try:
+                    payload = json.loads(data.decode('utf-8'))
+                except ValueError as error:
+                    raise SnapshotError(f'{self.file_path} has a corrupt record: '
+                                        f'{error}') from error
+                yield kind, payload
+                if kind == END:
+                    return
+        except (OSError, EOFError) as error:
+            raise SnapshotError(f'{self.file_path} is corrupt: {error}') from error
+
+    def close(self):
+        """Close the file."""
+        self._file.close()
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Close the file."""
+        self.close()
@@ -15,24 +15,72 @@ class Column():
         """Generate the column string used the CREATE TABLE query."""
         return ' '.join([self.name, self.datatype, self.constraint or ''])
 
+    def coerce(self, value):
+        """Convert value the way sqlite's type affinity stores it in this column.
+
+        This lets new values be compared to the ones read back from the table.
+        """
+        if value is None or isinstance(value, bool):
+            return value
+        if 'INT' in self.datatype:
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, str) and value.strip().lstrip('+-').isdigit():
+                return int(value)
+        elif 'TEXT' in self.datatype and isinstance(value, (int, float)):
+            return str(value)
+        return value
+
+
+class Index():
+    """Helper to manage table index data."""
+
+    def __init__(self, name, columns, unique=False):
+        self.name = name
+        self.columns = columns
+        self.unique = unique
+
+    def create_string(self, table_name):
+        """Generate an SQL query to create the index on table_name."""
+        unique = 'UNIQUE ' if self.unique else ''
+        columns = ', '.join(self.columns)
+        return f"CREATE {unique}INDEX IF NOT EXISTS '{self.name}' ON '{table_name}' ({columns});"
+
 
 class Table():
     """Helper class to manage table data."""
 
-    def __init__(self, table_name: str):
-        """Create a container to help manage an SQL table."""
+    def __init__(self, table_name: str, primary_key: tuple = None):
+        """Create a container to help manage an SQL table.
+
+        primary_key is a tuple of column names for a composite key, single
+        column keys can be set with the Column constraint instead.
+        """
         self.table_name = table_name
         self.columns = []
+        self.primary_key = primary_key
+        self.indexes = []
 
     def add_column(self, column: Column):
         """Add a Column type object to the table."""
         self.columns.append(column)
 
+    def add_index(self, index: 'Index'):
+        """Add an Index type object to the table."""
+        self.indexes.append(index)
+
     @property
     def create_table_string(self):
         """Generate an SQL query to create the table in a database."""
-        columns = ', '.join([column.create_text for column in self.columns])
-        return f"CREATE TABLE IF NOT EXISTS '{self.table_name}' ({columns});"
+        columns = [column.create_text for column in self.columns]
+        if self.primary_key:
+            columns.append(f"PRIMARY KEY ({', '.join(self.primary_key)})")
+        return f"CREATE TABLE IF NOT EXISTS '{self.table_name}' ({', '.join(columns)});"
+
+    @property
+    def create_index_strings(self):
+        """Generate the SQL queries to create the table's indexes."""
+        return [index.create_string(self.table_name) for index in self.indexes]
 
     @property
     def insert_string(self):
@@ -67,3 +115,33 @@ SHOW_COLUMNS = (
     Column('filename', 'TEXT', None),
     Column('overview', 'TEXT', None),
 )
+
+# Columns of the single episodes table shared by every series.  Rows are
+# keyed by the episode id like the per-series tables, TVDB has episodes
+# that share their season and episode numbers.
+EPISODES_COLUMNS = SHOW_COLUMNS
+
+EPISODES_INDEXES = (
+    Index('episodes_seriesId_number', ('seriesId', 'airedSeason', 'airedEpisodeNumber')),
+    Index('episodes_firstAired', ('firstAired',)),
+)
+
+STATE_COLUMNS = (
+    Column('key', 'TEXT', 'PRIMARY KEY'),
+    Column('value', 'TEXT', None),
+)
+
+# Episodes with a known air date, the date normalized to ISO 8601.
+SCHEDULE_COLUMNS = (
+    Column('episodeId', 'INTEGER', 'PRIMARY KEY'),
+    Column('seriesId', 'INTEGER', 'NOT NULL'),
+    Column('airDate', 'TEXT', 'NOT NULL'),
+    Column('airedSeason', 'INTEGER', None),
+    Column('airedEpisodeNumber', 'INTEGER', None),
+    Column('episodeName', 'TEXT', None),
+)
+
+SCHEDULE_INDEXES = (
+    Index('schedule_airDate', ('airDate',)),
+    Index('schedule_seriesId_airDate', ('seriesId', 'airDate')),
+)
@@ -0,0 +1,17 @@
+"""Contains the helpers to compare series titles."""
+
+import re
+import unicodedata
+
+
+def normalize_title(title: str) -> str:
+    """Reduce a series title to a form that matches across sites.
+
+    Accents, punctuation, case and a leading 'The' are dropped.
+    """
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(char for char in title if not unicodedata.combining(char)).lower()
+    title = re.sub(r'[^a-z0-9]+', ' ', title.replace('&', ' and ')).strip()
+    if title.startswith('the '):
+        title = title[4:]
+    return title
@@ -0,0 +1,247 @@
+"""Contains the HTTP transports used to talk to TVDB.
+
+A transport takes a request and returns a fully read Response, or streams
+the body through a StreamingResponse for large downloads.  TvdbApi
+accepts any Transport, so a fake one (or one pointed at a local server)
+can be swapped in.
+"""
+
+import gzip
+import http.client
+import io
+import logging
+import threading
+import zlib
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from urllib import parse
+
+from scotchbutter.util import metrics
+
+# Idle connections kept open per host.
+MAX_IDLE_CONNECTIONS = 8
+DEFAULT_TIMEOUT = 30
+# Bytes read at a time from a streamed response.
+CHUNK_SIZE = 64 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Response():
+    """Container for a completed HTTP response."""
+
+    def __init__(self, status: int, headers, body: bytes):
+        """Create a response container."""
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def __repr__(self):
+        return f'<Response {self.status} ({len(self.body)} bytes)>'
+
+
+class StreamingResponse():
+    """Container for a response whose body is read incrementally."""
+
+    def __init__(self, status: int, headers, raw):
+        """Create a streaming response around a file-like raw body."""
+        self.status = status
+        self.headers = headers
+        self.raw = raw
+
+    def iter_chunks(self, chunk_size: int = CHUNK_SIZE):
+        """Yield the body chunk_size bytes at a time, read errors raise ConnectionError."""
+        while True:
+            try:
+                chunk = self.raw.read(chunk_size)
+            except (http.client.HTTPException, OSError) as error:
+                raise ConnectionError(f'Reading the response failed: {error}') from error
+            if not chunk:
+                break
+            yield chunk
+
+
+def decode_body(body: bytes, encoding: str = None) -> bytes:
+    """Undo the Content-Encoding of a response body."""
+    encoding = (encoding or '').lower()
+    if encoding == 'gzip':
+        return gzip.decompress(body)
+    if encoding == 'deflate':
+        return zlib.decompress(body)
+    return body
+
+
+def split_origin(url: str, hosts: dict = None):
+    """Return the (scheme, host, port) and request path for url.
+
+    hosts maps host names to the urlsplit origin they are sent to instead.
+    """
+    parts = parse.urlsplit(url)
+    target = (hosts or {}).get(parts.hostname, parts)
+    scheme = target.scheme or 'http'
+    port = target.port or (443 if scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return (scheme, target.hostname, port), path
+
+
+class Transport(metaclass=ABCMeta):
+    """Base class for the HTTP transports."""
+
+    @abstractmethod
+    def request(self, method: str, url: str, headers: dict = None,
+                data: bytes = None) -> Response:
+        """Send a request and return the full response."""
+
+    @contextmanager
+    def stream(self, method: str, url: str, headers: dict = None):
+        """Send a request and yield a StreamingResponse.
+
+        The default implementation buffers the whole body with request(),
+        transports that can stream should override it.
+        """
+        response = self.request(method, url, headers)
+        yield StreamingResponse(response.status, response.headers, io.BytesIO(response.body))
+
+    def close(self):
+        """Release any resources held by the transport."""
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Release the transport resources."""
+        self.close()
+
+
+class KeepAliveTransport(Transport):
+    """Reuses persistent HTTP/1.1 connections across requests.
+
+    Idle connections are pooled per (scheme, host, port) and can be picked
+    up by any thread, so the TCP and TLS handshakes are paid once per
+    connection instead of once per request.  hosts optionally maps a host
+    name to another origin, e.g. {'api.thetvdb.com': 'http://127.0.0.1:8080'}.
+    """
+
+    def __init__(self, timeout: float = DEFAULT_TIMEOUT,
+                 max_idle: int = MAX_IDLE_CONNECTIONS, hosts: dict = None):
+        """Create a transport with an empty connection pool."""
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.hosts = {host: parse.urlsplit(origin) for host, origin in (hosts or {}).items()}
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+
+    def _origin(self, url: str):
+        """Return the (scheme, host, port) and request path for url."""
+        return split_origin(url, self.hosts)
+
+    def _checkout(self, origin):
+        """Take an idle connection for origin, or open a new one."""
+        with self._lock:
+            idle = self._idle.get(origin)
+            if idle:
+                return idle.pop(), True
+            self.connections_opened += 1
+        scheme, host, port = origin
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        # Connect up front so the TCP and TLS handshakes are timed on their own.
+        try:
+            with metrics.timer('http.connect'):
+                conn.connect()
+        except OSError as error:
+            # Timeouts and DNS failures are not ConnectionErrors, callers only retry those.
+            conn.close()
+            raise ConnectionError(f'Connecting to {host}:{port} failed: {error}') from error
+        logger.debug('Opened connection to %s://%s:%s', scheme, host, port)
+        return conn, False
+
+    def _checkin(self, origin, conn):
+        """Return a connection to the idle pool."""
+        with self._lock:
+            idle = self._idle.setdefault(origin, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method: str, url: str, headers: dict = None,
+                data: bytes = None) -> Response:
+        """Send a request over a pooled connection."""
+        origin, path = self._origin(url)
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers.setdefault('Connection', 'keep-alive')
+        while True:
+            conn, reused = self._checkout(origin)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError) as error:
+                conn.close()
+                if reused:
+                    # The server dropped an idle connection, retry on a fresh one.
+                    logger.debug('Reused connection failed (%s), reconnecting', error)
+                    continue
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            except OSError as error:
+                conn.close()
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            break
+        if response.will_close:
+            conn.close()
+        else:
+            self._checkin(origin, conn)
+        body = decode_body(body, response.headers.get('Content-Encoding'))
+        return Response(response.status, response.headers, body)
+
+    @contextmanager
+    def stream(self, method: str, url: str, headers: dict = None):
+        """Send a request and yield a StreamingResponse read from the socket.
+
+        The body is not content-decoded, so it is requested as identity.
+        The connection returns to the pool only if the body was fully read.
+        """
+        origin, path = self._origin(url)
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'identity'
+        headers.setdefault('Connection', 'keep-alive')
+        while True:
+            conn, reused = self._checkout(origin)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError) as error:
+                conn.close()
+                if reused:
+                    logger.debug('Reused connection failed (%s), reconnecting', error)
+                    continue
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            except OSError as error:
+                conn.close()
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            break
+        try:
+            yield StreamingResponse(response.status, response.headers, response)
+        except BaseException:
+            conn.close()
+            raise
+        if response.isclosed() and not response.will_close:
+            self._checkin(origin, conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
@@ -1,12 +1,20 @@
 """Contains classes and functions to communicate with the TVDB API."""
+import hashlib
 import json
 import logging
+import os
 import re
-from functools import lru_cache
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from urllib import parse, request
+from urllib import parse
 
-from scotchbutter.util import environment
+from scotchbutter.util import (environment, http_cache, metrics, ratelimit, singleflight,
+                               tables, transport)
 
 # TODO: Possibly move to a config file
 AUTH_DATA = {
@@ -23,130 +31,611 @@ SUB_URLS = {
     'search_series': '/search/series?name={name}',
     'series': '/series/{series_id}',
     'episodes': '/series/{series_id}/episodes',
+    'episode': '/episodes/{episode_id}',
+    'updated': '/updated/query?fromTime={from_time}&toTime={to_time}',
 }
-URLS = {key: request.urljoin(API_URL, path) for key, path in SUB_URLS.items()}
-URLS['banners'] = request.urljoin(TVDB_URL, '/banners/')
+URLS = {key: parse.urljoin(API_URL, path) for key, path in SUB_URLS.items()}
+URLS['banners'] = parse.urljoin(TVDB_URL, '/banners/')
+# Seconds a cached response is used before it is revalidated, by SUB_URLS key.
+CACHE_TTLS = {
+    'search_series': 24 * 60 * 60,
+    'series': 6 * 60 * 60,
+    'episodes': 6 * 60 * 60,
+    'episode': 6 * 60 * 60,
+}
+
+# TVDB tokens expire after 24 hours, refresh them a while before that.
+TOKEN_LIFETIME = 24 * 60 * 60
+TOKEN_REFRESH_AGE = 20 * 60 * 60
+# TVDB only reports updates for up to a week per query.
+UPDATED_WINDOW = 7 * 24 * 60 * 60
 
 # Sample string of date '1985-12-27'
 # dates aren't zero padded anymore, so also '1990-9-2'
 DATE_REGEX = re.compile(r'(?P<year>\d{4})-\d{1,2}-\d{1,2}')
 
-class TvdbApi():
-    """Provides an interface to query TVDB api."""
+# Fields kept by the compact records, the rest of the payload is fetched on demand.
+COMPACT_SERIES_FIELDS = ('id',) + tuple(column.name for column in tables.LIBRARY_COLUMNS
+                                        if column.name != 'overview')
+COMPACT_EPISODE_FIELDS = tuple(column.name for column in tables.SHOW_COLUMNS
+                               if column.name != 'overview') + ('lastUpdated',)
+# Fields whose values repeat across records, so they are interned.
+INTERNED_FIELDS = ('airsDayOfWeek', 'airsTime', 'firstAired', 'imdbId')
+
+# Number of episode pages fetched at once.  Keep this low enough to stay
+# under the TVDB rate limits.
+PAGE_WORKERS = 4
+
+
+def _default_file_mode() -> int:
+    """Return the mode open() gives new files under the current umask."""
+    # The umask can only be read by setting it, do it once while importing.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# Mode of downloaded files, temporary files are created private.
+DOWNLOAD_FILE_MODE = _default_file_mode()
+
+
+def make_series_ident(series_name: str, first_aired: str) -> str:
+    """Build the series name that is unique between remakes.
+
+    The series_ident will always include the year, when it is known.
+    """
+    series_ident = series_name
+    date = DATE_REGEX.match(first_aired or '')
+    if date:
+        year = f" ({date.groupdict()['year']})"
+        if not series_name.endswith(year):
+            series_ident += year
+    return series_ident
+
+
+def _compress(text):
+    """Store long free text compressed, it is rarely read."""
+    return zlib.compress(text.encode('utf-8')) if text else text
+
+
+def _decompress(data):
+    """Undo _compress."""
+    return zlib.decompress(data).decode('utf-8') if data else data
+
+
+class DownloadFile():
+    """Writes a download to a temporary file that replaces output_file when complete.
+
+    output_file is never left half written.  result is a tuple of
+    (size, sha256 hexdigest), or None when the body was empty.
+    """
+
+    def __init__(self, output_file: Path):
+        """Open a temporary file next to output_file."""
+        self.output_file = output_file
+        self.result = None
+        self._digest = hashlib.sha256()
+        self._size = 0
+        if not Path.is_dir(output_file.parent):
+            logging.debug('Creating directory %s', output_file.parent)
+            Path.mkdir(output_file.parent, parents=True, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=output_file.parent, prefix='.download-',
+                                                 delete=False)
+
+    def write(self, chunk: bytes):
+        """Append a chunk of the body."""
+        self._file.write(chunk)
+        self._digest.update(chunk)
+        self._size += len(chunk)
+
+    def finish(self):
+        """Move the complete file into place, an empty body leaves no file."""
+        self._file.close()
+        if not self._size:
+            self.abort()
+            return
+        os.chmod(self._file.name, DOWNLOAD_FILE_MODE)
+        os.replace(self._file.name, self.output_file)
+        self.result = (self._size, self._digest.hexdigest())
+
+    def abort(self):
+        """Remove the temporary file."""
+        self._file.close()
+        if os.path.exists(self._file.name):
+            os.remove(self._file.name)
+
+    def __enter__(self):
+        """Context management protocol."""
+        return self
 
-    def __init__(self):
-        """Generate a new API instance."""
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Move the file into place on success, remove it otherwise."""
+        if exc_type is None:
+            self.finish()
+        else:
+            self.abort()
+
+
+class TvdbApiBase():
+    """Request building and response handling shared by the TVDB clients.
+
+    Nothing here does I/O.  TvdbApi and tvdb_async.AsyncTvdbApi send the
+    requests and wait in their own way, then hand the responses back here.
+    """
+
+    def __init__(self, use_cache: bool = True, rate_limiter: ratelimit.RateLimiter = None,
+                 retry_policy: ratelimit.RetryPolicy = None):
+        """Set up the token, cache and pacing state."""
         self._token = None
+        self._token_time = None
         self._file_path = environment.get_settings_path()
+        self.cache = http_cache.ResponseCache() if use_cache else None
+        self.rate_limiter = rate_limiter or ratelimit.RateLimiter()
+        self.retry_policy = retry_policy or ratelimit.RetryPolicy()
+        self.reauthentications = 0
 
-    @property
-    def token(self):
-        """Generate new/use cached authentication token."""
-        if self._token is None:
-            headers = {
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-            }
-            data = bytes(json.dumps(AUTH_DATA), encoding='utf-8')
-            req = request.Request(URLS['login'], headers=headers, data=data)
-            try:
-                response = request.urlopen(req)
-            except request.HTTPError as error:
-                if error.code == 401:
-                    raise ConnectionRefusedError('Failed To Authenticate.')
-                raise ConnectionError(f'Unexpected Response: {error.code}.')
-            self._token = json.loads(response.read().decode('utf-8'))['token']
+    def _token_action(self):
+        """Return 'login' or 'refresh' when the token needs either, else None."""
+        token_age = None if self._token is None else time.monotonic() - self._token_time
+        if token_age is None or token_age >= TOKEN_LIFETIME:
+            return 'login'
+        if token_age >= TOKEN_REFRESH_AGE:
+            return 'refresh'
+        return None
+
+    @staticmethod
+    def _login_request():
+        """Return the method, url, headers and body of a login request."""
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+        }
+        data = bytes(json.dumps(AUTH_DATA), encoding='utf-8')
+        return 'POST', URLS['login'], headers, data
+
+    def _refresh_request(self):
+        """Return the method, url, headers and body of a token refresh request."""
+        headers = {
+            'Accept': 'application/json',
+            'Authorization': f'Bearer {self._token}'
+        }
+        return 'GET', URLS['refresh_token'], headers, None
+
+    def _set_token(self, response, refreshed: bool = False):
+        """Store the token of a login or refresh response."""
+        if response.status == 401:
+            raise ConnectionRefusedError('Failed To Authenticate.')
+        if response.status != 200:
+            raise ConnectionError(f'Unexpected Response: {response.status}.')
+        self._token = json.loads(response.body.decode('utf-8'))['token']
+        self._token_time = time.monotonic()
+        if refreshed:
+            metrics.count('tvdb.token_refreshes')
+            logging.debug('Refreshed TVDB token')
+        else:
+            metrics.count('tvdb.logins')
             logging.debug('Generated new TVDB token')
-        return self._token
 
-    @lru_cache()
-    def _get(self, url: str, binary=False):
-        """Post and return contents of an HTTP request."""
+    def _forget_token(self, token: str):
+        """Forget a token the server rejected, unless it was already replaced."""
+        if self._token == token:
+            self._token = None
+            self.reauthentications += 1
+            logging.debug('TVDB rejected the token, authenticating again')
+
+    def _retry_delay(self, status: int, headers, attempt: int):
+        """Handle a retryable status, returns the Retry-After delay or False to give up.
+
+        The delay may be None, the retry policy then picks the back-off.
+        """
+        retry_after = ratelimit.parse_retry_after(headers.get('Retry-After'))
+        if status in ratelimit.THROTTLE_STATUSES:
+            self.rate_limiter.on_throttle(retry_after)
+        if not self.retry_policy.allow(attempt):
+            return False
+        logging.debug('Got response %s, retrying (attempt %s)', status, attempt + 1)
+        return retry_after
+
+    def _retry_error(self, url: str, error: ConnectionError, attempt: int) -> bool:
+        """Check if a request that failed with error should be sent again."""
+        if not self.retry_policy.allow(attempt):
+            return False
+        logging.debug('Request to %s failed (%s), retrying', url, error)
+        return True
+
+    @property
+    def metrics(self):
+        """Return the request pacing and retry counters."""
+        counters = self.rate_limiter.metrics
+        counters.update(self.retry_policy.metrics)
+        counters['reauthentications'] = self.reauthentications
+        return counters
+
+    def _lookup(self, url: str, binary: bool, ttl: int, cache: bool):
+        """Find url in the response cache, returns (use_cache, cached, fresh body or None)."""
+        cache = cache and binary is False and self.cache is not None
+        if not cache:
+            return False, None, None
+        cached, fresh = self.cache.lookup(url, ttl)
+        if fresh:
+            metrics.count('tvdb.cache_hits')
+            return True, cached, cached.body
+        return True, cached, None
+
+    @staticmethod
+    def _request_headers(token: str, cached=None):
+        """Return the headers of an API request, revalidating cached if given."""
         headers = {
             'Accept': 'application/json',
-            'Authorization': f'Bearer {self.token}'
+            'Authorization': f'Bearer {token}'
         }
-        req = request.Request(url, headers=headers)
-        try:
-            response = request.urlopen(req)
-        except request.HTTPError as error:
-            if error.code == 404:
-                raise LookupError('There are no data for this term.')
-            raise ConnectionError(f'Unexpected Response: {error.code}.')
-        if binary is True:
-            contents = response.read() or None
+        if cached is not None:
+            headers.update(cached.validators)
+        return headers
+
+    @staticmethod
+    def _check_status(response):
+        """Raise the error matching an unsuccessful response."""
+        if response.status == 404:
+            raise LookupError('There are no data for this term.')
+        if response.status != 200:
+            raise ConnectionError(f'Unexpected Response: {response.status}.')
+
+    def _response_body(self, url: str, response, cached, cache: bool) -> bytes:
+        """Return the body of an API response, updating the response cache."""
+        if response.status == 304 and cached is not None:
+            self.cache.revalidate(url)
+            metrics.count('tvdb.cache_revalidations')
+            logging.debug('Revalidated cached response for %s', url)
+            return cached.body
+        self._check_status(response)
+        if cache:
+            self.cache.store(url, response.body, response.headers.get('ETag'),
+                             response.headers.get('Last-Modified'))
+        metrics.count('tvdb.bytes_received', len(response.body))
+        return response.body
+
+    @staticmethod
+    def _series_data(response: dict, series_id: int):
+        """Return the series data of a series response."""
+        response['data']['seriesId'] = response['data']['id']
+        logging.debug('Got data for seriesID: %s', series_id)
+        return response['data']
+
+    @staticmethod
+    def _page_urls(url: str, response: dict):
+        """Return the urls of the remaining pages, None if the last page is unknown."""
+        last_page = (response.get('links') or {}).get('last')
+        if not last_page:
+            return None
+        return [f'{url}?page={page}' for page in range(2, last_page + 1)]
+
+    @staticmethod
+    def _updated_urls(from_time: int, to_time: int = None):
+        """Return the urls of the update queries covering from_time to to_time."""
+        to_time = int(to_time or time.time())
+        urls = []
+        window_start = int(from_time)
+        while window_start < to_time:
+            window_end = min(window_start + UPDATED_WINDOW, to_time)
+            urls.append(URLS['updated'].format(from_time=window_start, to_time=window_end))
+            window_start = window_end
+        return urls
+
+    @staticmethod
+    def _merge_updated(updated: dict, raw_data: list):
+        """Add the series of an update query to updated, keeping the latest times."""
+        for series in raw_data:
+            updated[series['id']] = max(series['lastUpdated'], updated.get(series['id'], 0))
+
+    @staticmethod
+    def _search_url(search_string: str):
+        """Return the url searching TVDB for search_string."""
+        return URLS['search_series'].format(name=parse.quote(search_string))
+
+    @staticmethod
+    def _search_results(raw_data: list, search_string: str):
+        """Drop the search results without a name."""
+        # Apparently results without a seriesName can be a thing.
+        found_series = [series for series in raw_data if series['seriesName']]
+        logging.debug('Found %s series (%s skipped) using search string "%s"', len(found_series),
+                      len(raw_data) - len(found_series), search_string)
+        return found_series
+
+    def _series_by_ident(self, raw_data: list):
+        """Key search results by their series_ident."""
+        found_series = {}
+        for series in raw_data:
+            series_ident = make_series_ident(series['seriesName'], series['firstAired'])
+            found_series[series_ident] = self.series_type(series, self)
+        return found_series
+
+    def forget_series(self, series_id: int):
+        """Drop any cached responses for a series so the next query refetches them."""
+        if self.cache is not None:
+            self.cache.invalidate(URLS['series'].format(series_id=series_id))
+
+    def expire_series(self, series_id: int):
+        """Make the next queries of a series revalidate its cached responses with TVDB."""
+        if self.cache is not None:
+            self.cache.expire(URLS['series'].format(series_id=series_id))
+
+    def _download_target(self, path: str, output_file: Path = None):
+        """Return the url and output file of a download."""
+        return parse.urljoin(URLS['banners'], path), output_file or self._file_path.joinpath(path)
+
+    @staticmethod
+    def _downloaded(url: str, output_file: Path, result):
+        """Log a finished download, returns output_file or None if it was empty."""
+        if result is None:
+            # Sometimes files come back with 0 bytes instead of 404 error
+            # We are going to pretend they don't exist for right now.
+            logging.info('File %s was found, but contained no data.  Skipping download.', url)
+            return None
+        logging.debug('Downloaded %s to %s', url, output_file)
+        return output_file
+
+    def _download_response(self, response):
+        """Check a download response before its body is written."""
+        self._check_status(response)
+        self.rate_limiter.on_success()
+
+
+class TvdbApi(TvdbApiBase):
+    """Provides an interface to query TVDB api."""
+
+    def __init__(self, page_workers: int = PAGE_WORKERS, use_cache: bool = True,
+                 http_transport: transport.Transport = None, compact: bool = False,
+                 rate_limiter: ratelimit.RateLimiter = None,
+                 retry_policy: ratelimit.RetryPolicy = None):
+        """Generate a new API instance.
+
+        page_workers limits how many episode pages are requested at once,
+        a value of 1 walks the pages serially.  use_cache stores JSON
+        responses in a persistent http_cache.ResponseCache.  http_transport
+        defaults to a transport.KeepAliveTransport.  compact returns
+        CompactSeries/CompactEpisode records instead of TvdbSeries/Episode.
+        rate_limiter and retry_policy pace and retry every request, share
+        them between instances to share the pacing.
+        """
+        super().__init__(use_cache, rate_limiter, retry_policy)
+        self._token_lock = threading.Lock()
+        self._flight = singleflight.SingleFlight()
+        self.page_workers = max(1, page_workers)
+        self.transport = http_transport or transport.KeepAliveTransport()
+        self.series_type = CompactSeries if compact else TvdbSeries
+
+    @property
+    def token(self):
+        """Generate new/use cached authentication token.
+
+        Only one thread logs in or refreshes the token at a time, the others
+        wait for it and use the new token.
+        """
+        with self._token_lock:
+            action = self._token_action()
+            if action is not None:
+                # Only logins and refreshes are timed, not the wait for the lock.
+                with metrics.timer('tvdb.token'):
+                    if action == 'login':
+                        self._login()
+                    else:
+                        self._refresh_token()
+            return self._token
+
+    def _login(self):
+        """Authenticate with TVDB for a new token."""
+        self._set_token(self._send(*self._login_request()))
+
+    def _refresh_token(self):
+        """Extend the current token, logging in again if it already expired."""
+        response = self._send(*self._refresh_request())
+        if response.status == 401:
+            self._login()
         else:
-            contents = json.loads(response.read().decode('utf-8'))
-        return contents
+            self._set_token(response, refreshed=True)
+
+    def _expire_token(self, token: str):
+        """Forget a token the server rejected, unless another thread already replaced it."""
+        with self._token_lock:
+            self._forget_token(token)
+
+    def _throttle(self, status: int, headers, attempt: int) -> bool:
+        """Handle a retryable status, returns True if the request should be sent again."""
+        retry_after = self._retry_delay(status, headers, attempt)
+        if retry_after is False:
+            return False
+        self.retry_policy.wait(attempt, retry_after)
+        return True
+
+    def _send(self, method: str, url: str, headers: dict = None, data: bytes = None):
+        """Send a paced request, retrying throttled and failed attempts."""
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                with metrics.timer('http.request'):
+                    response = self.transport.request(method, url, headers, data)
+            except ConnectionError as error:
+                if not self._retry_error(url, error, attempt):
+                    raise
+                self.retry_policy.wait(attempt)
+                attempt += 1
+                continue
+            if response.status in ratelimit.RETRY_STATUSES:
+                if self._throttle(response.status, response.headers, attempt):
+                    attempt += 1
+                    continue
+            else:
+                self.rate_limiter.on_success()
+            return response
+
+    def _get(self, url: str, binary=False, ttl: int = None, cache: bool = True):
+        """Post and return contents of an HTTP request.
+
+        JSON responses are served from the response cache while they are
+        younger than ttl, stale entries are revalidated with the server.
+        Concurrent requests for the same url share a single network call.
+        """
+        with metrics.timer('tvdb.get'):
+            body = self._flight.do((url, binary), self._fetch, url, binary, ttl, cache)
+        if binary is True:
+            return body or None
+        with metrics.timer('tvdb.json_decode'):
+            return json.loads(body.decode('utf-8'))
+
+    def _fetch(self, url: str, binary: bool, ttl: int, cache: bool) -> bytes:
+        """Return the raw body of url, from the response cache when possible."""
+        cache, cached, body = self._lookup(url, binary, ttl, cache)
+        if body is not None:
+            return body
+        for attempt in range(2):
+            token = self.token
+            response = self._send('GET', url, self._request_headers(token, cached))
+            if response.status != 401 or attempt > 0:
+                break
+            # The token expired early, get a new one and try once more.
+            self._expire_token(token)
+        return self._response_body(url, response, cached, cache)
+
+    def get_series_data(self, series_id: int):
+        """Query TVDB for the raw information about a series."""
+        url = URLS['series'].format(series_id=series_id)
+        return self._series_data(self._get(url, ttl=CACHE_TTLS['series']), series_id)
 
     def get_series(self, series_id: int):
         """Query TVDB for information about a series."""
-        response = self._get(URLS['series'].format(series_id=series_id))
-        response['data']['seriesId'] = response['data']['id']
-        logging.debug('Got data for seriesID: %s', series_id)
-        return TvdbSeries(response['data'], self)
+        return self.series_type(self.get_series_data(series_id), self)
+
+    def get_episode(self, episode_id: int):
+        """Query TVDB for the full information about a single episode."""
+        url = URLS['episode'].format(episode_id=episode_id)
+        return self._get(url, ttl=CACHE_TTLS['episode'])['data']
 
     def get_episodes(self, series_id: int):
         """Get all episode information for a series."""
         url = URLS['episodes'].format(series_id=series_id)
-        raw_data = self._get(url)['data']
+        response = self._get(url, ttl=CACHE_TTLS['episodes'])
+        raw_data = response['data']
         episode_data = list(raw_data)
-        tvdb_page_size = 100
-        page = 1
-        while len(raw_data) == tvdb_page_size:
-            page += 1
-            url = URLS['episodes'].format(series_id=series_id) + f'?page={page}'
-            try:
-                raw_data = self._get(url)['data']
-            except LookupError:
-                # When (total results) % tvdb_page_size == 0
-                break
-            episode_data += raw_data
+        page_urls = self._page_urls(url, response)
+        if self.page_workers > 1 and page_urls is not None:
+            if page_urls:
+                workers = min(self.page_workers, len(page_urls))
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    # map() yields in submission order, so pages stay in sequence.
+                    for raw_data in executor.map(self._get_listed_page, page_urls):
+                        episode_data += raw_data
+        else:
+            tvdb_page_size = 100
+            page = 1
+            while len(raw_data) == tvdb_page_size:
+                page += 1
+                raw_data = self._get_page(f'{url}?page={page}')
+                episode_data += raw_data
         logging.debug('Got %s episodes for seriesId %s', len(episode_data), series_id)
         return episode_data
 
+    def _get_page(self, url: str):
+        """Return the data of a single page of a paginated query."""
+        try:
+            return self._get_listed_page(url)
+        except LookupError:
+            # When (total results) % tvdb_page_size == 0
+            return []
+
+    def _get_listed_page(self, url: str):
+        """Return the data of a page links.last says exists, a 404 raises LookupError.
+
+        Reading a missing listed page as empty would drop its episodes, which
+        add_series then deletes from the library.
+        """
+        return self._get(url, ttl=CACHE_TTLS['episodes'])['data']
+
+    def get_updated(self, from_time: int, to_time: int = None):
+        """Find the series updated on TVDB since from_time.
+
+        Returns a dict of {seriesId: lastUpdated}, both epoch seconds.
+        """
+        updated = {}
+        for url in self._updated_urls(from_time, to_time):
+            try:
+                self._merge_updated(updated, self._get(url, cache=False)['data'] or [])
+            except LookupError:
+                pass
+        logging.debug('Found %s series updated since %s', len(updated), from_time)
+        return updated
+
+    def search_series_data(self, search_string: str):
+        """Search TVDB for matching shows, returns the raw series dicts.
+
+        Callers that only need ids and names, like util.resolver, skip
+        building a series object per result.
+        """
+        url = self._search_url(search_string)
+        raw_data = self._get(url, ttl=CACHE_TTLS['search_series'])['data']
+        return self._search_results(raw_data, search_string)
+
     def search_series(self, search_string: str):
         """Search TVDB for matching shows."""
-        url = URLS['search_series'].format(name=parse.quote(search_string))
-        raw_data = self._get(url)['data']
-        found_series = {}
-        skipped = 0
-        for series in raw_data:
-            if not series['seriesName']:
-                skipped += 1
-                # Apparently this can be a thing.
-                continue
-            series_ident = f"{series['seriesName']}"
-            date = DATE_REGEX.match(series['firstAired'] or '')
-            if date:
-                year = f" ({date.groupdict()['year']})"
-                if not series_ident.endswith(year):
-                    series_ident += year
-            found_series[series_ident] = TvdbSeries(series, self)
-        logging.debug('Found %s series (%s skipped) using search string "%s"', len(found_series), skipped, search_string)
-        return found_series
+        return self._series_by_ident(self.search_series_data(search_string))
 
-    @lru_cache()
     def download(self, path: str, output_file: Path = None):
         """Download a file from TVDB."""
-        url = request.urljoin(URLS['banners'], path)
-        output_file = output_file or self._file_path.joinpath(path)
+        url, output_file = self._download_target(path, output_file)
         if not Path.is_file(output_file):
-            data = self._get(url, binary=True)
-            if data is None:
-                # Sometimes files come back with 0 bytes instead of 404 error
-                # We are going to pretend they don't exist for right now.
-                logging.info('File %s was found, but contained no data.  Skipping download.', url)
-                output_file = None
-            else:
-                if not Path.is_dir(output_file.parent):
-                    logging.debug('Creating directory %s', output_file.parent)
-                    Path.mkdir(output_file.parent, parents=True)
-                with open(output_file, 'wb') as f:
-                    f.write(data)
-                logging.debug('Downloaded %s to %s', url, output_file)
+            result = self._flight.do(('download', str(output_file)), self.stream_to_file,
+                                     url, output_file)
+            output_file = self._downloaded(url, output_file, result)
         return output_file
 
+    def stream_to_file(self, url: str, output_file: Path):
+        """Stream a download to output_file in chunks.
+
+        The body is written to a temporary file in the same folder and then
+        renamed, so output_file is never left half written.  Returns a tuple
+        of (size, sha256 hexdigest), or None if the response was empty.
+        """
+        with metrics.timer('tvdb.download'):
+            result = self._stream_to_file(url, output_file)
+        if result is not None:
+            metrics.count('tvdb.download_bytes', result[0])
+        return result
+
+    def _stream_to_file(self, url: str, output_file: Path):
+        """Download url with retries, see stream_to_file."""
+        attempt = 0
+        reauthenticated = False
+        while True:
+            token = self.token
+            headers = {'Authorization': f'Bearer {token}'}
+            self.rate_limiter.acquire()
+            try:
+                with self.transport.stream('GET', url, headers) as response:
+                    if response.status == 401 and not reauthenticated:
+                        retry = reauthenticated = True
+                        self._expire_token(token)
+                    elif response.status in ratelimit.RETRY_STATUSES:
+                        retry = self._throttle(response.status, response.headers, attempt)
+                        attempt += 1
+                    else:
+                        retry = False
+                    if not retry:
+                        return self._write_stream(response, output_file)
+            except ConnectionError as error:
+                if not self._retry_error(url, error, attempt):
+                    raise
+                self.retry_policy.wait(attempt)
+                attempt += 1
+
+    def _write_stream(self, response: transport.StreamingResponse, output_file: Path):
+        """Write a streamed download to output_file, see stream_to_file."""
+        self._download_response(response)
+        with DownloadFile(output_file) as download:
+            for chunk in response.iter_chunks():
+                download.write(chunk)
+        return download.result
+
 
 class TvdbSeries():
     """Container for a information about a TV Show."""
@@ -157,14 +646,9 @@ class TvdbSeries():
         self._series_data = series_data
         self.series_id = series_data['id']
         self.series_name = series_data['seriesName']
-        self.series_ident = series_data['seriesName']
+        self.series_ident = make_series_ident(series_data['seriesName'],
+                                              series_data['firstAired'])
         self._episodes = None
-        date = DATE_REGEX.match(self._series_data['firstAired'] or '')
-        if date:
-            year = f" ({date.groupdict()['year']})"
-            # The series_ident will always include the year
-            if not self._series_data['seriesName'].endswith(year):
-                self.series_ident += year
 
     def __getitem__(self, key):
         if key in self._series_data:
@@ -181,14 +665,17 @@ class TvdbSeries():
     def episodes(self):
         """Find all known episodes of the series."""
         if self._episodes is None:
-            episodes_data = self._tvdb_api.get_episodes(self.series_id)
-            episodes = []
-            for episode_data in sorted(episodes_data, key=lambda x:
-                                       (x['airedSeason'], x['airedEpisodeNumber'])):
-                episodes.append(Episode(episode_data, self, self._tvdb_api))
-            self._episodes = episodes
+            self.set_episodes(self._tvdb_api.get_episodes(self.series_id))
         return self._episodes
 
+    def set_episodes(self, episodes_data):
+        """Build the episode containers from raw TVDB episode data."""
+        episodes = []
+        for episode_data in sorted(episodes_data, key=lambda x:
+                                   (x['airedSeason'], x['airedEpisodeNumber'])):
+            episodes.append(Episode(episode_data, self, self._tvdb_api))
+        self._episodes = episodes
+
     @property
     def banner(self):
         """Download the series banner from TVDB."""
@@ -227,3 +714,137 @@ class Episode():
         else:
             thumbnail = None
         return thumbnail
+
+
+def _compact_values(data, fields):
+    """Pick fields out of a TVDB payload, interning the values that repeat."""
+    values = []
+    for field in fields:
+        value = data.get(field)
+        if field in INTERNED_FIELDS and isinstance(value, str):
+            value = sys.intern(value)
+        values.append(value)
+    return tuple(values)
+
+
+class CompactSeries():
+    """Memory efficient container for a TV Show.
+
+    Only COMPACT_SERIES_FIELDS are kept in a tuple, the overview is stored
+    compressed and any other key is fetched from TVDB when it is requested.
+    """
+
+    __slots__ = ('_tvdb_api', '_values', '_overview', '_episodes', 'series_ident')
+    _index = {field: index for index, field in enumerate(COMPACT_SERIES_FIELDS)}
+
+    def __init__(self, series_data, tvdb_api):
+        """Create a compact TV Series container."""
+        self._tvdb_api = tvdb_api
+        self._values = _compact_values(series_data, COMPACT_SERIES_FIELDS)
+        self._overview = _compress(series_data.get('overview'))
+        self._episodes = None
+        self.series_ident = make_series_ident(self.series_name, self['firstAired'])
+
+    @property
+    def series_id(self):
+        return self._values[self._index['id']]
+
+    @property
+    def series_name(self):
+        return self._values[self._index['seriesName']]
+
+    def __getitem__(self, key):
+        if key in self._index:
+            return self._values[self._index[key]]
+        if key == 'overview':
+            return _decompress(self._overview)
+        series_data = self._tvdb_api.get_series_data(self.series_id)
+        if key in series_data:
+            return series_data[key]
+        raise KeyError(key)
+
+    def __str__(self):
+        return self.series_ident
+
+    def __repr__(self):
+        return f'{self.series_ident} -- seriesId: {self.series_id}'
+
+    @property
+    def episodes(self):
+        """Find all known episodes of the series."""
+        if self._episodes is None:
+            self.set_episodes(self._tvdb_api.get_episodes(self.series_id))
+        return self._episodes
+
+    def set_episodes(self, episodes_data):
+        """Build the episode containers from raw TVDB episode data."""
+        episodes_data = sorted(episodes_data,
+                               key=lambda x: (x['airedSeason'], x['airedEpisodeNumber']))
+        self._episodes = [CompactEpisode(episode_data, self) for episode_data in episodes_data]
+
+    @property
+    def banner(self):
+        """Download the series banner from TVDB."""
+        return self._tvdb_api.download(self['banner'])
+
+
+class CompactEpisode():
+    """Memory efficient container for an episode of a series.
+
+    Only COMPACT_EPISODE_FIELDS are kept in a tuple, the overview is stored
+    compressed and any other key is fetched from TVDB when it is requested.
+    """
+
+    __slots__ = ('series', '_values', '_overview')
+    _index = {field: index for index, field in enumerate(COMPACT_EPISODE_FIELDS)}
+
+    def __init__(self, episode_data, series):
+        """Create a compact episode container."""
+        self.series = series
+        self._values = _compact_values(episode_data, COMPACT_EPISODE_FIELDS)
+        self._overview = _compress(episode_data.get('overview'))
+
+    @property
+    def series_name(self):
+        return self.series.series_name
+
+    @property
+    def series_ident(self):
+        return self.series.series_ident
+
+    @property
+    def series_id(self):
+        return self.series.series_id
+
+    @property
+    def episode_number(self):
+        return self._values[self._index['airedEpisodeNumber']]
+
+    @property
+    def season(self):
+        return self._values[self._index['airedSeason']]
+
+    @property
+    def name(self):
+        return self._values[self._index['episodeName']]
+
+    def __getitem__(self, key):
+        if key in self._index:
+            return self._values[self._index[key]]
+        if key == 'overview':
+            return _decompress(self._overview)
+        episode_data = self.series._tvdb_api.get_episode(self['id'])
+        if key in episode_data:
+            return episode_data[key]
+        raise KeyError(key)
+
+    def __str__(self):
+        return f'{self.series_ident} - S{self.season:02d}E{self.episode_number:02d} - {self.name}'
+
+    @property
+    def thumbnail(self):
+        """Download the episode thumbnail from TVDB."""
+        filename = self['filename']
+        if filename:
+            return self.series._tvdb_api.download(filename)
+        return None
@@ -0,0 +1,617 @@
+"""Contains an asyncio client for the TVDB API.
+
+AsyncTvdbApi mirrors tvdb.TvdbApi but runs on an event loop, so a single
+thread can keep hundreds of requests in flight.  Request building and
+response handling are shared with tvdb.TvdbApi through tvdb.TvdbApiBase.
+It returns AsyncTvdbSeries containers, whose episodes are either fetched
+by get_series or loaded with load_episodes.  The banner and thumbnail
+properties of those containers return awaitables.
+"""
+
+import asyncio
+import http.client
+import io
+import json
+import logging
+import ssl
+from contextlib import asynccontextmanager
+from pathlib import Path
+from urllib import parse
+
+from scotchbutter.util import metrics, ratelimit, transport, tvdb
+
+# Connections open at once per host, which is also the number of requests
+# in flight.  The rate limiter still paces how fast they are sent.
+MAX_CONNECTIONS = 100
+# Series get_many_series fetches at once, each may also fetch its episode
+# pages.  Bounds the series held in memory however many are requested.
+MAX_PENDING_SERIES = 16
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncStreamingResponse():
+    """Container for a response whose body is read incrementally."""
+
+    def __init__(self, status: int, headers, chunks):
+        """Create a streaming response around an async generator of body chunks."""
+        self.status = status
+        self.headers = headers
+        self._chunks = chunks
+        self.complete = False
+
+    async def iter_chunks(self):
+        """Yield the body a chunk at a time."""
+        try:
+            async for chunk in self._chunks:
+                yield chunk
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as error:
+            raise ConnectionError(f'Download interrupted: {error!r}') from error
+        self.complete = True
+
+
+class _Connection():
+    """A single HTTP/1.1 connection opened with asyncio streams."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Wrap an open stream pair."""
+        self.reader = reader
+        self.writer = writer
+        self.will_close = False
+
+    def close(self):
+        """Close the connection without waiting for it."""
+        self.writer.close()
+
+
+class AsyncKeepAliveTransport():
+    """Asyncio HTTP/1.1 transport reusing persistent connections.
+
+    Mirrors transport.KeepAliveTransport: idle connections are pooled per
+    (scheme, host, port), bodies are requested gzipped and hosts optionally
+    maps a host name to another origin.  At most max_connections
+    connections are open per origin, further requests wait for one.
+    """
+
+    def __init__(self, timeout: float = transport.DEFAULT_TIMEOUT,
+                 max_connections: int = MAX_CONNECTIONS, hosts: dict = None):
+        """Create a transport with an empty connection pool."""
+        self.timeout = timeout
+        self.max_connections = max(1, max_connections)
+        self.hosts = {host: parse.urlsplit(origin) for host, origin in (hosts or {}).items()}
+        self._idle = {}
+        self._slots = {}
+        self._ssl_context = None
+        self.connections_opened = 0
+
+    def _origin(self, url: str):
+        """Return the (scheme, host, port) and request path for url."""
+        return transport.split_origin(url, self.hosts)
+
+    def _slot(self, origin) -> asyncio.Semaphore:
+        """Return the semaphore limiting the connections to origin."""
+        # Created on first use so they belong to the running loop.
+        if origin not in self._slots:
+            self._slots[origin] = asyncio.Semaphore(self.max_connections)
+        return self._slots[origin]
+
+    async def _checkout(self, origin):
+        """Take an idle connection for origin, or open a new one."""
+        idle = self._idle.get(origin)
+        while idle:
+            conn = idle.pop()
+            if not conn.reader.at_eof():
+                return conn, True
+            conn.close()
+        scheme, host, port = origin
+        ssl_context = None
+        if scheme == 'https':
+            if self._ssl_context is None:
+                self._ssl_context = ssl.create_default_context()
+            ssl_context = self._ssl_context
+        try:
+            with metrics.timer('http.connect'):
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(host, port, ssl=ssl_context), self.timeout)
+        except OSError as error:
+            # Timeouts and DNS failures are not ConnectionErrors, callers only retry those.
+            raise ConnectionError(f'Connecting to {host}:{port} failed: {error!r}') from error
+        self.connections_opened += 1
+        logger.debug('Opened connection to %s://%s:%s', scheme, host, port)
+        return _Connection(reader, writer), False
+
+    def _checkin(self, origin, conn: _Connection):
+        """Return a connection to the idle pool, or close it."""
+        if conn.will_close:
+            conn.close()
+        else:
+            self._idle.setdefault(origin, []).append(conn)
+
+    async def _send_request(self, conn: _Connection, method: str, origin, path: str,
+                            headers: dict, data: bytes):
+        """Write a request and read the status line and headers of the response."""
+        scheme, host, port = origin
+        default_port = 443 if scheme == 'https' else 80
+        lines = [f'{method} {path} HTTP/1.1',
+                 f'Host: {host}' if port == default_port else f'Host: {host}:{port}']
+        if data is not None:
+            headers['Content-Length'] = str(len(data))
+        lines.extend(f'{name}: {value}' for name, value in headers.items())
+        conn.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (data or b''))
+        await conn.writer.drain()
+        status_line = await asyncio.wait_for(conn.reader.readline(), self.timeout)
+        if not status_line:
+            raise ConnectionResetError('Connection closed before a response was sent')
+        version, status = status_line.decode('latin-1').split(None, 2)[:2]
+        header_lines = []
+        while True:
+            line = await asyncio.wait_for(conn.reader.readline(), self.timeout)
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        response_headers = http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+        connection = (response_headers.get('Connection') or '').lower()
+        conn.will_close = version == 'HTTP/1.0' or connection == 'close'
+        return int(status), response_headers
+
+    def _body_chunks(self, conn: _Connection, method: str, status: int, headers,
+                     chunk_size: int = transport.CHUNK_SIZE):
+        """Return an async generator over the raw body of a response."""
+        reader = conn.reader
+
+        async def read_exactly(size):
+            return await asyncio.wait_for(reader.readexactly(size), self.timeout)
+
+        async def chunks():
+            if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+                return
+            if (headers.get('Transfer-Encoding') or '').lower() == 'chunked':
+                while True:
+                    size_line = await asyncio.wait_for(reader.readline(), self.timeout)
+                    size = int(size_line.split(b';')[0], 16)
+                    if size == 0:
+                        # Skip any trailers up to the closing blank line.
+                        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                            pass
+                        return
+                    while size:
+                        chunk = await read_exactly(min(size, chunk_size))
+                        size -= len(chunk)
+                        yield chunk
+                    await read_exactly(2)
+            elif headers.get('Content-Length') is not None:
+                remaining = int(headers['Content-Length'])
+                while remaining:
+                    chunk = await read_exactly(min(remaining, chunk_size))
+                    remaining -= len(chunk)
+                    yield chunk
+            else:
+                # The body runs until the server closes the connection.
+                conn.will_close = True
+                while True:
+                    chunk = await asyncio.wait_for(reader.read(chunk_size), self.timeout)
+                    if not chunk:
+                        return
+                    yield chunk
+
+        return chunks()
+
+    async def _open(self, method: str, url: str, headers: dict, data: bytes = None):
+        """Send a request, returns (origin, connection, status, headers)."""
+        origin, path = self._origin(url)
+        while True:
+            conn, reused = await self._checkout(origin)
+            try:
+                status, response_headers = await self._send_request(
+                    conn, method, origin, path, dict(headers), data)
+            except (ConnectionError, asyncio.IncompleteReadError, ValueError) as error:
+                conn.close()
+                if reused:
+                    # The server dropped an idle connection, retry on a fresh one.
+                    logger.debug('Reused connection failed (%s), reconnecting', error)
+                    continue
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            except asyncio.TimeoutError as error:
+                conn.close()
+                raise ConnectionError(f'Request to {url} timed out') from error
+            except OSError as error:
+                conn.close()
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            except BaseException:
+                conn.close()
+                raise
+            return origin, conn, status, response_headers
+
+    async def request(self, method: str, url: str, headers: dict = None,
+                      data: bytes = None) -> transport.Response:
+        """Send a request over a pooled connection and return the full response."""
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+        headers.setdefault('Connection', 'keep-alive')
+        origin, _ = self._origin(url)
+        async with self._slot(origin):
+            origin, conn, status, response_headers = await self._open(method, url, headers, data)
+            try:
+                body = b''.join([chunk async for chunk in
+                                 self._body_chunks(conn, method, status, response_headers)])
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError,
+                    ValueError) as error:
+                conn.close()
+                raise ConnectionError(f'Request to {url} failed: {error}') from error
+            except BaseException:
+                conn.close()
+                raise
+            self._checkin(origin, conn)
+        body = transport.decode_body(body, response_headers.get('Content-Encoding'))
+        return transport.Response(status, response_headers, body)
+
+    @asynccontextmanager
+    async def stream(self, method: str, url: str, headers: dict = None):
+        """Send a request and yield an AsyncStreamingResponse read from the socket.
+
+        The body is not content-decoded, so it is requested as identity.
+        The connection returns to the pool only if the body was fully read.
+        """
+        headers = dict(headers or {})
+        headers['Accept-Encoding'] = 'identity'
+        headers.setdefault('Connection', 'keep-alive')
+        origin, _ = self._origin(url)
+        async with self._slot(origin):
+            origin, conn, status, response_headers = await self._open(method, url, headers)
+            response = AsyncStreamingResponse(
+                status, response_headers, self._body_chunks(conn, method, status, response_headers))
+            try:
+                yield response
+            except BaseException:
+                conn.close()
+                raise
+            if response.complete:
+                self._checkin(origin, conn)
+            else:
+                conn.close()
+
+    async def close(self):
+        """Close every idle connection."""
+        idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn in connections:
+                conn.close()
+                try:
+                    await conn.writer.wait_closed()
+                except (ConnectionError, ssl.SSLError):
+                    pass
+
+
+class AsyncTvdbSeries(tvdb.TvdbSeries):
+    """TvdbSeries bound to an AsyncTvdbApi.
+
+    Its episodes can't be fetched lazily by the property, they are filled
+    by get_series or by awaiting load_episodes.
+    """
+
+    @property
+    def episodes(self):
+        """Return the loaded episodes of the series."""
+        if self._episodes is None:
+            raise RuntimeError(f'The episodes of {self.series_ident} are not loaded, '
+                               'await load_episodes() first')
+        return self._episodes
+
+    async def load_episodes(self):
+        """Fetch the episodes of the series if needed and return them."""
+        if self._episodes is None:
+            self.set_episodes(await self._tvdb_api.get_episodes(self.series_id))
+        return self._episodes
+
+
+class AsyncTvdbApi(tvdb.TvdbApiBase):
+    """Provides an asyncio interface to query TVDB api."""
+
+    series_type = AsyncTvdbSeries
+
+    def __init__(self, use_cache: bool = True, http_transport: AsyncKeepAliveTransport = None,
+                 rate_limiter: ratelimit.RateLimiter = None,
+                 retry_policy: ratelimit.RetryPolicy = None):
+        """Generate a new API instance.
+
+        use_cache stores JSON responses in a persistent
+        http_cache.ResponseCache, which is read and written on the loop's
+        default executor like every other blocking call.  http_transport
+        defaults to an AsyncKeepAliveTransport, whose max_connections caps
+        the requests in flight.  rate_limiter and retry_policy pace and
+        retry every request, as for tvdb.TvdbApi.
+        """
+        super().__init__(use_cache, rate_limiter, retry_policy)
+        self._token_lock = None
+        self._flights = {}
+        self.transport = http_transport or AsyncKeepAliveTransport()
+
+    async def __aenter__(self):
+        """Async context management protocol."""
+        return self
+
+    @staticmethod
+    async def _run(func, *args):
+        """Run a blocking call, like an sqlite query or a file write, off the event loop."""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        """Close the transport."""
+        await self.close()
+
+    async def close(self):
+        """Close the idle connections of the transport."""
+        await self.transport.close()
+
+    async def get_token(self):
+        """Generate new/use cached authentication token.
+
+        Only one task logs in or refreshes the token at a time, the others
+        wait for it and use the new token.
+        """
+        if self._token_lock is None:
+            # Created on first use so it belongs to the running loop.
+            self._token_lock = asyncio.Lock()
+        async with self._token_lock:
+            action = self._token_action()
+            if action is not None:
+                # Only logins and refreshes are timed, see tvdb.TvdbApi.token.
+                with metrics.timer('tvdb.token'):
+                    if action == 'login':
+                        await self._login()
+                    else:
+                        await self._refresh_token()
+            return self._token
+
+    async def _login(self):
+        """Authenticate with TVDB for a new token."""
+        self._set_token(await self._send(*self._login_request()))
+
+    async def _refresh_token(self):
+        """Extend the current token, logging in again if it already expired."""
+        response = await self._send(*self._refresh_request())
+        if response.status == 401:
+            await self._login()
+        else:
+            self._set_token(response, refreshed=True)
+
+    def _expire_token(self, token: str):
+        """Forget a token the server rejected, unless another task already replaced it."""
+        self._forget_token(token)
+
+    async def _throttle(self, status: int, headers, attempt: int) -> bool:
+        """Handle a retryable status, returns True if the request should be sent again."""
+        retry_after = self._retry_delay(status, headers, attempt)
+        if retry_after is False:
+            return False
+        await self.retry_policy.wait_async(attempt, retry_after)
+        return True
+
+    async def _send(self, method: str, url: str, headers: dict = None, data: bytes = None):
+        """Send a paced request, retrying throttled and failed attempts."""
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire_async()
+            try:
+                with metrics.timer('http.request'):
+                    response = await self.transport.request(method, url, headers, data)
+            except ConnectionError as error:
+                if not self._retry_error(url, error, attempt):
+                    raise
+                await self.retry_policy.wait_async(attempt)
+                attempt += 1
+                continue
+            if response.status in ratelimit.RETRY_STATUSES:
+                if await self._throttle(response.status, response.headers, attempt):
+                    attempt += 1
+                    continue
+            else:
+                self.rate_limiter.on_success()
+            return response
+
+    async def _shared(self, key, func, *args):
+        """Await func(*args), sharing a single call between concurrent callers of key."""
+        future = self._flights.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func(*args))
+            self._flights[key] = future
+            future.add_done_callback(lambda _: self._flights.pop(key, None))
+        # A cancelled caller must not cancel the call the others are waiting on.
+        return await asyncio.shield(future)
+
+    async def _get(self, url: str, binary=False, ttl: int = None, cache: bool = True):
+        """Post and return contents of an HTTP request, see tvdb.TvdbApi._get."""
+        with metrics.timer('tvdb.get'):
+            body = await self._shared((url, binary), self._fetch, url, binary, ttl, cache)
+        if binary is True:
+            return body or None
+        with metrics.timer('tvdb.json_decode'):
+            return json.loads(body.decode('utf-8'))
+
+    async def _fetch(self, url: str, binary: bool, ttl: int, cache: bool) -> bytes:
+        """Return the raw body of url, from the response cache when possible."""
+        cache, cached, body = await self._run(self._lookup, url, binary, ttl, cache)
+        if body is not None:
+            return body
+        for attempt in range(2):
+            token = await self.get_token()
+            response = await self._send('GET', url, self._request_headers(token, cached))
+            if response.status != 401 or attempt > 0:
+                break
+            # The token expired early, get a new one and try once more.
+            self._expire_token(token)
+        return await self._run(self._response_body, url, response, cached, cache)
+
+    async def get_series_data(self, series_id: int):
+        """Query TVDB for the raw information about a series."""
+        url = tvdb.URLS['series'].format(series_id=series_id)
+        return self._series_data(await self._get(url, ttl=tvdb.CACHE_TTLS['series']), series_id)
+
+    async def get_series(self, series_id: int, episodes: bool = True):
+        """Query TVDB for information about a series.
+
+        The series and its episodes are fetched concurrently.  Without
+        episodes, await the series' load_episodes before using them.
+        """
+        if not episodes:
+            return self.series_type(await self.get_series_data(series_id), self)
+        series_data, episodes_data = await asyncio.gather(self.get_series_data(series_id),
+                                                          self.get_episodes(series_id))
+        series = self.series_type(series_data, self)
+        series.set_episodes(episodes_data)
+        return series
+
+    async def get_many_series(self, series_ids, max_pending: int = MAX_PENDING_SERIES):
+        """Fetch many series at once, yields (series_id, series or exception) as they finish.
+
+        Errors are yielded instead of raised, so one missing or broken
+        series does not end a library-wide refresh.  At most max_pending
+        series are fetched or waiting to be consumed at a time.
+        """
+        async def fetch(series_id):
+            try:
+                return series_id, await self.get_series(series_id)
+            except Exception as error:
+                return series_id, error
+
+        remaining = iter(series_ids)
+        max_pending = max(1, max_pending)
+        pending = set()
+        try:
+            while True:
+                for series_id in remaining:
+                    pending.add(asyncio.ensure_future(fetch(series_id)))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    return
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def get_episode(self, episode_id: int):
+        """Query TVDB for the full information about a single episode."""
+        url = tvdb.URLS['episode'].format(episode_id=episode_id)
+        return (await self._get(url, ttl=tvdb.CACHE_TTLS['episode']))['data']
+
+    async def get_episodes(self, series_id: int):
+        """Get all episode information for a series."""
+        url = tvdb.URLS['episodes'].format(series_id=series_id)
+        response = await self._get(url, ttl=tvdb.CACHE_TTLS['episodes'])
+        raw_data = response['data']
+        episode_data = list(raw_data)
+        page_urls = self._page_urls(url, response)
+        if page_urls is not None:
+            pages = await asyncio.gather(*(self._get_listed_page(page_url)
+                                           for page_url in page_urls))
+            # gather() keeps the order of its arguments, so pages stay in sequence.
+            for raw_data in pages:
+                episode_data += raw_data
+        else:
+            tvdb_page_size = 100
+            page = 1
+            while len(raw_data) == tvdb_page_size:
+                page += 1
+                raw_data = await self._get_page(f'{url}?page={page}')
+                episode_data += raw_data
+        logger.debug('Got %s episodes for seriesId %s', len(episode_data), series_id)
+        return episode_data
+
+    async def _get_page(self, url: str):
+        """Return the data of a single page of a paginated query."""
+        try:
+            return await self._get_listed_page(url)
+        except LookupError:
+            # When (total results) % tvdb_page_size == 0
+            return []
+
+    async def _get_listed_page(self, url: str):
+        """Return the data of a page links.last says exists, see tvdb.TvdbApi._get_listed_page."""
+        return (await self._get(url, ttl=tvdb.CACHE_TTLS['episodes']))['data']
+
+    async def get_updated(self, from_time: int, to_time: int = None):
+        """Find the series updated on TVDB since from_time, see tvdb.TvdbApi.get_updated."""
+        async def fetch(url):
+            try:
+                return (await self._get(url, cache=False))['data'] or []
+            except LookupError:
+                return []
+
+        updated = {}
+        urls = self._updated_urls(from_time, to_time)
+        for raw_data in await asyncio.gather(*(fetch(url) for url in urls)):
+            self._merge_updated(updated, raw_data)
+        logger.debug('Found %s series updated since %s', len(updated), from_time)
+        return updated
+
+    async def search_series_data(self, search_string: str):
+        """Search TVDB for matching shows, returns the raw series dicts."""
+        url = self._search_url(search_string)
+        raw_data = (await self._get(url, ttl=tvdb.CACHE_TTLS['search_series']))['data']
+        return self._search_results(raw_data, search_string)
+
+    async def search_series(self, search_string: str):
+        """Search TVDB for matching shows, their episodes are loaded with load_episodes."""
+        return self._series_by_ident(await self.search_series_data(search_string))
+
+    async def download(self, path: str, output_file: Path = None):
+        """Download a file from TVDB."""
+        url, output_file = self._download_target(path, output_file)
+        if not Path.is_file(output_file):
+            result = await self._shared(('download', str(output_file)), self.stream_to_file,
+                                        url, output_file)
+            output_file = self._downloaded(url, output_file, result)
+        return output_file
+
+    async def stream_to_file(self, url: str, output_file: Path):
+        """Stream a download to output_file, see tvdb.TvdbApi.stream_to_file."""
+        with metrics.timer('tvdb.download'):
+            result = await self._stream_to_file(url, output_file)
+        if result is not None:
+            metrics.count('tvdb.download_bytes', result[0])
+        return result
+
+    async def _stream_to_file(self, url: str, output_file: Path):
+        """Download url with retries, see stream_to_file."""
+        attempt = 0
+        reauthenticated = False
+        while True:
+            token = await self.get_token()
+            headers = {'Authorization': f'Bearer {token}'}
+            await self.rate_limiter.acquire_async()
+            try:
+                async with self.transport.stream('GET', url, headers) as response:
+                    if response.status == 401 and not reauthenticated:
+                        retry = reauthenticated = True
+                        self._expire_token(token)
+                    elif response.status in ratelimit.RETRY_STATUSES:
+                        retry = await self._throttle(response.status, response.headers, attempt)
+                        attempt += 1
+                    else:
+                        retry = False
+                    if not retry:
+                        return await self._write_stream(response, output_file)
+                    # Drain the error body so the connection can be reused.
+                    async for _ in response.iter_chunks():
+                        pass
+            except ConnectionError as error:
+                if not self._retry_error(url, error, attempt):
+                    raise
+                await self.retry_policy.wait_async(attempt)
+                attempt += 1
+
+    async def _write_stream(self, response: AsyncStreamingResponse, output_file: Path):
+        """Write a streamed download to output_file, see stream_to_file."""
+        self._download_response(response)
+        download = await self._run(tvdb.DownloadFile, output_file)
+        try:
+            async for chunk in response.iter_chunks():
+                await self._run(download.write, chunk)
+        except BaseException:
+            download.abort()
+            raise
+        await self._run(download.finish)
+        return download.result
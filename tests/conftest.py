@@ -0,0 +1,37 @@
+"""Shared fixtures of the test suite."""
+
+import pytest
+
+from scotchbutter.util import database, environment
+from tests.stubs import StubApi
+
+
+@pytest.fixture(autouse=True)
+def settings_home(tmp_path, monkeypatch):
+    """Keep the settings folder, and every database in it, inside tmp_path."""
+    monkeypatch.setenv('HOME', str(tmp_path))
+    environment.get_settings_path.cache_clear()
+    yield tmp_path
+    environment.get_settings_path.cache_clear()
+
+
+@pytest.fixture
+def stub_api():
+    """Serve synthetic series with 30 episodes each."""
+    return StubApi(30)
+
+
+@pytest.fixture
+def make_series(stub_api):
+    """Build a TvdbSeries with its episodes from the stub api."""
+    def make(series_id: int):
+        return stub_api.get_series(series_id)
+    return make
+
+
+@pytest.fixture
+def db():
+    """Open a per-series database in the settings folder."""
+    db = database.DBInterface()
+    yield db
+    db.close()
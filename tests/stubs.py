@@ -0,0 +1,122 @@
+"""Stand-ins for the TVDB client used by the tests."""
+
+import json
+
+from scotchbutter.util import transport, tvdb
+
+
+def series_payload(series_id: int) -> dict:
+    """Build a payload shaped like /series/{id}."""
+    return {
+        'id': series_id, 'seriesId': series_id, 'seriesName': f'Series {series_id}',
+        'firstAired': '2004-9-22', 'airsDayOfWeek': 'Wednesday', 'airsTime': '9:00 PM',
+        'banner': f'graphical/{series_id}-g.jpg', 'imdbId': f'tt{series_id:07d}',
+        'overview': f'The story of series {series_id}.', 'network': 'ABC', 'status': 'Ended',
+    }
+
+
+def episode_payload(series_id: int, number: int) -> dict:
+    """Build a payload shaped like an entry of /series/{id}/episodes."""
+    return {
+        'id': series_id * 1000 + number, 'seriesId': series_id,
+        'airedSeason': number // 10 + 1, 'airedEpisodeNumber': number % 10 + 1,
+        'episodeName': f'Episode {number}', 'firstAired': f'2010-{number % 12 + 1}-1',
+        'absoluteNumber': number + 1, 'dvdSeason': None, 'dvdEpisodeNumber': None,
+        'imdbId': '', 'filename': f'episodes/{series_id}/{number}.jpg',
+        'overview': f'Something happens in episode {number}.',
+    }
+
+
+class StubApi():
+    """Serves series and episode payloads without any network.
+
+    The payloads are created on first use and can be edited with
+    update_series, update_episode and remove_episode, every call returns
+    fresh copies like a new response would.
+    """
+
+    def __init__(self, episodes: int = 30):
+        self.episodes = episodes
+        self._series = {}
+        self._episodes = {}
+        self.calls = []
+        # Series answering 404, and the {seriesId: lastUpdated} get_updated reports.
+        self.missing = set()
+        self.updated = {}
+
+    def _load(self, series_id: int):
+        if series_id not in self._series:
+            self._series[series_id] = series_payload(series_id)
+            self._episodes[series_id] = [episode_payload(series_id, number)
+                                         for number in range(self.episodes)]
+
+    def update_series(self, series_id: int, **fields):
+        """Change fields of the payload of a series."""
+        self._load(series_id)
+        self._series[series_id].update(fields)
+
+    def update_episode(self, series_id: int, position: int, **fields):
+        """Change fields of the payload of an episode."""
+        self._load(series_id)
+        self._episodes[series_id][position].update(fields)
+
+    def remove_episode(self, series_id: int, position: int) -> dict:
+        """Drop an episode from the series, returns its payload."""
+        self._load(series_id)
+        return self._episodes[series_id].pop(position)
+
+    def get_series_data(self, series_id: int):
+        self.calls.append(('series', series_id))
+        if series_id in self.missing:
+            raise LookupError(f'seriesId {series_id} was not found')
+        self._load(series_id)
+        return dict(self._series[series_id])
+
+    def get_episodes(self, series_id: int):
+        self.calls.append(('episodes', series_id))
+        self._load(series_id)
+        return [dict(episode) for episode in self._episodes[series_id]]
+
+    def get_series(self, series_id: int, episodes: bool = True):
+        series = tvdb.TvdbSeries(self.get_series_data(series_id), self)
+        if episodes:
+            series.set_episodes(self.get_episodes(series_id))
+        return series
+
+    def get_updated(self, from_time: int, to_time: int = None):
+        self.calls.append(('updated', from_time))
+        return dict(self.updated)
+
+    def expire_series(self, series_id: int):
+        self.calls.append(('expire', series_id))
+
+
+class FakeTransport(transport.Transport):
+    """Answers requests from a table of canned responses.
+
+    routes maps a path, with its query, to a JSON payload, a (status,
+    payload) tuple or an exception to raise.  A list of those answers
+    successive requests, its last entry is repeated.  Logging in always
+    succeeds and unknown paths answer 404.  Every request is recorded in
+    requests.
+    """
+
+    def __init__(self, routes: dict = None):
+        self.routes = dict(routes or {})
+        self.requests = []
+
+    def request(self, method: str, url: str, headers: dict = None, data: bytes = None):
+        _, path = transport.split_origin(url)
+        self.requests.append((method, path))
+        if path in ('/login', '/refresh_token'):
+            return transport.Response(200, {}, b'{"token": "token"}')
+        route = self.routes.get(path)
+        if isinstance(route, list):
+            route = route.pop(0) if len(route) > 1 else route[0]
+        if isinstance(route, Exception):
+            raise route
+        if route is None:
+            return transport.Response(404, {}, b'{"Error": "Not Found"}')
+        status, payload = route if isinstance(route, tuple) else (200, route)
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+        return transport.Response(status, {}, body)
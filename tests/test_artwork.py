@@ -0,0 +1,73 @@
+"""Tests of the artwork downloads and their manifest."""
+
+import os
+import stat
+
+import pytest
+
+from scotchbutter.util import artwork, tvdb
+
+
+class StubDownloads():
+    """Serves artwork bodies by TVDB path through tvdb.DownloadFile."""
+
+    def __init__(self, bodies: dict):
+        self.bodies = bodies
+        self.fetched = []
+
+    def stream_to_file(self, url: str, output_file):
+        path = url[len(tvdb.URLS['banners']):]
+        self.fetched.append(path)
+        if path not in self.bodies:
+            raise LookupError(f'{url} was not found')
+        with tvdb.DownloadFile(output_file) as download:
+            download.write(self.bodies[path])
+        return download.result
+
+
+def test_download_file_mode(tmp_path):
+    output_file = tmp_path / 'banner.jpg'
+    with tvdb.DownloadFile(output_file) as download:
+        download.write(b'image')
+    assert output_file.read_bytes() == b'image'
+    assert stat.S_IMODE(output_file.stat().st_mode) == tvdb.DOWNLOAD_FILE_MODE
+    assert download.result[0] == 5
+
+
+def test_download_file_removed_on_error(tmp_path):
+    with pytest.raises(RuntimeError):
+        with tvdb.DownloadFile(tmp_path / 'banner.jpg') as download:
+            download.write(b'partial')
+            raise RuntimeError('connection lost')
+    assert os.listdir(tmp_path) == []
+
+
+def test_download_paths(tmp_path):
+    api = StubDownloads({'a.jpg': b'same', 'b.jpg': b'same', 'c.jpg': b'other', 'empty.jpg': b''})
+    downloader = artwork.ArtworkDownloader(api, workers=2, root=tmp_path)
+    stats = downloader.download_paths(['a.jpg', 'b.jpg', 'c.jpg', 'empty.jpg', 'gone.jpg'])
+    assert (stats.downloaded, stats.empty, stats.failed) == (3, 1, ['gone.jpg'])
+    # Identical images share one stored object.
+    assert os.path.samefile(tmp_path / 'a.jpg', tmp_path / 'b.jpg')
+    assert downloader.manifest.get('c.jpg')['size'] == 5
+
+
+def test_manifest_skips_current_files(tmp_path):
+    api = StubDownloads({'a.jpg': b'image'})
+    artwork.ArtworkDownloader(api, root=tmp_path).download_paths(['a.jpg'])
+    reloaded = artwork.ArtworkDownloader(api, root=tmp_path)
+    _, sha256 = artwork.hash_file(tmp_path / 'a.jpg')
+    assert reloaded.manifest.get('a.jpg') == {'size': 5, 'sha256': sha256}
+    stats = reloaded.download_paths(['a.jpg'])
+    assert stats.skipped == 1
+    assert api.fetched == ['a.jpg']
+
+
+def test_manifest_redownloads_changed_files(tmp_path):
+    api = StubDownloads({'a.jpg': b'image'})
+    downloader = artwork.ArtworkDownloader(api, root=tmp_path)
+    downloader.download_paths(['a.jpg'])
+    os.remove(tmp_path / 'a.jpg')
+    (tmp_path / 'a.jpg').write_bytes(b'truncated image')
+    assert downloader.download_paths(['a.jpg']).downloaded == 1
+    assert (tmp_path / 'a.jpg').read_bytes() == b'image'
@@ -0,0 +1,140 @@
+"""Tests of the crawl engine, its FetchScheduler and the EpisodeIndex."""
+
+import threading
+import time
+
+from scotchbutter.source import base
+from scotchbutter.util import database, transport
+from tests.stubs import FakeTransport
+
+
+class StubSource(base.SiteSource):
+    """Crawls /index, which links to one page per series listing its episodes."""
+
+    base_url = 'http://videos.test'
+    language = 'en'
+    delay = 0.0
+
+    def __init__(self, links: dict):
+        self.links = links
+
+    def start_requests(self, index):
+        yield base.Request(f'{self.base_url}/index')
+
+    def parse(self, page):
+        for path in page.text.split():
+            yield base.Request(page.urljoin(path), self.parse_series)
+
+    def parse_series(self, page):
+        if page.text == 'boom':
+            raise ValueError('unparsable page')
+        for series, season, episode in self.links[page.url]:
+            yield base.EpisodeLink(series, season, episode, f'{page.url}#{season}x{episode}')
+
+
+def make_index():
+    index = base.EpisodeIndex()
+    index.add_series(1, 'Series 1')
+    for episode in (1, 2):
+        index.add_episode(1, 1, episode, (1000 + episode, f'Episode {episode}'))
+    return index
+
+
+def make_scheduler(routes: dict, **kwargs):
+    return base.FetchScheduler(use_cache=False, http_transport=FakeTransport(routes), **kwargs)
+
+
+def test_crawl_matches_links():
+    source = StubSource({
+        'http://videos.test/one': [(1, 1, 1), ('Series 1', '1', '2'), (1, 1, 9)],
+        'http://videos.test/two': [('Unknown', 1, 1)],
+    })
+    routes = {'/index': b'one two one', '/one': b'', '/two': b''}
+    result = base.crawl([source], make_index(), make_scheduler(routes))
+    assert result.pages == 3
+    assert set(result.found) == {(1, 1, 1), (1, 1, 2)}
+    assert len(result.unmatched) == 2
+    assert result.failed == []
+
+
+def test_failed_page_does_not_end_crawl():
+    source = StubSource({'http://videos.test/good': [(1, 1, 1)]})
+    routes = {'/index': b'good bad gone', '/good': b'', '/bad': b'boom'}
+    result = base.crawl([source], make_index(), make_scheduler(routes))
+    assert set(result.found) == {(1, 1, 1)}
+    assert sorted(url for _, url in result.failed) == ['http://videos.test/bad',
+                                                       'http://videos.test/gone']
+
+
+def test_malformed_link_only_fails_itself():
+    source = StubSource({'http://videos.test/one': [(1, 'one', 1), (1, None, 2), (1, 1, 2)]})
+    routes = {'/index': b'one', '/one': b''}
+    result = base.crawl([source], make_index(), make_scheduler(routes))
+    assert set(result.found) == {(1, 1, 2)}
+    assert [url for _, url in result.failed] == ['http://videos.test/one#onex1',
+                                                 'http://videos.test/one#Nonex2']
+
+
+def test_throttled_request_is_retried(monkeypatch):
+    monkeypatch.setattr(base.time, 'sleep', lambda seconds: None)
+    source = StubSource({'http://videos.test/one': [(1, 1, 1)]})
+    routes = {'/index': [(429, b''), b'one'], '/one': b''}
+    scheduler = make_scheduler(routes)
+    result = base.crawl([source], make_index(), scheduler)
+    assert set(result.found) == {(1, 1, 1)}
+    assert scheduler.transport.requests.count(('GET', '/index')) == 2
+    assert scheduler._hosts['videos.test'].delay == 1.0
+
+
+def test_throttled_request_gives_up(monkeypatch):
+    monkeypatch.setattr(base.time, 'sleep', lambda seconds: None)
+    routes = {'/index': (503, b'')}
+    scheduler = make_scheduler(routes)
+    result = base.crawl([StubSource({})], make_index(), scheduler)
+    assert len(scheduler.transport.requests) == base.MAX_ATTEMPTS
+    assert result.failed == [('StubSource', 'http://videos.test/index')]
+
+
+class ConcurrencyTransport(transport.Transport):
+    """Records the most requests in flight at once."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def request(self, method: str, url: str, headers: dict = None, data: bytes = None):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        time.sleep(0.01)
+        with self.lock:
+            self.in_flight -= 1
+        return transport.Response(200, {}, b'')
+
+
+def test_host_limits_requests_in_flight():
+    http_transport = ConcurrencyTransport()
+    scheduler = base.FetchScheduler(workers=8, use_cache=False, http_transport=http_transport)
+    scheduler.set_host_limits('videos.test', 2, 0.0)
+    source = StubSource({})
+    for number in range(10):
+        scheduler.add(source, base.Request(f'http://videos.test/{number}', lambda page: ()))
+    results = list(scheduler.run())
+    assert len(results) == 10
+    assert all(error is None for *_, error in results)
+    assert http_transport.most_in_flight == 2
+
+
+def test_index_from_database_skips_missing_tables(make_series):
+    with database.DBInterface() as db:
+        db.add_series(make_series(1))
+        db.add_series(make_series(2))
+        db.cursor.execute("DROP TABLE '2'")
+    with database.DBInterface() as db:
+        assert not db.episode_table_exists(2)
+        index = base.EpisodeIndex.from_database(db)
+    assert len(index) == 30
+    assert index.series_id('Series 2') == 2
+    assert index.get('Series 1', 1, 1) == (1000, 'Episode 0')
+    assert index.get(2, 1, 1) is None
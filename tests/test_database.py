@@ -0,0 +1,195 @@
+"""Tests of the DBInterface writes, migration, snapshots and transactions."""
+
+import gzip
+
+import pytest
+
+from scotchbutter.util import database, snapshot, tables
+
+
+def episode_names(db, series_id):
+    return [name for name, in db.iter_episodes(series_id, ('episodeName',), database.ROW_TUPLE)]
+
+
+class TestAddSeries():
+    """The diff upsert of DBInterface.add_series."""
+
+    def test_insert(self, db, make_series):
+        changes = db.add_series(make_series(1))
+        assert changes.series == database.SeriesChanges.INSERTED
+        assert (changes.inserted, changes.updated, changes.deleted) == (30, 0, 0)
+        assert len(db.get_episodes(1)) == 30
+
+    def test_unchanged(self, db, make_series):
+        db.add_series(make_series(1))
+        changes = db.add_series(make_series(1))
+        assert not changes.changed
+        assert changes.unchanged == 30
+
+    def test_update(self, db, stub_api, make_series):
+        db.add_series(make_series(1))
+        stub_api.update_episode(1, 0, episodeName='Renamed')
+        changes = db.add_series(make_series(1))
+        assert changes.series == database.SeriesChanges.UNCHANGED
+        assert (changes.inserted, changes.updated, changes.unchanged) == (0, 1, 29)
+        assert 'Renamed' in episode_names(db, 1)
+
+    def test_update_series(self, db, stub_api, make_series):
+        db.add_series(make_series(1))
+        stub_api.update_series(1, airsTime='8:00 PM')
+        changes = db.add_series(make_series(1))
+        assert changes.series == database.SeriesChanges.UPDATED
+        assert changes.unchanged == 30
+        assert db.get_library(('airsTime',), database.ROW_TUPLE) == [('8:00 PM',)]
+
+    def test_delete(self, db, stub_api, make_series):
+        db.add_series(make_series(1))
+        removed = stub_api.remove_episode(1, -1)
+        changes = db.add_series(make_series(1))
+        assert changes.deleted == 1
+        assert removed['episodeName'] not in episode_names(db, 1)
+
+    def test_subset_does_not_delete(self, db, make_series):
+        db.add_series(make_series(1))
+        series = make_series(1)
+        changes = db.add_series(series, series.episodes[:5])
+        assert (changes.deleted, changes.unchanged) == (0, 5)
+        assert len(db.get_episodes(1)) == 30
+
+
+class TestMigrateToNormalized():
+    """Moving per-series tables into the single episodes table."""
+
+    def test_migrate(self, db, make_series):
+        db.add_series(make_series(1))
+        db.add_series(make_series(2))
+        expected = db.get_episodes(2)
+        assert db.migrate_to_normalized() == 2
+        assert db.schema == database.SCHEMA_NORMALIZED
+        assert not db._series_tables()
+        assert db.get_episodes(2) == expected
+        assert db.migrate_to_normalized() == 0
+
+    def test_reopened_database_keeps_schema(self, db, make_series):
+        db.add_series(make_series(1))
+        db.migrate_to_normalized()
+        db.close()
+        reopened = database.DBInterface()
+        assert reopened.schema == database.SCHEMA_NORMALIZED
+        assert len(reopened.get_episodes(1)) == 30
+        reopened.close()
+
+    def test_normalized_schema_requires_migration(self, db, make_series):
+        db.add_series(make_series(1))
+        db.close()
+        normalized = database.DBInterface(schema=database.SCHEMA_NORMALIZED)
+        with pytest.raises(ValueError):
+            normalized.add_series(make_series(2))
+        assert normalized.migrate_to_normalized() == 1
+        normalized.add_series(make_series(2))
+        assert len(normalized.get_episodes(1)) == 30
+        assert len(normalized.get_episodes(2)) == 30
+        normalized.close()
+
+
+    def test_episodes_sharing_numbers(self, db, stub_api, make_series):
+        stub_api.update_episode(1, 1, airedSeason=1, airedEpisodeNumber=1)
+        db.add_series(make_series(1))
+        db.migrate_to_normalized()
+        assert len(db.get_episodes(1)) == 30
+        assert not db.add_series(make_series(1)).changed
+
+    def test_rekeys_episodes_table(self, db, make_series):
+        # The layout of the first normalized schema, keyed by the numbering.
+        old_columns = (tables.Column('id', 'INTEGER', 'NOT NULL'),) + tables.SHOW_COLUMNS[1:]
+        with db.transaction():
+            db.create_table(db.episodes_name, old_columns,
+                            ('seriesId', 'airedSeason', 'airedEpisodeNumber'))
+            db.set_state(database.SCHEMA_KEY, database.SCHEMA_NORMALIZED)
+        db.close()
+        normalized = database.DBInterface()
+        with pytest.raises(ValueError):
+            normalized.add_series(make_series(1))
+        assert normalized.migrate_to_normalized() == 0
+        assert normalized._episodes_keyed_by_id()
+        normalized.add_series(make_series(1))
+        assert len(normalized.get_episodes(1)) == 30
+        normalized.close()
+
+
+class TestSnapshot():
+    """Exporting and importing library snapshots."""
+
+    def test_round_trip(self, db, make_series, tmp_path):
+        for series_id in (1, 2):
+            db.add_series(make_series(series_id))
+        db.set_state('last_sync', '1234')
+        file_path = tmp_path / 'library.snap'
+        assert db.export_snapshot(file_path) == {'series': 2, 'episodes': 60}
+        target = database.DBInterface('imported.sqlite', schema=database.SCHEMA_NORMALIZED)
+        assert target.import_snapshot(file_path, batch_size=7) == {'series': 2, 'episodes': 60}
+        assert target.get_library() == db.get_library()
+        assert target.get_episodes(2) == db.get_episodes(2)
+        assert target.get_state('last_sync') == '1234'
+        assert target.search('Series 2')
+        target.close()
+
+    def test_truncated_import(self, db, make_series, tmp_path):
+        db.add_series(make_series(1))
+        file_path = tmp_path / 'library.snap'
+        db.export_snapshot(file_path)
+        with gzip.open(file_path, 'rb') as source:
+            data = source.read()
+        with gzip.open(file_path, 'wb') as target:
+            target.write(data[:len(data) // 2])
+        other = database.DBInterface('imported.sqlite')
+        other.add_series(make_series(2))
+        with pytest.raises(snapshot.SnapshotError):
+            other.import_snapshot(file_path)
+        assert [row['seriesId'] for row in other.get_library()] == [2]
+        # The rolled back import leaves the database usable.
+        other.add_series(make_series(3))
+        assert len(other.get_episodes(3)) == 30
+        other.close()
+
+    def test_not_a_snapshot(self, db, tmp_path):
+        file_path = tmp_path / 'library.snap'
+        file_path.write_bytes(b'not a snapshot')
+        with pytest.raises(snapshot.SnapshotError):
+            db.import_snapshot(file_path)
+
+
+class TestTransaction():
+    """DBInterface.transaction commits, rolls back and nests."""
+
+    def test_rollback(self, db, make_series):
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.add_series(make_series(1))
+                raise RuntimeError('abort')
+        assert db.existing_tables == []
+        # Tables the rollback dropped are created again.
+        changes = db.add_series(make_series(1))
+        assert changes.inserted == 30
+        assert len(db.get_episodes(1)) == 30
+
+    def test_nested_rollback(self, db, make_series):
+        db.add_series(make_series(1))
+        with pytest.raises(RuntimeError):
+            with db.transaction():
+                db.add_series(make_series(2))
+                with db.transaction():
+                    db.set_state('last_sync', '1')
+                raise RuntimeError('abort')
+        assert [row['seriesId'] for row in db.get_library()] == [1]
+        assert db.get_state('last_sync') is None
+
+    def test_commit(self, db, make_series):
+        with db.transaction():
+            db.add_series(make_series(1))
+            db.set_state('last_sync', '1')
+        db.close()
+        reopened = database.DBInterface()
+        assert len(reopened.get_episodes(1)) == 30
+        assert reopened.get_state('last_sync') == '1'
+        reopened.close()
@@ -0,0 +1,62 @@
+"""Tests of the persistent HTTP response cache."""
+
+from scotchbutter.util import http_cache
+
+
+def last_access(cache, url):
+    query = f"SELECT last_access FROM '{cache.table_name}' WHERE url = ?"
+    return cache._conn.execute(query, (url,)).fetchone()[0]
+
+
+def test_lookup_fresh_and_stale():
+    cache = http_cache.ResponseCache()
+    assert cache.lookup('http://a/1') == (None, False)
+    cache.store('http://a/1', b'body', etag='"v1"')
+    response, fresh = cache.lookup('http://a/1', ttl=60)
+    assert (response.body, fresh) == (b'body', True)
+    assert response.validators == {'If-None-Match': '"v1"'}
+    _, fresh = cache.lookup('http://a/1', ttl=0)
+    assert fresh is False
+    cache.revalidate('http://a/1')
+    assert cache.stats['revalidated'] == 1
+    cache.close()
+
+
+def test_uses_wal():
+    cache = http_cache.ResponseCache()
+    assert cache._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+    cache.close()
+
+
+def test_access_time_is_throttled(monkeypatch):
+    cache = http_cache.ResponseCache()
+    cache.store('http://a/1', b'body')
+    stored = last_access(cache, 'http://a/1')
+    cache.lookup('http://a/1')
+    assert last_access(cache, 'http://a/1') == stored
+    monkeypatch.setattr(http_cache, 'ACCESS_UPDATE_INTERVAL', 0)
+    cache.lookup('http://a/1')
+    assert last_access(cache, 'http://a/1') > stored
+    cache.close()
+
+
+def test_evicts_least_recently_used():
+    cache = http_cache.ResponseCache(max_bytes=10)
+    cache.store('http://a/1', b'12345')
+    cache.store('http://a/2', b'12345')
+    cache.store('http://a/3', b'12345')
+    assert cache.lookup('http://a/1') == (None, False)
+    assert cache.lookup('http://a/3')[0].body == b'12345'
+    assert cache.stats['bytes'] == 10
+    cache.close()
+
+
+def test_invalidate_nested_urls():
+    cache = http_cache.ResponseCache()
+    for url in ('http://a/series/1', 'http://a/series/1/episodes?page=2',
+                'http://a/series/12'):
+        cache.store(url, b'body')
+    cache.invalidate('http://a/series/1')
+    assert cache.lookup('http://a/series/1/episodes?page=2') == (None, False)
+    assert cache.lookup('http://a/series/12')[0] is not None
+    cache.close()
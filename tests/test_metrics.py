@@ -0,0 +1,65 @@
+"""Tests of the metrics registry and the instrumented hot paths."""
+
+import json
+
+import pytest
+
+from scotchbutter.util import metrics, tvdb
+from tests.stubs import FakeTransport, series_payload
+
+
+@pytest.fixture
+def registry(monkeypatch):
+    """Swap the default registry for an empty one."""
+    registry = metrics.MetricsRegistry()
+    monkeypatch.setattr(metrics, 'REGISTRY', registry)
+    return registry
+
+
+def test_histogram():
+    histogram = metrics.Histogram(buckets=(1.0, 2.0, 4.0), unit='')
+    for value in (0.5, 1.5, 1.5, 3.0, 10.0):
+        histogram.observe(value)
+    assert histogram.bucket_counts == [1, 2, 1, 1]
+    assert (histogram.count, histogram.min, histogram.max) == (5, 0.5, 10.0)
+    assert histogram.mean == pytest.approx(3.3)
+    assert 1.0 <= histogram.quantile(0.5) <= 2.0
+    assert histogram.quantile(1.0) == 10.0
+
+
+def test_timer_records_errors(registry):
+    with pytest.raises(ValueError):
+        with registry.timer('work'):
+            raise ValueError('failed')
+    assert registry.snapshot()['histograms']['work']['count'] == 1
+
+
+def test_exports(registry):
+    registry.count('tvdb.cache_hits', 3)
+    registry.observe('db.commit', 0.002)
+    assert json.loads(registry.to_json())['counters'] == {'tvdb.cache_hits': 3}
+    text = registry.to_prometheus()
+    assert 'scotchbutter_tvdb_cache_hits_total 3' in text
+    assert 'scotchbutter_db_commit_seconds_bucket{le="+Inf"} 1' in text
+    assert 'scotchbutter_db_commit_seconds_count 1' in text
+    assert 'db.commit' in registry.summary()
+
+
+def test_token_is_timed_only_when_fetched(registry):
+    fake = FakeTransport({'/series/1': {'data': series_payload(1)}})
+    api = tvdb.TvdbApi(use_cache=False, http_transport=fake)
+    for _ in range(3):
+        api.get_series_data(1)
+    snapshot = registry.snapshot()
+    assert snapshot['histograms']['tvdb.token']['count'] == 1
+    assert snapshot['counters']['tvdb.logins'] == 1
+    assert snapshot['histograms']['tvdb.get']['count'] == 3
+
+
+def test_select_is_recorded_once(registry, db, make_series):
+    db.add_series(make_series(1))
+    registry.reset()
+    db._select_from_table(db.library_name)
+    snapshot = registry.snapshot()
+    assert list(snapshot['histograms']) == ['db.iter_rows']
+    assert snapshot['histograms']['db.iter_rows']['count'] == 1
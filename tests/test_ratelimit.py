@@ -0,0 +1,83 @@
+"""Tests of the request pacing and retry policies."""
+
+import email.utils
+import time
+
+import pytest
+
+from scotchbutter.util import ratelimit, tvdb
+from tests.stubs import FakeTransport, series_payload
+
+
+class NoWaitRetryPolicy(ratelimit.RetryPolicy):
+    """Retries without sleeping."""
+
+    def wait(self, attempt: int, retry_after: float = None):
+        self._next_delay(attempt, retry_after)
+
+
+def test_parse_retry_after():
+    assert ratelimit.parse_retry_after('120') == 120.0
+    assert ratelimit.parse_retry_after(None) is None
+    assert ratelimit.parse_retry_after('soon') is None
+    when = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 25 < ratelimit.parse_retry_after(when) <= 30
+
+
+def test_additive_increase_multiplicative_decrease():
+    limiter = ratelimit.RateLimiter(rate=10.0, min_rate=1.0, max_rate=10.5, increase=0.2)
+    limiter.on_success()
+    limiter.on_success()
+    limiter.on_success()
+    assert limiter.rate == 10.5
+    limiter.on_throttle()
+    assert limiter.rate == 5.25
+    for _ in range(5):
+        limiter.on_throttle()
+    assert limiter.rate == 1.0
+    assert limiter.metrics['throttled'] == 6
+
+
+def test_bucket_paces_after_burst():
+    limiter = ratelimit.RateLimiter(rate=10.0, burst=2)
+    waits = [limiter.reserve() for _ in range(4)]
+    assert waits[:2] == [0.0, 0.0]
+    assert 0.05 < waits[2] < waits[3] <= 0.2
+
+
+def test_retry_after_pauses_the_bucket():
+    limiter = ratelimit.RateLimiter(burst=10)
+    limiter.on_throttle(retry_after=5)
+    assert 4.5 < limiter.reserve() <= 5
+
+
+def test_retry_policy_limits():
+    policy = ratelimit.RetryPolicy(max_retries=2, backoff=1.0, max_backoff=3.0, budget=3)
+    assert [policy.allow(attempt) for attempt in range(3)] == [True, True, False]
+    assert policy.allow(0) is True
+    assert policy.allow(0) is False
+    assert policy.delay(0, retry_after=10) == 3.0
+    assert 0.5 <= policy.delay(0) <= 1.0
+    assert policy.delay(5) <= 3.0
+
+
+def test_api_retries_throttled_and_failed_requests():
+    fake = FakeTransport({'/series/1': [(503, b''), ConnectionError('reset'),
+                                        {'data': series_payload(1)}]})
+    limiter = ratelimit.RateLimiter(rate=10.0)
+    api = tvdb.TvdbApi(use_cache=False, http_transport=fake, rate_limiter=limiter,
+                       retry_policy=NoWaitRetryPolicy())
+    assert api.get_series_data(1)['seriesName'] == 'Series 1'
+    assert fake.requests.count(('GET', '/series/1')) == 3
+    assert api.metrics['retries'] == 2
+    assert api.metrics['throttled'] == 1
+    assert limiter.rate < 10.0
+
+
+def test_api_gives_up_after_max_retries():
+    fake = FakeTransport({'/series/1': (503, b'')})
+    api = tvdb.TvdbApi(use_cache=False, http_transport=fake,
+                       retry_policy=NoWaitRetryPolicy(max_retries=2))
+    with pytest.raises(ConnectionError):
+        api.get_series_data(1)
+    assert fake.requests.count(('GET', '/series/1')) == 3
@@ -0,0 +1,62 @@
+"""Tests of the bulk library refresh and incremental sync."""
+
+from scotchbutter.util import refresh, tvdb
+from tests.stubs import FakeTransport, episode_payload, series_payload
+
+
+def library_ids(db):
+    return refresh.library_series_ids(db)
+
+
+def test_refresh_library(db, stub_api):
+    stats = refresh.refresh_library(db, stub_api, list(range(1, 11)), workers=3, batch_size=4)
+    assert (stats.series, stats.episodes, stats.failed) == (10, 300, [])
+    assert library_ids(db) == list(range(1, 11))
+    assert {('expire', series_id) for series_id in range(1, 11)} <= set(stub_api.calls)
+
+
+def test_refresh_records_failed_series(db, stub_api):
+    stub_api.missing.add(3)
+    stats = refresh.refresh_library(db, stub_api, [1, 2, 3, 4], workers=2)
+    assert stats.failed == [3]
+    assert library_ids(db) == [1, 2, 4]
+
+
+def test_refresh_writes_changes(db, stub_api):
+    refresh.refresh_library(db, stub_api, [1])
+    stub_api.update_episode(1, 0, episodeName='Renamed')
+    stub_api.remove_episode(1, -1)
+    stats = refresh.refresh_library(db, stub_api)
+    assert stats.episodes == 29
+    names = [episode['episodeName'] for episode in db.get_episodes(1)]
+    assert names[0] == 'Renamed' and len(names) == 29
+
+
+def test_refresh_revalidates_cached_responses(db):
+    fake = FakeTransport({
+        '/series/1': {'data': series_payload(1)},
+        '/series/1/episodes': {'data': [episode_payload(1, n) for n in range(5)],
+                               'links': {'last': 1}},
+    })
+    api = tvdb.TvdbApi(http_transport=fake)
+    api.get_series(1).episodes
+    fake.requests.clear()
+    stats = refresh.refresh_library(db, api, [1])
+    assert stats.episodes == 5
+    assert ('GET', '/series/1') in fake.requests
+    assert ('GET', '/series/1/episodes') in fake.requests
+    api.cache.close()
+
+
+def test_sync_library(db, stub_api):
+    first = refresh.sync_library(db, stub_api)
+    assert first.series == 0
+    assert db.get_state(refresh.LAST_SYNC_KEY) is not None
+    refresh.refresh_library(db, stub_api, [1, 2])
+    db.set_state(refresh.LAST_SYNC_KEY, '0')
+    stub_api.updated = {2: 100, 99: 100}
+    stub_api.update_episode(2, 0, episodeName='Renamed')
+    stats = refresh.sync_library(db, stub_api)
+    assert stats.series == 1
+    assert db.get_episodes(2)[0]['episodeName'] == 'Renamed'
+    assert int(db.get_state(refresh.LAST_SYNC_KEY)) > 0
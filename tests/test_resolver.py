@@ -0,0 +1,110 @@
+"""Tests of the batch title resolver."""
+
+import threading
+
+import pytest
+
+from scotchbutter.util import resolver
+
+
+class SearchApi():
+    """Answers searches from a table of results and counts them."""
+
+    def __init__(self, results: dict):
+        self.results = results
+        self.lock = threading.Lock()
+        self.searches = []
+
+    def search_series_data(self, query: str):
+        with self.lock:
+            self.searches.append(query)
+        result = self.results.get(query)
+        if isinstance(result, Exception):
+            raise result
+        if result is None:
+            raise LookupError(query)
+        return result
+
+
+def candidate(series_id: int, name: str, first_aired: str = '', **fields):
+    return dict({'id': series_id, 'seriesName': name, 'firstAired': first_aired}, **fields)
+
+
+OFFICE_US = candidate(73244, 'The Office (US)', '2005-03-24', aliases=['The Office'])
+OFFICE_UK = candidate(78107, 'The Office', '2001-07-09')
+
+
+@pytest.fixture
+def make_resolver():
+    resolvers = []
+
+    def make(results: dict, **kwargs):
+        batch = resolver.Resolver(SearchApi(results), workers=2, **kwargs)
+        resolvers.append(batch)
+        return batch
+    yield make
+    for batch in resolvers:
+        batch.close()
+
+
+@pytest.mark.parametrize('title, expected', [
+    ('The Office (2005)', ('office', 2005)),
+    ('the.office.us', ('office us', None)),
+    ('Doctor Who [2005]', ('doctor who', 2005)),
+    ('Show.Name.2019', ('show name', 2019)),
+    ('1883', ('1883', None)),
+])
+def test_parse_title(title, expected):
+    assert resolver.parse_title(title) == expected
+
+
+def test_candidate_year():
+    assert resolver.candidate_year(OFFICE_US) == 2005
+    assert resolver.candidate_year(candidate(1, 'Unaired')) is None
+    assert resolver.candidate_year(candidate(1, 'Unaired', None)) is None
+
+
+def test_score_candidate_uses_aliases_and_year():
+    assert resolver.score_candidate('office', None, OFFICE_US) == 1.0
+    same_year = resolver.score_candidate('office', 2005, OFFICE_US)
+    other_year = resolver.score_candidate('office', 2005, OFFICE_UK)
+    assert same_year == 1.0 + resolver.YEAR_BONUS
+    assert other_year == 1.0 - resolver.YEAR_PENALTY
+
+
+def test_resolve_dedups_queries(make_resolver):
+    batch = make_resolver({'office': [OFFICE_UK, OFFICE_US]})
+    titles = ['The Office (2005)', 'the.office', 'THE OFFICE (2001)', '', '  ']
+    resolutions = {res.title: res for res in batch.resolve(titles)}
+    assert batch.tvdb_api.searches == ['office']
+    assert resolutions['The Office (2005)'].series_id == 73244
+    assert resolutions['THE OFFICE (2001)'].series_id == 78107
+    assert resolutions['the.office'].candidates == 2
+    assert len(resolutions) == 3
+
+
+def test_resolve_threshold_and_errors(make_resolver):
+    batch = make_resolver({'offices': [OFFICE_UK], 'broken': ConnectionError('reset')},
+                          threshold=0.95)
+    resolutions = {res.title: res for res in batch.resolve(['Offices', 'Broken', 'Missing', '!!'])}
+    assert not resolutions['Offices'].matched
+    assert resolutions['Offices'].score > 0
+    assert resolutions['Broken'].error == 'reset'
+    assert resolutions['Missing'].candidates == 0
+    assert resolutions['!!'].error == 'Title has no searchable text'
+
+
+def test_threshold_zero_is_kept(make_resolver):
+    results = {'post office box': [OFFICE_UK]}
+    resolution, = make_resolver(results).resolve(['Post Office Box'])
+    assert not resolution.matched
+    resolution, = make_resolver(results, threshold=0.0).resolve(['Post Office Box'])
+    assert resolution.series_id == 78107
+
+
+def test_searches_are_cached(make_resolver):
+    make_resolver({'office': [OFFICE_UK]}).resolve_lines(['The Office']).__next__()
+    batch = make_resolver({})
+    line, = batch.resolve_lines(['The Office'])
+    assert batch.tvdb_api.searches == []
+    assert '"seriesId": 78107' in line
@@ -0,0 +1,58 @@
+"""Tests of the single-flight call coalescing."""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from scotchbutter.util import singleflight
+
+
+def run_together(flight, func, callers: int = 5):
+    """Call flight.do from several threads while func is blocked, return their futures."""
+    with ThreadPoolExecutor(max_workers=callers) as executor:
+        futures = [executor.submit(flight.do, 'key', func) for _ in range(callers)]
+        # Every caller but the leader is waiting once shared reaches callers - 1.
+        while flight.shared < callers - 1:
+            threading.Event().wait(0.001)
+        func.release.set()
+    return futures
+
+
+def blocking(result=None, error=None):
+    """Build a function that blocks until released, counting its calls."""
+    def func():
+        func.started += 1
+        func.release.wait(5)
+        if error is not None:
+            raise error
+        return result
+    func.started = 0
+    func.release = threading.Event()
+    return func
+
+
+def test_concurrent_calls_are_shared():
+    flight = singleflight.SingleFlight()
+    func = blocking(result=[1, 2])
+    futures = run_together(flight, func)
+    assert [future.result() for future in futures] == [[1, 2]] * 5
+    assert (func.started, flight.calls, flight.shared) == (1, 1, 4)
+
+
+def test_errors_are_shared():
+    flight = singleflight.SingleFlight()
+    func = blocking(error=LookupError('missing'))
+    futures = run_together(flight, func)
+    for future in futures:
+        with pytest.raises(LookupError):
+            future.result()
+    assert func.started == 1
+
+
+def test_finished_calls_are_not_kept():
+    flight = singleflight.SingleFlight()
+    assert flight.do('key', lambda: 1) == 1
+    assert flight.do('key', lambda: 2) == 2
+    assert flight.do('other', lambda: 3) == 3
+    assert (flight.calls, flight.shared) == (3, 0)
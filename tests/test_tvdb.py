@@ -0,0 +1,44 @@
+"""Tests of the TvdbApi requests against a fake transport."""
+
+import pytest
+
+from scotchbutter.util import tvdb
+from tests.stubs import FakeTransport, episode_payload
+
+
+def episodes_page(series_id: int, page: int, size: int = 100, last: int = None):
+    """Build a response of /series/{id}/episodes holding size episodes."""
+    start = (page - 1) * 100
+    data = [episode_payload(series_id, number) for number in range(start, start + size)]
+    return {'data': data, 'links': {'first': 1, 'last': last, 'next': None}}
+
+
+def make_api(routes: dict, page_workers: int = tvdb.PAGE_WORKERS):
+    fake = FakeTransport(routes)
+    return tvdb.TvdbApi(page_workers=page_workers, use_cache=False, http_transport=fake), fake
+
+
+class TestGetEpisodes():
+    """Walking the pages of /series/{id}/episodes."""
+
+    def test_listed_pages(self):
+        api, _ = make_api({
+            '/series/1/episodes': episodes_page(1, 1, last=3),
+            '/series/1/episodes?page=2': episodes_page(1, 2, last=3),
+            '/series/1/episodes?page=3': episodes_page(1, 3, size=20, last=3),
+        })
+        episodes = api.get_episodes(1)
+        assert [episode['id'] for episode in episodes] == [1000 + n for n in range(220)]
+
+    def test_missing_listed_page_raises(self):
+        api, _ = make_api({
+            '/series/1/episodes': episodes_page(1, 1, last=3),
+            '/series/1/episodes?page=3': episodes_page(1, 3, size=20, last=3),
+        })
+        with pytest.raises(LookupError):
+            api.get_episodes(1)
+
+    def test_serial_walk_ends_on_missing_page(self):
+        api, fake = make_api({'/series/1/episodes': episodes_page(1, 1)}, page_workers=1)
+        assert len(api.get_episodes(1)) == 100
+        assert ('GET', '/series/1/episodes?page=2') in fake.requests
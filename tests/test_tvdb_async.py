@@ -0,0 +1,205 @@
+"""Tests of the asyncio TVDB client and its HTTP/1.1 transport."""
+
+import asyncio
+import gzip
+
+import pytest
+
+from scotchbutter.util import refresh, tvdb_async
+
+
+class ScriptedServer():
+    """Local HTTP server answering each request with the next scripted response.
+
+    A response of None closes the connection without answering.
+    """
+
+    def __init__(self, responses: list):
+        self.responses = list(responses)
+        self.requests = []
+        self.connections = 0
+        self._server = None
+
+    async def __aenter__(self):
+        self._server = await asyncio.start_server(self._handle, '127.0.0.1', 0)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._server.close()
+        await self._server.wait_closed()
+
+    def url(self, path: str) -> str:
+        port = self._server.sockets[0].getsockname()[1]
+        return f'http://127.0.0.1:{port}{path}'
+
+    async def _handle(self, reader, writer):
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except asyncio.IncompleteReadError:
+                    break
+                self.requests.append(head.split(b'\r\n')[0].decode('latin-1'))
+                response = self.responses.pop(0)
+                if response is None:
+                    break
+                writer.write(response)
+                await writer.drain()
+        finally:
+            writer.close()
+
+
+def ok(body: bytes, *headers: str) -> bytes:
+    """Build a response with a Content-Length body."""
+    lines = ['HTTP/1.1 200 OK', f'Content-Length: {len(body)}'] + list(headers)
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+
+CHUNKED = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+           b'5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: 1\r\n\r\n')
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+class TestTransport():
+    """AsyncKeepAliveTransport against a local server."""
+
+    def test_chunked_body_keeps_connection_usable(self):
+        async def main():
+            async with ScriptedServer([CHUNKED, ok(b'next')]) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                first = await client.request('GET', server.url('/chunked'))
+                second = await client.request('GET', server.url('/next'))
+                await client.close()
+                return first, second, client.connections_opened, server.connections
+
+        first, second, opened, connections = run(main())
+        assert (first.status, first.body) == (200, b'hello world')
+        assert second.body == b'next'
+        assert (opened, connections) == (1, 1)
+
+    def test_keep_alive_reuse_and_close(self):
+        async def main():
+            responses = [ok(b'1'), ok(b'2', 'Connection: close'), ok(b'3')]
+            async with ScriptedServer(responses) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                bodies = [(await client.request('GET', server.url(f'/{n}'))).body
+                          for n in range(3)]
+                await client.close()
+                return bodies, client.connections_opened
+
+        bodies, opened = run(main())
+        assert bodies == [b'1', b'2', b'3']
+        assert opened == 2
+
+    def test_gzip_body(self):
+        async def main():
+            response = ok(gzip.compress(b'{"data": []}'), 'Content-Encoding: gzip')
+            async with ScriptedServer([response]) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                result = await client.request('GET', server.url('/'))
+                await client.close()
+                return result
+
+        assert run(main()).body == b'{"data": []}'
+
+    def test_stale_connection_is_retried(self):
+        async def main():
+            async with ScriptedServer([ok(b'1'), None, ok(b'2')]) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                await client.request('GET', server.url('/1'))
+                second = await client.request('GET', server.url('/2'))
+                await client.close()
+                return second, client.connections_opened, server.requests
+
+        second, opened, requests = run(main())
+        assert second.body == b'2'
+        assert opened == 2
+        assert requests == ['GET /1 HTTP/1.1', 'GET /2 HTTP/1.1', 'GET /2 HTTP/1.1']
+
+    def test_fresh_connection_failure_raises(self):
+        async def main():
+            async with ScriptedServer([None]) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                try:
+                    await client.request('GET', server.url('/'))
+                finally:
+                    await client.close()
+
+        with pytest.raises(ConnectionError):
+            run(main())
+
+    def test_stream(self):
+        async def main():
+            async with ScriptedServer([ok(b'x' * 100), ok(b'after')]) as server:
+                client = tvdb_async.AsyncKeepAliveTransport(timeout=5)
+                async with client.stream('GET', server.url('/file')) as response:
+                    chunks = [chunk async for chunk in response.iter_chunks()]
+                after = await client.request('GET', server.url('/after'))
+                await client.close()
+                return chunks, after, client.connections_opened
+
+        chunks, after, opened = run(main())
+        assert b''.join(chunks) == b'x' * 100
+        assert (after.body, opened) == (b'after', 1)
+
+
+class CountingApi(tvdb_async.AsyncTvdbApi):
+    """Serves series after a short delay, tracking how many are fetched at once."""
+
+    def __init__(self):
+        super().__init__(use_cache=False)
+        self.active = 0
+        self.most_active = 0
+
+    async def get_series(self, series_id: int, episodes: bool = True):
+        self.active += 1
+        self.most_active = max(self.most_active, self.active)
+        await asyncio.sleep(0.001)
+        self.active -= 1
+        if series_id == 3:
+            raise LookupError('missing')
+        return series_id
+
+
+def test_get_many_series_is_bounded():
+    async def main():
+        api = CountingApi()
+        results = [item async for item in api.get_many_series(range(20), max_pending=4)]
+        return api, results
+
+    api, results = run(main())
+    assert sorted(series_id for series_id, _ in results) == list(range(20))
+    assert isinstance(dict(results)[3], LookupError)
+    assert api.most_active <= 4
+
+
+class AsyncStubApi():
+    """Async facade over a StubApi for refresh_library_async."""
+
+    def __init__(self, stub_api):
+        self.stub_api = stub_api
+
+    def expire_series(self, series_id: int):
+        self.stub_api.expire_series(series_id)
+
+    async def get_many_series(self, series_ids, max_pending: int):
+        for series_id in series_ids:
+            try:
+                yield series_id, self.stub_api.get_series(series_id)
+            except Exception as error:
+                yield series_id, error
+
+
+def test_refresh_library_async(db, stub_api, make_series):
+    db.add_series(make_series(1))
+    stub_api.missing.add(2)
+    stats = run(refresh.refresh_library_async(db, AsyncStubApi(stub_api), batch_size=2,
+                                              series_ids=[1, 2, 3, 4]))
+    assert (stats.series, stats.failed) == (3, [2])
+    # The connection moved back off the writer thread.
+    assert [row['seriesId'] for row in db.get_library()] == [1, 3, 4]
+    assert ('expire', 4) in stub_api.calls